@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+### The utils are imported as a package from the repo root, the same way the notebooks add it to the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.synthetic_data import make_synthetic_lar, make_synthetic_tract_race
+from utils.read_data import read_lar
+from utils.process_data import load_counties, load_references, clean_chunk
+
+
+SYNTHETIC_ROWS = 5000
+
+
+@pytest.fixture(scope = 'session')
+def lar_path(tmp_path_factory):
+
+    '''
+    A small synthetic public LAR written as CSV
+    '''
+
+    path = tmp_path_factory.mktemp('lar') / 'synthetic_lar.csv'
+    make_synthetic_lar(SYNTHETIC_ROWS, seed = 0).to_csv(path, index = False)
+
+    return str(path)
+
+
+@pytest.fixture(scope = 'session')
+def references(tmp_path_factory):
+
+    '''
+    The supplemental datasets from the repo, with a synthetic tract race table for the tracts the LAR uses
+    '''
+
+    tract_race_path = tmp_path_factory.mktemp('census') / 'tract_race.csv'
+    make_synthetic_tract_race(load_counties(), seed = 0).to_csv(tract_race_path, index = False)
+
+    return load_references(tract_race_path = str(tract_race_path))
+
+
+@pytest.fixture
+def lar_df(lar_path):
+
+    '''
+    The synthetic LAR read with the LAR schema
+    '''
+
+    return read_lar(lar_path)
+
+
+@pytest.fixture
+def clean_df(lar_df):
+
+    '''
+    The synthetic LAR after everything 1_clean_data does
+    '''
+
+    return clean_chunk(lar_df)
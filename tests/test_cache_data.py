@@ -0,0 +1,38 @@
+import inspect
+
+import pandas as pd
+
+from utils import clean_data, categorize_data
+from utils.cache_data import function_source, cached_stage
+from utils.pipeline import STAGES, measure_stage_prop_values
+
+
+calls = []
+
+
+def count_records(path, column):
+
+    calls.append(column)
+    return pd.read_csv(path, usecols = [column])[column].notnull().sum()
+
+
+def test_cached_stage_reruns_on_changed_inputs(tmp_path, lar_path):
+
+    cache_dir = str(tmp_path / 'cache')
+
+    first = cached_stage(count_records, lar_path, 'lei', cache_dir = cache_dir)
+    second = cached_stage(count_records, lar_path, 'lei', cache_dir = cache_dir)
+    other = cached_stage(count_records, lar_path, 'action_taken', cache_dir = cache_dir)
+
+    assert first == second == other
+    assert calls == ['lei', 'action_taken']
+
+
+def test_stage_source_covers_the_utils_it_uses():
+
+    ### Edits to the cleaning and categorizing helpers change the key of every stage that uses them
+    for function in [STAGES['clean']['function'], STAGES['categorize']['function'], measure_stage_prop_values]:
+        source = function_source(function)
+
+        assert inspect.getsource(clean_data) in source
+        assert inspect.getsource(categorize_data) in source
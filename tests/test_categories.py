@@ -0,0 +1,23 @@
+import pandas as pd
+
+from utils.categories import CATEGORY_SCHEMA, as_category, apply_category_schema, label_categories
+
+
+def test_as_category_keeps_the_schema():
+
+    values = as_category(['1', '5', '9', None], 'lmi_def')
+
+    ### Every code in the schema is a category even when no record has it, others become null
+    assert list(values.cat.categories) == list(CATEGORY_SCHEMA['lmi_def'])
+    assert values.astype(object).where(values.notnull(), None).tolist() == ['1', '5', None, None]
+    assert values.cat.codes.dtype.itemsize == 1
+
+
+def test_apply_category_schema_and_labels():
+
+    df = pd.DataFrame({'dti_cat': ['2', '6'], 'lei': ['A', 'B']})
+    apply_category_schema(df)
+
+    assert isinstance(df['dti_cat'].dtype, pd.CategoricalDtype)
+    assert df['lei'].tolist() == ['A', 'B']
+    assert label_categories(df['dti_cat'], 'dti_cat').tolist() == ['Manageable', 'Null']
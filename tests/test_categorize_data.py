@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.categorize_data import (categorize_bins, PROP_VALUE_BINS, CLTV_BINS, LOAN_TERM_BINS, LMI_BINS,
+                                   DIVERSE_BINS)
+
+
+VALUES = pd.Series([-np.inf, -5, 0, 0.005, 0.5, 1, 3, 9.99, 10, 25, 50, 75, 80, 120, 360, 500, 1e9, np.inf, np.nan])
+
+
+def as_values(categories):
+
+    '''
+    Codes as plain strings with None for nulls
+    '''
+
+    values = pd.Series(categories).astype(object)
+    return values.where(values.notnull(), None).tolist()
+
+
+@pytest.mark.parametrize('bin_spec', [PROP_VALUE_BINS, CLTV_BINS, LOAN_TERM_BINS, LMI_BINS, DIVERSE_BINS])
+def test_categorize_bins_matches_cut(bin_spec):
+
+    edges = bin_spec['edges']
+    closed = bin_spec.get('closed', 'left')
+
+    expected = pd.cut(VALUES, edges, right = closed == 'right', labels = bin_spec['codes'],
+                      ordered = False).astype(object)
+
+    ### An infinite outer edge leaves that end open, pd.cut leaves an infinite value out of the bin
+    if edges[-1] == np.inf:
+        expected[VALUES == np.inf] = bin_spec['codes'][-1]
+    if edges[0] == -np.inf:
+        expected[VALUES == -np.inf] = bin_spec['codes'][0]
+
+    expected = expected.where(expected.notnull(), bin_spec.get('fallback'))
+    for value, code in bin_spec.get('values', {}).items():
+        expected[VALUES == value] = code
+
+    assert as_values(categorize_bins(VALUES, bin_spec)) == as_values(expected)
+
+
+def test_categorize_bins_outer_values():
+
+    assert categorize_bins(pd.Series([np.inf, 1e12]), PROP_VALUE_BINS).tolist() == ['6', '6']
+    assert categorize_bins(pd.Series([-np.inf, np.inf, np.nan]), CLTV_BINS).tolist() == ['1', '2', '3']
+    assert categorize_bins(pd.Series([0.001, np.nan]), PROP_VALUE_BINS).tolist() == ['7', '7']
@@ -0,0 +1,120 @@
+import pandas as pd
+import pytest
+
+from utils import clean_data
+from utils.process_data import AUS_COLS
+
+
+def notebook_rows(df):
+
+    '''
+    Records the way the notebooks hand them to the row functions, plain values with nulls filled with '000'
+    '''
+
+    row_df = df.astype(object)
+    return row_df.where(row_df.notnull(), None).fillna('000')
+
+
+def as_values(categories):
+
+    '''
+    Codes as plain strings with None for nulls, so categoricals and object columns compare
+    '''
+
+    values = pd.Series(categories).astype(object)
+    return values.where(values.notnull(), None).tolist()
+
+
+def test_clean_location_series(lar_df):
+
+    ### The notebook fills the geography nulls with its own placeholders
+    row_df = notebook_rows(lar_df[['census_tract', 'county_code']].fillna({'census_tract': '00-00',
+                                                                          'county_code': 'ii-ii'}))
+
+    expected = row_df.apply(clean_data.clean_location, axis = 1)
+    result = clean_data.clean_location_series(lar_df['census_tract'], lar_df['county_code'])
+
+    assert as_values(result) == as_values(expected)
+
+
+@pytest.mark.parametrize('race_col, ethnicity_col, field', [
+    ('applicant_race_1', 'applicant_ethnicity_1', 'app_race_ethnicity'),
+    ('co_applicant_race_1', 'co_applicant_ethnicity_1', 'coapp_race_ethnicity')])
+def test_clean_race_ethnicity_series(lar_df, race_col, ethnicity_col, field):
+
+    row_df = notebook_rows(lar_df)
+    if field == 'coapp_race_ethnicity':
+        row_df = row_df.drop(columns = ['applicant_race_1', 'applicant_ethnicity_1'])
+
+    expected = row_df.apply(clean_data.clean_race_ethnicity, axis = 1)
+    result = clean_data.clean_race_ethnicity_series(lar_df[race_col], lar_df[ethnicity_col], field)
+
+    assert as_values(result) == as_values(expected)
+
+
+def test_find_same_race_series(clean_df):
+
+    expected = notebook_rows(clean_df).apply(clean_data.find_same_race, axis = 1)
+    result = clean_data.find_same_race_series(clean_df['app_race_ethnicity'], clean_df['coapp_race_ethnicity'])
+
+    assert as_values(result) == as_values(expected)
+
+
+def test_clean_credit_model_series(lar_df):
+
+    expected = notebook_rows(lar_df).apply(clean_data.clean_credit_model, axis = 1)
+    result = clean_data.clean_credit_model_series(lar_df['applicant_credit_score_type'])
+
+    assert as_values(result) == as_values(expected)
+
+
+def test_find_coapplicants_series(clean_df):
+
+    row_df = notebook_rows(clean_df)
+
+    expected = row_df.apply(clean_data.find_coapplicants, axis = 1)
+    result = clean_data.find_coapplicants_series(clean_df['coapp_race_ethnicity'], clean_df['co_applicant_sex'],
+                                                 clean_df['co_applicant_age'],
+                                                 clean_df['co_applicant_credit_score_type'])
+
+    assert as_values(result) == as_values(expected)
+
+
+def test_clean_outcomes_series(lar_df):
+
+    expected = notebook_rows(lar_df).apply(clean_data.clean_outcomes, axis = 1)
+    result = clean_data.clean_outcomes_series(lar_df['action_taken'])
+
+    assert as_values(result) == as_values(expected)
+
+
+def test_clean_aus_series(lar_df):
+
+    number_of_values, number_of_nulls = clean_data.count_aus_patterns(lar_df[AUS_COLS])
+
+    ### The notebook counts the patterns with value_counts(dropna = False) on every row
+    aus_df = lar_df[AUS_COLS].astype(object)
+    assert number_of_values.tolist() == [len(row.value_counts(dropna = False)) for _, row in aus_df.iterrows()]
+    assert number_of_nulls.tolist() == aus_df.isnull().sum(axis = 1).tolist()
+
+    row_df = notebook_rows(lar_df)
+    row_df['number_of_values'] = number_of_values
+    row_df['number_of_nulls'] = number_of_nulls
+
+    expected = row_df.apply(clean_data.clean_aus, axis = 1)
+    result = clean_data.clean_aus_series(lar_df['aus_1'], number_of_values, number_of_nulls)
+
+    assert as_values(result) == as_values(expected)
+
+
+def test_find_aus_patterns_adds_columns(lar_df):
+
+    aus_df = lar_df[AUS_COLS].copy()
+    number_of_values, number_of_nulls = clean_data.count_aus_patterns(aus_df)
+
+    result = clean_data.find_aus_patterns(aus_df)
+
+    ### The notebook reassigns the result, the counts land on the same frame
+    assert result is aus_df
+    assert result['number_of_values'].tolist() == number_of_values.tolist()
+    assert result['number_of_nulls'].tolist() == number_of_nulls.tolist()
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+from utils.instrument import RunManifest, children_peak_rss
+
+
+def run_child(megabytes):
+
+    subprocess.run([sys.executable, '-c', 'x = bytearray(' + str(megabytes * 1024 ** 2) + ')'], check = True)
+
+
+def test_children_peak_only_when_raised():
+
+    manifest = RunManifest('children')
+    large = int((children_peak_rss() or 0)/1024 ** 2) + 200
+
+    with manifest.stage('large_child'):
+        run_child(large)
+
+    ### A smaller child can't raise the peak the first one set, so it isn't reported as this stage's
+    with manifest.stage('small_child'):
+        run_child(10)
+
+    assert manifest.records[0]['children_peak_rss_mb'] >= large
+    assert manifest.records[1]['children_peak_rss_mb'] is None
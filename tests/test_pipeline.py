@@ -0,0 +1,83 @@
+import os
+
+import pandas as pd
+import pytest
+
+from utils.store_data import write_stage
+from utils.process_data import load_counties
+from utils.synthetic_data import make_synthetic_tract_race
+from utils.pipeline import (STAGES, lar_paths_for, parse_lar_paths, read_years, run_pipeline, stage_order,
+                            stage_paths)
+
+
+def test_stage_order_puts_dependencies_first():
+
+    order = stage_order(['metro'])
+
+    assert order == ['clean', 'reference_store', 'prop_values', 'categorize', 'regression_data', 'metro']
+
+    order = stage_order()
+    for name in order:
+        assert all(order.index(dependency) < order.index(name) for dependency in STAGES[name]['depends_on'])
+
+    with pytest.raises(ValueError, match = 'Unknown stage'):
+        stage_order(['metros'])
+
+
+def test_resume_skips_completed_stages(tmp_path, lar_path):
+
+    tract_race_path = str(tmp_path / 'tract_race.csv')
+    make_synthetic_tract_race(load_counties(), seed = 0).to_csv(tract_race_path, index = False)
+
+    run_dir = str(tmp_path / 'run')
+    options = {'lar_path': lar_path, 'tract_race_path': tract_race_path, 'chunksize': 2000}
+    paths = stage_paths(run_dir, 2019)
+
+    def modified():
+        return {name: os.stat(paths[name][output]).st_mtime_ns
+                for name, output in [('clean', 'clean_path'), ('prop_values', 'params_path'),
+                                     ('categorize', 'categorized_path')]}
+
+    state = run_pipeline(run_dir, stages = ['categorize'], workers = 1, **options)
+    first = modified()
+
+    assert all(state[name + '_2019']['status'] == 'ok' for name in ['clean', 'prop_values', 'categorize'])
+
+    ### Nothing changed, every stage is skipped
+    run_pipeline(run_dir, stages = ['categorize'], resume = True, workers = 1, **options)
+    assert modified() == first
+
+    ### A prop_values option changed, it and the stages after it rerun
+    run_pipeline(run_dir, stages = ['categorize'], resume = True, workers = 1, fixed_prop_zscore = True, **options)
+    rerun = modified()
+
+    assert rerun['clean'] == first['clean']
+    assert rerun['prop_values'] != first['prop_values'] and rerun['categorize'] != first['categorize']
+
+def test_lar_paths():
+
+    assert parse_lar_paths(['lar.csv']) == (None, 'lar.csv')
+    assert parse_lar_paths(['2018=a.csv', '2019=b.csv']) == ({2018: 'a.csv', 2019: 'b.csv'}, None)
+    assert lar_paths_for([2019], 'lar.csv') == {2019: 'lar.csv'}
+    assert lar_paths_for([2018, 2019], lar_paths = {'2018': 'a.csv', '2019': 'b.csv'}) == {2018: 'a.csv',
+                                                                                           2019: 'b.csv'}
+
+    with pytest.raises(ValueError, match = 'YEAR=PATH'):
+        parse_lar_paths(['a.csv', 'b.csv'])
+    with pytest.raises(ValueError, match = 'every year'):
+        lar_paths_for([2018, 2019], 'lar.csv')
+    with pytest.raises(ValueError, match = 'No LAR file for 2019'):
+        lar_paths_for([2018, 2019], lar_paths = {2018: 'a.csv'})
+
+
+def test_read_years_adds_the_year(tmp_path):
+
+    year_paths = {}
+    for year, rows in [(2019, 3), (2018, 2)]:
+        year_paths[year] = str(tmp_path / (str(year) + '.parquet'))
+        write_stage(pd.DataFrame({'denied': [0, 1, 0][:rows], 'black': [1, 0, 1][:rows]}), year_paths[year])
+
+    df = read_years(year_paths, columns = ['denied'])
+
+    assert list(df.columns) == ['denied', 'year']
+    assert df['year'].tolist() == ['2018', '2018', '2019', '2019', '2019']
@@ -0,0 +1,74 @@
+import pandas as pd
+import pytest
+
+from utils.store_data import read_stage
+from utils.process_data import factorize_keys, enrich, stream_hmda
+
+
+def test_stream_hmda_chunks_match_one_pass(tmp_path, lar_path, references):
+
+    ### Every record in one chunk is what the notebooks do on the whole frame
+    stream_hmda(str(tmp_path / 'whole.csv'), lar_path, references, chunksize = 10 ** 6)
+    stream_hmda(str(tmp_path / 'chunked.csv'), lar_path, references, chunksize = 700,
+                clean_output_path = str(tmp_path / 'clean.csv'))
+
+    whole = read_stage(str(tmp_path / 'whole.csv'))
+    chunked = read_stage(str(tmp_path / 'chunked.csv'))
+
+    assert len(read_stage(str(tmp_path / 'clean.csv'))) == len(pd.read_csv(lar_path, usecols = ['lei']))
+    pd.testing.assert_frame_equal(chunked.astype(object), whole.astype(object))
+
+
+@pytest.mark.parametrize('lookup_name, on', [('lender_def', ['lei']), ('counties', ['state_fips', 'county_fips']),
+                                             ('prop_values', ['state_fips', 'county_fips']),
+                                             ('tract_race', ['census_tract'])])
+def test_enrich_matches_merge(clean_df, references, lookup_name, on):
+
+    lookup = references[lookup_name]
+
+    expected = pd.merge(clean_df, lookup, how = 'left', on = on)
+    result = enrich(clean_df, lookup, on)
+
+    pd.testing.assert_frame_equal(result.reset_index(drop = True)[expected.columns], expected, check_dtype = False)
+
+
+def test_enrich_matches_null_keys():
+
+    df = pd.DataFrame({'state_fips': ['01', None, '02', None], 'county_fips': ['001', '003', None, None]})
+    lookup = pd.DataFrame({'state_fips': ['01', None, None], 'county_fips': ['001', '003', None],
+                           'metro_code': ['10100', '10200', '10300']})
+
+    expected = pd.merge(df, lookup, how = 'left', on = ['state_fips', 'county_fips'])
+    result = enrich(df, lookup, ['state_fips', 'county_fips'])
+
+    assert result['metro_code'].tolist() == expected['metro_code'].tolist()
+
+
+def test_factorize_keys():
+
+    df = pd.DataFrame({'a': ['1', None, '2', '1', None], 'b': ['x', 'y', None, 'x', 'y']})
+
+    codes, keys = factorize_keys(df, ['a', 'b'])
+
+    assert codes.tolist() == [0, 1, 2, 0, 1]
+    assert keys.take(codes).reset_index(drop = True).equals(df)
+
+
+def test_enrich_adds_columns_in_place(clean_df, references):
+
+    result = enrich(clean_df, references['lender_def'], ['lei'])
+
+    assert result is clean_df
+    assert 'lar_count' in clean_df.columns
+
+
+def test_enrich_rejects_lookups_merge_would_grow(clean_df, references):
+
+    lookup = references['lender_def']
+    repeated = lookup[lookup['lei'] == clean_df['lei'].iloc[0]]
+
+    with pytest.raises(ValueError, match = 'more than one row'):
+        enrich(clean_df, pd.concat([lookup, repeated]), ['lei'])
+
+    with pytest.raises(ValueError, match = 'already have'):
+        enrich(clean_df, lookup.assign(loan_type = '1'), ['lei'])
@@ -0,0 +1,15 @@
+import pandas as pd
+
+from utils.read_data import read_lar
+
+
+def test_read_lar_chunks(lar_path):
+
+    whole = read_lar(lar_path)
+    chunks = list(read_lar(lar_path, chunksize = 1000))
+
+    ### Mostly null coded fields come back as categoricals in every chunk
+    assert all(isinstance(chunk['aus_5'].dtype, pd.CategoricalDtype) for chunk in chunks)
+
+    combined = pd.concat([chunk.astype(object) for chunk in chunks], ignore_index = True)
+    pd.testing.assert_frame_equal(combined, whole.astype(object))
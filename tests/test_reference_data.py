@@ -0,0 +1,45 @@
+import os
+
+import pandas as pd
+import pytest
+
+from utils.synthetic_data import make_synthetic_tract_race
+from utils.process_data import load_counties, load_references, categorize_chunk, measure_prop_values
+from utils.reference_data import update_reference_store, open_reference_store
+
+
+@pytest.fixture(scope = 'module')
+def tract_race_path(tmp_path_factory):
+
+    path = tmp_path_factory.mktemp('census') / 'tract_race.csv'
+    make_synthetic_tract_race(load_counties(), seed = 0).to_csv(path, index = False)
+
+    return str(path)
+
+
+def test_store_lookups_match_merges(tmp_path, clean_df, tract_race_path):
+
+    update_reference_store(str(tmp_path), tract_race_path = tract_race_path)
+
+    csv_references = load_references(tract_race_path = tract_race_path)
+    store_references = load_references(store_dir = str(tmp_path))
+
+    expected = categorize_chunk(clean_df.copy(), csv_references)
+    result = categorize_chunk(clean_df.copy(), store_references)
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert measure_prop_values([clean_df], store_references) == measure_prop_values([clean_df], csv_references)
+
+
+def test_update_reference_store_rebuilds_when_stale(tmp_path, tract_race_path):
+
+    built = update_reference_store(str(tmp_path), tract_race_path = tract_race_path)
+    assert update_reference_store(str(tmp_path), tract_race_path = tract_race_path) == built
+
+    ### A newer source file makes the store stale
+    source_stat = os.stat(tract_race_path)
+    os.utime(tract_race_path, ns = (source_stat.st_atime_ns, source_stat.st_mtime_ns + 10 ** 9))
+
+    assert open_reference_store(str(tmp_path)).is_stale([tract_race_path])
+    update_reference_store(str(tmp_path), tract_race_path = tract_race_path)
+    assert not open_reference_store(str(tmp_path)).is_stale([tract_race_path])
@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+from utils.categories import as_category, category_dtype
+from utils.store_data import StageWriter, read_stage, iter_stage
+
+
+@pytest.mark.parametrize('file_name', ['stage.parquet', 'stage.arrow'])
+def test_stage_writer_unifies_chunks(tmp_path, file_name):
+
+    path = str(tmp_path / file_name)
+
+    ### A count that only has nulls in the second chunk, and categories the first chunk doesn't use
+    first = pd.DataFrame({'lar_count': [10, 20], 'loan_amount': [100000, 200000],
+                          'lmi_def': as_category(['1', '1'], 'lmi_def')})
+    second = pd.DataFrame({'lar_count': [None, 30.5], 'loan_amount': [150000.5, None],
+                           'lmi_def': as_category(['5', None], 'lmi_def')})
+
+    with StageWriter(path) as writer:
+        writer.write(first)
+        writer.write(second)
+
+    df = read_stage(path)
+
+    assert df['lar_count'].isnull().tolist() == [False, False, True, False]
+    assert df['loan_amount'].tolist()[:3] == [100000, 200000, 150000.5]
+    assert df['lmi_def'].dtype == category_dtype('lmi_def')
+    assert df['lmi_def'].astype(object).tolist()[:3] == ['1', '1', '5']
+    assert all(chunk['lmi_def'].dtype == category_dtype('lmi_def') for chunk in iter_stage(path, chunksize = 2))
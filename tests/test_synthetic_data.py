@@ -0,0 +1,25 @@
+import pandas as pd
+
+from utils.read_data import LAR_SCHEMA
+from utils.synthetic_data import make_synthetic_lar
+
+
+def test_make_synthetic_lar_is_reproducible():
+
+    first = make_synthetic_lar(500, seed = 1)
+
+    assert list(first.columns) == list(LAR_SCHEMA)
+    pd.testing.assert_frame_equal(make_synthetic_lar(500, seed = 1), first)
+    assert not make_synthetic_lar(500, seed = 2).equals(first)
+
+
+def test_synthetic_lar_joins_to_references(lar_df, references):
+
+    ### Every lender is in the lender file and most records are in counties the crosswalk knows
+    assert lar_df['lei'].isin(references['lender_def']['lei']).all()
+
+    counties = references['counties']
+    county_codes = lar_df['county_code'].dropna()
+    known = county_codes.isin(counties['state_fips'].astype(str) + counties['county_fips'].astype(str))
+
+    assert known.mean() > 0.9
@@ -0,0 +1,278 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.formula.api as smf
+
+from utils.use_regression import (SEPARATION_MESSAGE, calculate_vif, create_dummy_vars, count_group_outcomes,
+                                  design_matrix, evaluate_model, fit_design, run_batched_regressions,
+                                  run_grouped_regressions, run_regression, stream_regression)
+
+
+@pytest.fixture
+def group_df():
+
+    '''
+    Records for a few metros with dummies, a continuous variable and an outcome that depends on them
+    '''
+
+    rng = np.random.default_rng(0)
+    rows = 3000
+
+    df = pd.DataFrame({'metro_code': rng.choice(['10100', '10200', '10300', '10400'], rows),
+                       'black': rng.choice([0, 1], rows, p = [0.2, 0.8]),
+                       'female': rng.choice([0, 1], rows),
+                       'income_log': rng.normal(4.5, 0.6, rows)})
+
+    linear = -1 + 0.8 * (1 - df['black']) + 0.3 * df['female'] - 0.4 * (df['income_log'] - 4.5)
+    df['denied'] = (rng.random(rows) < 1/(1 + np.exp(-linear))).astype(float)
+    df['loan_outcome'] = np.where(df['denied'] == 1, '1', '3')
+    df.loc[rng.random(rows) < 0.1, 'loan_outcome'] = '4'
+
+    return df
+
+
+def test_evaluate_model_drops_nulls(group_df):
+
+    group_df = group_df.copy()
+    group_df.loc[group_df.index[:100], 'income_log'] = np.nan
+
+    scores_df = evaluate_model(group_df, ['black', 'female', 'income_log'], folds = 3, processes = 1)
+
+    ### Every record with a value is scored once across the folds
+    assert scores_df['records'].sum() == group_df['income_log'].notnull().sum()
+    assert scores_df[['calibration_error', 'max_calibration_gap']].notnull().all().all()
+    assert (scores_df['max_calibration_gap'] >= scores_df['calibration_error']).all()
+
+
+def test_create_dummy_vars_uses_earlier_specs():
+
+    df = pd.DataFrame({'app_race_ethnicity': ['3', '5', '6', '3']})
+
+    create_dummy_vars(df, [{'app_race_ethnicity': {'black': ['3'], 'latino': ['6']}},
+                           {'black': {'not_black': [1]}}])
+
+    assert df['black'].tolist() == [0, 1, 1, 0]
+    assert df['latino'].tolist() == [1, 1, 0, 1]
+    assert df['not_black'].tolist() == [1, 0, 0, 1]
+
+
+def test_count_group_outcomes_matches_pivot(group_df):
+
+    count_df = count_group_outcomes(group_df, 'metro_code', ['black', 'female'])
+
+    ### The notebooks' pivot table of the loans and denials for every metro and value
+    counted_df = group_df[group_df['loan_outcome'].isin(['1', '3'])]
+    for var in ['black', 'female']:
+        pivot_df = pd.pivot_table(counted_df, index = ['metro_code', var], columns = ['loan_outcome'],
+                                  values = ['denied'], aggfunc = 'count', fill_value = 0).reset_index()
+        pivot_df.columns = ['metro_code', 'variable_flag', 'loan', 'denied']
+
+        var_df = count_df[count_df['variable_name'] == var]
+        merged = pd.merge(pivot_df, var_df, how = 'left', on = ['metro_code', 'variable_flag'])
+
+        assert merged['loan_x'].tolist() == merged['loan_y'].tolist()
+        assert merged['denied_x'].tolist() == merged['denied_y'].tolist()
+
+    assert (count_df['total_count'] == count_df['loan'] + count_df['denied']).all()
+
+
+def test_count_group_outcomes_integer_outcomes(group_df):
+
+    expected = count_group_outcomes(group_df, 'metro_code', ['black'])
+
+    int_df = group_df.assign(loan_outcome = group_df['loan_outcome'].astype(int))
+    pd.testing.assert_frame_equal(count_group_outcomes(int_df, 'metro_code', ['black']), expected)
+
+    with pytest.raises(ValueError):
+        count_group_outcomes(group_df.assign(loan_outcome = 1.5), 'metro_code', ['black'])
+
+
+def test_count_group_outcomes_zero_rows(group_df):
+
+    count_df = count_group_outcomes(group_df, 'metro_code', ['black'], zero_vars = ['income_log'])
+    zero_df = count_df[count_df['variable_name'] == 'income_log']
+
+    assert sorted(zero_df['metro_code']) == sorted(group_df['metro_code'].unique())
+    assert (zero_df['variable_flag'] == 0).all()
+    assert (zero_df[['loan', 'denied', 'total_count']] == 0).all().all()
+
+
+def test_batched_matches_statsmodels(group_df):
+
+    independent_vars = ['black', 'female', 'income_log']
+
+    results_df, fit_info_df = run_batched_regressions(group_df, 'metro_code', independent_vars)
+
+    assert fit_info_df['error'].map(lambda error: error is None).all()
+
+    for metro, metro_df in group_df.groupby('metro_code'):
+        results = smf.logit('denied ~ black + female + income_log', data = metro_df).fit(disp = 0)
+        metro_results = results_df[results_df['metro_code'] == metro].set_index('variable_name')
+
+        np.testing.assert_allclose(metro_results['coefficient'], results.params[metro_results.index], rtol = 1e-6)
+        np.testing.assert_allclose(metro_results['standard_error'], results.bse[metro_results.index], rtol = 1e-6)
+        np.testing.assert_allclose(metro_results['psuedo_rsquare'], results.prsquared, rtol = 1e-6)
+
+
+def test_batched_perfect_separation(group_df):
+
+    group_df = group_df.copy()
+    separated = group_df['metro_code'] == '10400'
+    group_df.loc[separated, 'denied'] = (group_df.loc[separated, 'female'] == 0).astype(float)
+
+    results_df, fit_info_df = run_batched_regressions(group_df, 'metro_code', ['female'])
+    fit_info_df = fit_info_df.set_index('metro_code')
+
+    assert fit_info_df.loc['10400', 'error'] == "PerfectSeparationError('" + SEPARATION_MESSAGE + "')"
+    assert results_df[results_df['metro_code'] == '10400']['odds_ratio'].isnull().all()
+    assert fit_info_df.drop(index = '10400')['error'].map(lambda error: error is None).all()
+
+
+@pytest.mark.parametrize('runner', [run_batched_regressions, run_grouped_regressions])
+def test_no_groups(group_df, runner):
+
+    results_df, fit_info_df = runner(group_df, 'metro_code', ['black'], groups = [])
+
+    assert len(results_df) == 0 and 'odds_ratio' in results_df.columns
+    assert len(fit_info_df) == 0 and 'error' in fit_info_df.columns
+
+
+def test_calculate_vif_methods(group_df):
+
+    ### A variable close to income_log so one VIF is over the threshold
+    independent_df = group_df[['black', 'female', 'income_log']].copy()
+    noise = np.random.default_rng(1).normal(0, 0.2, len(group_df))
+    independent_df['income_copy'] = independent_df['income_log'] * 0.9 + noise
+
+    matrix_vif = calculate_vif(independent_df)
+    ols_vif = calculate_vif(independent_df, method = 'ols')
+
+    assert matrix_vif['independent_var'].tolist() == ols_vif['independent_var'].tolist()
+    np.testing.assert_allclose(matrix_vif['vif'], ols_vif['vif'], atol = 0.011)
+    assert matrix_vif['threshold'].tolist() == ols_vif['threshold'].tolist()
+
+
+def test_calculate_vif_with_nulls(group_df):
+
+    independent_df = group_df[['black', 'female', 'income_log']].copy()
+    independent_df['lar_count'] = pd.array(np.random.default_rng(2).integers(1, 50, len(group_df)), dtype = 'Int64')
+    independent_df.loc[independent_df.index[:5], 'lar_count'] = pd.NA
+    independent_df.loc[independent_df.index[5:10], 'income_log'] = np.nan
+
+    matrix_vif = calculate_vif(independent_df)
+
+    ### Same as the regressions, which drop any record with a null
+    ols_vif = calculate_vif(independent_df.astype(float), method = 'ols')
+    complete_vif = calculate_vif(independent_df.dropna())
+
+    assert matrix_vif['vif'].notnull().all()
+    np.testing.assert_allclose(matrix_vif['vif'], ols_vif['vif'], atol = 0.011)
+    np.testing.assert_allclose(matrix_vif['vif'], complete_vif['vif'])
+
+
+def test_compressed_binning_error(group_df):
+
+    formula = 'denied ~ black + female + income_log'
+
+    ### With every record in the sample the binned fit is the compressed fit itself
+    results = run_regression(group_df, formula, bins = {'income_log': 10}, error_sample = len(group_df)).fit()
+    exact = smf.logit(formula, data = group_df).fit(disp = 0)
+
+    error_df = results.binning_error.set_index('variable_name')
+
+    np.testing.assert_allclose(error_df.loc[exact.params.index, 'exact'], exact.params, rtol = 1e-6)
+    np.testing.assert_allclose(error_df.loc[exact.params.index, 'binned'], results.params[exact.params.index],
+                               rtol = 1e-6)
+    np.testing.assert_allclose(error_df.loc['log_likelihood', ['exact', 'binned']].astype(float),
+                               [exact.llf, results.llf], rtol = 1e-6)
+    assert (error_df['sample_records'] == len(group_df)).all()
+
+    assert run_regression(group_df, 'denied ~ black + female', compress = True).fit().binning_error is None
+
+
+def test_stream_regression_takes_any_iterable(group_df):
+
+    independent_vars = ['black', 'female', 'income_log']
+    chunks = [group_df.iloc[start:start + 700] for start in range(0, len(group_df), 700)]
+
+    list_df, list_info = stream_regression(chunks, independent_vars)
+    generator_df, generator_info = stream_regression((chunk for chunk in chunks), independent_vars)
+
+    exact = smf.logit('denied ~ black + female + income_log', data = group_df).fit(disp = 0)
+
+    np.testing.assert_allclose(list_df['coefficient'], exact.params[list_df['variable_name']], rtol = 1e-6)
+    np.testing.assert_allclose(list_df['standard_error'], exact.bse[list_df['variable_name']], rtol = 1e-6)
+    pd.testing.assert_frame_equal(generator_df, list_df)
+    assert generator_info['records'] == list_info['records'] == len(group_df)
+    assert generator_info['llf'] == pytest.approx(exact.llf) and generator_info['error'] is None
+
+
+def test_stream_regression_errors(group_df):
+
+    separated_df = group_df.assign(denied = (group_df['female'] == 0).astype(float))
+    results_df, fit_info = stream_regression([separated_df], ['female'])
+
+    assert fit_info['error'] == "PerfectSeparationError('" + SEPARATION_MESSAGE + "')"
+    assert results_df['odds_ratio'].isnull().all()
+
+    ### A copy of a variable makes the Hessian singular
+    results_df, fit_info = stream_regression([group_df.assign(female_copy = group_df['female'])],
+                                             ['female', 'female_copy'])
+
+    assert fit_info['error'].startswith('LinAlgError')
+    assert results_df['odds_ratio'].isnull().all()
+
+
+def test_grouped_matches_batched(group_df):
+
+    independent_vars = ['black', 'female', 'income_log']
+
+    batched_df, batched_info = run_batched_regressions(group_df, 'metro_code', independent_vars)
+    grouped_df, grouped_info = run_grouped_regressions(group_df, 'metro_code', independent_vars, processes = 2)
+
+    ### Same groups in the same order, whichever worker fit them
+    assert grouped_info['metro_code'].tolist() == batched_info['metro_code'].tolist()
+    np.testing.assert_allclose(grouped_df['odds_ratio'], batched_df['odds_ratio'], rtol = 1e-6)
+    np.testing.assert_allclose(grouped_df['standard_error'], batched_df['standard_error'], rtol = 1e-6)
+
+
+def test_design_matrix_fit_matches_formula(group_df):
+
+    group_df = group_df.copy()
+    group_df.loc[group_df.index[:50], 'income_log'] = np.nan
+
+    design = design_matrix(group_df, ['black', 'female', 'income_log'])
+    exact = smf.logit('denied ~ black + female + income_log', data = group_df).fit(disp = 0)
+
+    ### Records with nulls are dropped like the formula does
+    assert design['exog'].shape == (len(group_df) - 50, 4) and design['keep'].sum() == len(group_df) - 50
+
+    results = fit_design(design)
+    np.testing.assert_allclose(results.params[exact.params.index], exact.params, rtol = 1e-6)
+
+    ### A subset of the variables on a slice of the rows
+    subset = fit_design(design, rows = slice(0, 1000), independent_vars = ['female'])
+    assert list(subset.params.index) == ['Intercept', 'female'] and subset.nobs == 1000
+
+    assert design_matrix(group_df, ['black'], dtype = np.float32)['exog'].dtype == np.float32
+
+
+@pytest.mark.parametrize('runner', [run_batched_regressions, run_grouped_regressions])
+def test_fit_cache_refits_changed_groups(group_df, runner, tmp_path):
+
+    independent_vars = ['black', 'female', 'income_log']
+    cache_dir = str(tmp_path / 'fits')
+
+    first_df, first_info = runner(group_df, 'metro_code', independent_vars, cache_dir = cache_dir)
+    cached_df, cached_info = runner(group_df, 'metro_code', independent_vars, cache_dir = cache_dir)
+
+    assert not first_info['cache_hit'].any() and cached_info['cache_hit'].all()
+    pd.testing.assert_frame_equal(cached_df, first_df)
+
+    ### One metro's records change, only that metro is refit
+    changed_df = group_df.copy()
+    changed_df.loc[changed_df['metro_code'] == '10100', 'income_log'] += 0.1
+    changed_df, changed_info = runner(changed_df, 'metro_code', independent_vars, cache_dir = cache_dir)
+
+    assert changed_info.set_index('metro_code')['cache_hit'].to_dict() == {'10100': False, '10200': True,
+                                                                           '10300': True, '10400': True}
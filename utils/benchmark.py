@@ -0,0 +1,349 @@
+import os
+import sys
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+import pandas as pd
+import numpy as np
+
+from utils.read_data import read_lar
+from utils.process_data import (AUS_COLS, load_references, clean_chunk, categorize_chunk, filter_home_purchase,
+                                stream_hmda)
+from utils.synthetic_data import write_synthetic_data
+from utils import clean_data, categorize_data, use_regression
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+BENCHMARK_DIR = os.path.join(DATA_DIR, 'benchmarks')
+BENCHMARK_PATH = os.path.join(BENCHMARK_DIR, 'benchmark_results.csv')
+
+### The row functions are run through apply on a sample, at full size they would take hours
+ROW_SAMPLE = 20000
+
+### The dummy variables and independent variables from 1_regression_analysis, without the lender and metro ones
+REGRESSION_COLS = [{'loan_outcome': {'denied': ['3']}},
+                   {'app_race_ethnicity': {'black': ['3'], 'latino': ['6'], 'asian': ['2'], 'native': ['1'],
+                                           'pac_islander': ['4'], 'race_na': ['7'], 'asian_cb': ['2', '4']}},
+                   {'co_applicant': {'no_coapplicant': ['2'], 'na_coapplicant': ['3']}},
+                   {'applicant_sex_cat': {'female': ['2'], 'sex_na': ['3', '6']}},
+                   {'applicant_age_cat': {'younger_than_34': ['1', '2'], 'older_than_55': ['5', '6', '7'],
+                                          'age_na': ['8']}},
+                   {'mortgage_term': {'not30yr_mortgage': ['2', '3']}},
+                   {'app_credit_model': {'equifax': ['1'], 'experian': ['2'], 'other_model': ['4', '6'],
+                                         'more_than_one': ['5'], 'model_na': ['7']}},
+                   {'dti_cat': {'dti_manageable': ['2'], 'dti_unmanageable': ['3'], 'dti_struggling': ['4']}},
+                   {'lmi_def': {'low_lmi': ['1'], 'moderate_lmi': ['2'], 'middle_lmi': ['3']}},
+                   {'diverse_def': {'white_cat2': ['2'], 'white_cat3': ['3'], 'white_cat4': ['4']}},
+                   {'main_aus': {'non_desktop': ['2', '3', '4', '5', '6'], 'aus_na': ['7']}}]
+
+REGRESSION_VARS = ['black', 'latino', 'asian_cb', 'native', 'race_na', 'female', 'sex_na', 'no_coapplicant',
+                   'younger_than_34', 'older_than_55', 'income_log', 'loan_log', 'property_value_ratio',
+                   'not30yr_mortgage', 'equifax', 'experian', 'other_model', 'more_than_one', 'model_na',
+                   'dti_manageable', 'dti_unmanageable', 'dti_struggling', 'low_lmi', 'moderate_lmi', 'middle_lmi',
+                   'non_desktop', 'aus_na', 'white_cat2', 'white_cat3', 'white_cat4']
+
+CONTINUOUS_VARS = ['income_log', 'loan_log', 'property_value_ratio']
+
+
+def measure(function, *args, **kwargs):
+
+    '''
+    Run a function once, returning its result along with the wall time and the peak memory it allocated
+    '''
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    try:
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, {'seconds': seconds, 'peak_mb': peak_bytes/1024 ** 2}
+
+
+def count_rows(value):
+
+    '''
+    Records a benchmarked function ran on, from its first argument
+    '''
+
+    if isinstance(value, dict) and 'endog' in value:
+        return len(value['endog'])
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray, list)):
+        return len(value)
+
+    return None
+
+
+def current_commit():
+
+    '''
+    The commit the benchmarks ran on, so results can be compared between commits
+    '''
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__)), check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def clean_benchmarks(lar_df):
+
+    '''
+    Every clean_data function on the raw records
+    '''
+
+    aus_df = lar_df[AUS_COLS].copy()
+    number_of_values, number_of_nulls = clean_data.count_aus_patterns(aus_df)
+    app_race = clean_data.clean_race_ethnicity_series(lar_df['applicant_race_1'], lar_df['applicant_ethnicity_1'])
+    coapp_race = clean_data.clean_race_ethnicity_series(lar_df['co_applicant_race_1'],
+                                                        lar_df['co_applicant_ethnicity_1'], 'coapp_race_ethnicity')
+
+    return [('clean_location_series', clean_data.clean_location_series,
+             (lar_df['census_tract'], lar_df['county_code'])),
+            ('clean_race_ethnicity_series', clean_data.clean_race_ethnicity_series,
+             (lar_df['applicant_race_1'], lar_df['applicant_ethnicity_1'])),
+            ('find_same_race_series', clean_data.find_same_race_series, (app_race, coapp_race)),
+            ('clean_credit_model_series', clean_data.clean_credit_model_series,
+             (lar_df['applicant_credit_score_type'],)),
+            ('find_coapplicants_series', clean_data.find_coapplicants_series,
+             (coapp_race, lar_df['co_applicant_sex'], lar_df['co_applicant_age'],
+              lar_df['co_applicant_credit_score_type'])),
+            ('clean_outcomes_series', clean_data.clean_outcomes_series, (lar_df['action_taken'],)),
+            ('count_aus_patterns', clean_data.count_aus_patterns, (aus_df,)),
+            ('find_aus_patterns', clean_data.find_aus_patterns, (aus_df, AUS_COLS)),
+            ('clean_aus_series', clean_data.clean_aus_series, (lar_df['aus_1'], number_of_values, number_of_nulls))]
+
+
+def categorize_benchmarks(categorized_df):
+
+    '''
+    Every categorize_data column function on the categorized records
+    '''
+
+    property_value_ratio = categorized_df['property_value_ratio']
+
+    return [('setup_dti_cat_series', categorize_data.setup_dti_cat_series,
+             (categorized_df['debt_to_income_ratio'],)),
+            ('categorize_cltv_series', categorize_data.categorize_cltv_series,
+             (pd.to_numeric(categorized_df['combined_loan_to_value_ratio'], errors = 'coerce'),)),
+            ('calculate_property_value_ratio', categorize_data.calculate_property_value_ratio,
+             (categorized_df['prop_value'], categorized_df['median_prop_value'])),
+            ('calculate_prop_zscore_series', categorize_data.calculate_prop_zscore_series, (property_value_ratio,)),
+            ('categorize_property_value_ratio_series', categorize_data.categorize_property_value_ratio_series,
+             (property_value_ratio,)),
+            ('categorize_age_series', categorize_data.categorize_age_series, (categorized_df['applicant_age'],)),
+            ('categorize_sex_series', categorize_data.categorize_sex_series, (categorized_df['applicant_sex'],)),
+            ('categorize_underwriter_series', categorize_data.categorize_underwriter_series,
+             (categorized_df['aus_cat'], categorized_df['aus_1'])),
+            ('categorize_loan_term_series', categorize_data.categorize_loan_term_series,
+             (pd.to_numeric(categorized_df['loan_term'], errors = 'coerce'),)),
+            ('categorize_lmi_series', categorize_data.categorize_lmi_series,
+             (pd.to_numeric(categorized_df['tract_to_msa_income_percentage'], errors = 'coerce'),)),
+            ('categorize_diverse_series', categorize_data.categorize_diverse_series,
+             (categorized_df['white_pct'],))]
+
+
+def row_benchmarks(categorized_df):
+
+    '''
+    The row functions the notebooks apply, on a sample of records with the column names the notebooks give them
+    '''
+
+    sample_df = categorized_df.head(ROW_SAMPLE).astype(object).copy()
+    sample_df = sample_df.where(sample_df.notnull(), None).fillna('000')
+
+    number_of_values, number_of_nulls = clean_data.count_aus_patterns(categorized_df.head(ROW_SAMPLE)[AUS_COLS])
+    sample_df['number_of_values'] = number_of_values
+    sample_df['number_of_nulls'] = number_of_nulls
+
+    sample_df['cltv_ratio'] = pd.to_numeric(sample_df['combined_loan_to_value_ratio'], errors = 'coerce')
+    sample_df['em_loan_term'] = pd.to_numeric(sample_df['loan_term'], errors = 'coerce')
+    sample_df['tract_msa_ratio'] = pd.to_numeric(sample_df['tract_to_msa_income_percentage'], errors = 'coerce')
+    sample_df['property_value_ratio'] = pd.to_numeric(sample_df['property_value_ratio'], errors = 'coerce')
+
+    coapp_df = sample_df.drop(columns = ['applicant_race_1', 'applicant_ethnicity_1'])
+
+    row_functions = [('clean_location', clean_data.clean_location, sample_df),
+                     ('clean_race_ethnicity', clean_data.clean_race_ethnicity, sample_df),
+                     ('find_same_race', clean_data.find_same_race, sample_df),
+                     ('clean_credit_model', clean_data.clean_credit_model, sample_df),
+                     ('find_coapplicants', clean_data.find_coapplicants, coapp_df),
+                     ('clean_outcomes', clean_data.clean_outcomes, sample_df),
+                     ('clean_aus', clean_data.clean_aus, sample_df),
+                     ('setup_dti_cat', categorize_data.setup_dti_cat, sample_df),
+                     ('categorize_cltv', categorize_data.categorize_cltv, sample_df),
+                     ('calculate_prop_zscore', categorize_data.calculate_prop_zscore, sample_df),
+                     ('categorize_property_value_ratio', categorize_data.categorize_property_value_ratio, sample_df),
+                     ('categorize_age', categorize_data.categorize_age, sample_df),
+                     ('categorize_sex', categorize_data.categorize_sex, sample_df),
+                     ('categorize_underwriter', categorize_data.categorize_underwriter, sample_df),
+                     ('categorize_loan_term', categorize_data.categorize_loan_term, sample_df),
+                     ('categorize_lmi', categorize_data.categorize_lmi, sample_df)]
+
+    return [(name, lambda row_df, row_function = row_function: row_df.apply(row_function, axis = 1), (row_df,))
+            for name, row_function, row_df in row_functions]
+
+
+def make_regression_frame(categorized_df):
+
+    '''
+    The regression dataset 1_regression_analysis builds, from categorized records
+    '''
+
+    regression_df = categorized_df[categorized_df['loan_outcome'].isin(['1', '3']) &
+                                   (categorized_df['income'] > 0)].copy()
+
+    regression_df['property_value_ratio'] = pd.to_numeric(regression_df['property_value_ratio'])
+    regression_df = use_regression.create_dummy_vars(regression_df, REGRESSION_COLS)
+
+    return regression_df.dropna(subset = REGRESSION_VARS).reset_index(drop = True)
+
+
+def regression_benchmarks(categorized_df):
+
+    '''
+    The use_regression functions on the regression dataset
+    '''
+
+    regression_df = make_regression_frame(categorized_df)
+    dummy_source = categorized_df[categorized_df['loan_outcome'].isin(['1', '3'])].copy()
+    formula = use_regression.create_formula(REGRESSION_VARS)
+    design = use_regression.design_matrix(regression_df, REGRESSION_VARS)
+    bins = {var: 20 for var in CONTINUOUS_VARS}
+
+    return [('create_dummy_vars', use_regression.create_dummy_vars, (dummy_source, REGRESSION_COLS)),
+            ('create_formula', use_regression.create_formula, (REGRESSION_VARS,)),
+            ('run_regression', lambda df: use_regression.run_regression(df, formula).fit(disp = 0),
+             (regression_df,)),
+            ('design_matrix', use_regression.design_matrix, (regression_df, REGRESSION_VARS)),
+            ('fit_design', use_regression.fit_design, (design,)),
+            ('run_regression_compressed', lambda df: use_regression.run_regression(df, formula, bins = bins).fit(),
+             (regression_df,)),
+            ('calculate_vif', use_regression.calculate_vif, (regression_df[REGRESSION_VARS],)),
+            ('calculate_group_vif', use_regression.calculate_group_vif,
+             (regression_df, 'metro_code', REGRESSION_VARS)),
+            ('count_group_outcomes', use_regression.count_group_outcomes,
+             (regression_df, 'metro_code', [var for var in REGRESSION_VARS if var not in CONTINUOUS_VARS])),
+            ('run_grouped_regressions', use_regression.run_grouped_regressions,
+             (regression_df, 'metro_code', REGRESSION_VARS)),
+            ('run_batched_regressions', use_regression.run_batched_regressions,
+             (regression_df, 'metro_code', REGRESSION_VARS)),
+            ('evaluate_model', use_regression.evaluate_model, (regression_df, REGRESSION_VARS))]
+
+
+def run_benchmarks(sizes = (100000,), output_path = BENCHMARK_PATH, seed = 0, groups = None, data_dir = None):
+
+    '''
+    Time and memory profile every utils function and the end-to-end stages on synthetic LARs of each size
+    Results are appended to output_path with the commit, so slowdowns show up between commits
+    groups limits the run to some of 'stages', 'clean', 'categorize', 'rows' and 'regression'
+    '''
+
+    if groups is None:
+        groups = ['stages', 'clean', 'categorize', 'rows', 'regression']
+
+    run_info = {'commit': current_commit(), 'run_at': pd.Timestamp.now().isoformat(timespec = 'seconds'),
+                'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__}
+
+    timing_list = []
+
+    def record(group, name, rows, function, *args):
+
+        print(group + ': ' + name)
+        result, timing = measure(function, *args)
+
+        timing.update({'group': group, 'function': name, 'rows': rows})
+        timing_list.append(timing)
+
+        return result
+
+    with tempfile.TemporaryDirectory(dir = data_dir) as work_dir:
+        for size in sizes:
+            paths = write_synthetic_data(work_dir, size, seed)
+            references = load_references(tract_race_path = paths['tract_race_path'])
+
+            ### End-to-end stages
+            lar_df = record('stages', 'read_lar', size, read_lar, paths['lar_path'])
+            clean_df = record('stages', 'clean_chunk', size, clean_chunk, lar_df.copy())
+            categorized_df = record('stages', 'categorize_chunk', size, categorize_chunk, clean_df, references)
+            record('stages', 'filter_home_purchase', size, filter_home_purchase, categorized_df)
+
+            if 'stages' in groups:
+                record('stages', 'stream_hmda', size, stream_hmda, os.path.join(work_dir, 'stage.parquet'),
+                       paths['lar_path'], references)
+
+            benchmark_groups = [('clean', lambda: clean_benchmarks(lar_df)),
+                                ('categorize', lambda: categorize_benchmarks(categorized_df)),
+                                ('rows', lambda: row_benchmarks(categorized_df)),
+                                ('regression', lambda: regression_benchmarks(categorized_df))]
+
+            for group, make_benchmarks in benchmark_groups:
+                if group not in groups:
+                    continue
+
+                for name, function, args in make_benchmarks():
+                    record(group, name, count_rows(args[0]), function, *args)
+
+    timing_df = pd.DataFrame(timing_list)
+    for column, value in reversed(list(run_info.items())):
+        timing_df.insert(0, column, value)
+
+    timing_df = timing_df[list(run_info) + ['group', 'function', 'rows', 'seconds', 'peak_mb']]
+
+    if output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok = True)
+        timing_df.to_csv(output_path, mode = 'a', header = not os.path.isfile(output_path), index = False)
+
+    return timing_df
+
+
+def compare_benchmarks(path = BENCHMARK_PATH, baseline = None, current = None):
+
+    '''
+    Compare two runs in the results file, by default the latest run against the one before it
+    Ratios above 1 mean the function got slower or used more memory
+    '''
+
+    results_df = pd.read_csv(path, dtype = {'commit': str})
+    runs = list(dict.fromkeys(results_df['run_at']))
+
+    current = runs[-1] if current is None else current
+    baseline = runs[-2] if baseline is None else baseline
+
+    keys = ['group', 'function', 'rows']
+    baseline_df = results_df[results_df['run_at'] == baseline][keys + ['seconds', 'peak_mb']]
+    current_df = results_df[results_df['run_at'] == current][keys + ['seconds', 'peak_mb']]
+
+    compare_df = pd.merge(baseline_df, current_df, how = 'outer', on = keys, suffixes = ('_baseline', '_current'))
+    compare_df['seconds_ratio'] = compare_df['seconds_current'].div(compare_df['seconds_baseline'])
+    compare_df['peak_mb_ratio'] = compare_df['peak_mb_current'].div(compare_df['peak_mb_baseline'])
+
+    return compare_df.sort_values(by = 'seconds_ratio', ascending = False).reset_index(drop = True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the utils functions on synthetic HMDA data')
+    parser.add_argument('--rows', type = int, nargs = '+', default = [100000],
+                        help = 'synthetic LAR sizes, e.g. 100000 1000000 10000000')
+    parser.add_argument('--groups', nargs = '+', default = None,
+                        help = 'stages, clean, categorize, rows and/or regression')
+    parser.add_argument('--output', default = BENCHMARK_PATH)
+    parser.add_argument('--seed', type = int, default = 0)
+    arguments = parser.parse_args()
+
+    timing_df = run_benchmarks(arguments.rows, arguments.output, arguments.seed, arguments.groups)
+
+    pd.set_option('display.width', 200)
+    print(timing_df[['group', 'function', 'rows', 'seconds', 'peak_mb']].to_string(index = False))
+    sys.exit(0)
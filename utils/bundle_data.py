@@ -0,0 +1,244 @@
+import os
+import json
+import multiprocessing
+
+import pandas as pd
+import numpy as np
+
+from utils.cache_data import evict_cache
+from utils.use_regression import (MAX_FIT_CACHE_BYTES, sort_by_group, fit_group, fit_batched_design, empty_group_fits,
+                                  fit_info_frame)
+
+
+BUNDLE_FILE = 'bundle.json'
+
+### Bundles opened by this process, keyed by directory, and the grouped runner's worker state
+_bundles = {}
+_worker_data = {}
+
+
+def write_regression_bundle(df, bundle_dir, independent_vars, group_cols, dependent_var = 'denied'):
+
+    '''
+    Write the regression data as .npy arrays any process can memory map: for every group column
+    an intercept and variables block and an outcome vector sorted by group, with the offsets where each group starts
+    Nulls stay in the block, each fit drops the records it can't use
+    Records with no group are left out of that group column's arrays
+    '''
+
+    independent_vars = list(independent_vars)
+    names = ['Intercept'] + independent_vars
+    os.makedirs(bundle_dir, exist_ok = True)
+
+    manifest = {'built_at': pd.Timestamp.now().isoformat(timespec = 'seconds'), 'dependent_var': dependent_var,
+                'names': names, 'groupings': {}}
+
+    for group_col in group_cols:
+        data, offsets = sort_by_group(df, group_col, [group_col, dependent_var] + independent_vars)
+        groups = list(offsets)
+
+        exog_path = os.path.join(bundle_dir, group_col + '_exog.npy')
+        temp_path = exog_path + '.tmp.npy'
+
+        ### Filled one column at a time straight into the file, the block is never in memory twice
+        exog = np.lib.format.open_memmap(temp_path, mode = 'w+', dtype = np.float64, shape = (len(data), len(names)))
+        exog[:, 0] = 1
+        for position, var in enumerate(independent_vars):
+            exog[:, position + 1] = data[var].to_numpy(dtype = float)
+        exog.flush()
+        del exog
+        os.replace(temp_path, exog_path)
+
+        arrays = {'endog': data[dependent_var].to_numpy(dtype = float),
+                  'offsets': np.array([offsets[group_key][0] for group_key in groups] + [len(data)],
+                                      dtype = np.int64)}
+        for array_name, array in arrays.items():
+            array_path = os.path.join(bundle_dir, group_col + '_' + array_name + '.npy')
+            np.save(array_path + '.tmp.npy', array)
+            os.replace(array_path + '.tmp.npy', array_path)
+
+        manifest['groupings'][group_col] = {'rows': len(data), 'groups': [str(group_key) for group_key in groups]}
+
+    ### The manifest goes last, a bundle without one is incomplete
+    manifest_path = os.path.join(bundle_dir, BUNDLE_FILE)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return manifest
+
+
+class RegressionBundle:
+
+    '''
+    Read only view of a regression bundle, the arrays are memory mapped the first time they are used
+    so every process fitting from it shares one copy of the data in the page cache
+    '''
+
+    def __init__(self, bundle_dir):
+
+        self.bundle_dir = bundle_dir
+
+        manifest_path = os.path.join(bundle_dir, BUNDLE_FILE)
+        if not os.path.isfile(manifest_path):
+            raise FileNotFoundError('No regression bundle in ' + bundle_dir)
+
+        with open(manifest_path) as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+        self.names = self.manifest['names']
+        self.arrays = {}
+        self.group_positions = {}
+
+    def array(self, group_col, array_name):
+
+        if (group_col, array_name) not in self.arrays:
+            if group_col not in self.manifest['groupings']:
+                raise KeyError('The bundle is not sorted by ' + repr(group_col))
+
+            path = os.path.join(self.bundle_dir, group_col + '_' + array_name + '.npy')
+            self.arrays[(group_col, array_name)] = np.load(path, mmap_mode = 'r')
+
+        return self.arrays[(group_col, array_name)]
+
+    def groups(self, group_col):
+
+        return self.manifest['groupings'][group_col]['groups']
+
+    def offsets(self, group_col):
+
+        '''
+        Each group's (start, stop) rows, the same as sort_by_group
+        '''
+
+        starts = self.array(group_col, 'offsets')
+
+        return {group_key: (int(starts[position]), int(starts[position + 1]))
+                for position, group_key in enumerate(self.groups(group_col))}
+
+    def group_rows(self, group_col, group_key):
+
+        if group_col not in self.group_positions:
+            self.group_positions[group_col] = {group_key: position for position, group_key
+                                               in enumerate(self.groups(group_col))}
+
+        position = self.group_positions[group_col].get(group_key)
+        if position is None:
+            return 0, 0
+
+        starts = self.array(group_col, 'offsets')
+        return int(starts[position]), int(starts[position + 1])
+
+    def design(self, group_col, independent_vars = None, group_key = None):
+
+        '''
+        The design dict design_matrix builds, for one group or for every group sorted by group_col
+        The exog block is a view of the mapped file when the variables are the bundle's own and no record has a null,
+        otherwise only the rows and columns needed are copied
+        '''
+
+        exog = self.array(group_col, 'exog')
+        endog = self.array(group_col, 'endog')
+
+        if group_key is not None:
+            start, stop = self.group_rows(group_col, group_key)
+            exog, endog = exog[start:stop], endog[start:stop]
+
+        names = self.names
+        if independent_vars is not None and list(independent_vars) != names[1:]:
+            positions = [0] + [names.index(var) for var in independent_vars]
+            exog = exog[:, positions]
+            names = [names[position] for position in positions]
+
+        keep = np.isfinite(endog) & np.isfinite(exog).all(axis = 1)
+        if not keep.all():
+            exog, endog = exog[keep], endog[keep]
+
+        return {'endog': endog, 'exog': exog, 'names': list(names), 'keep': keep}
+
+
+def open_regression_bundle(bundle_dir):
+
+    '''
+    The regression bundle, opened once per process, a rewritten bundle is reopened
+    '''
+
+    manifest_path = os.path.join(bundle_dir, BUNDLE_FILE)
+    bundle_key = (os.path.abspath(bundle_dir), os.stat(manifest_path).st_mtime_ns if os.path.isfile(manifest_path)
+                  else None)
+
+    if bundle_key not in _bundles:
+        _bundles[bundle_key] = RegressionBundle(bundle_dir)
+
+    return _bundles[bundle_key]
+
+
+def _init_bundle_worker(bundle_dir, group_col, fit_kwargs, single_thread = False, cache_dir = None):
+
+    ### One BLAS thread per worker, otherwise every process tries to use every core
+    if single_thread:
+        from threadpoolctl import threadpool_limits
+        _worker_data['thread_limits'] = threadpool_limits(limits = 1)
+
+    ### Workers only get the path, each one maps the same files
+    _worker_data['bundle'] = open_regression_bundle(bundle_dir)
+    _worker_data['group_col'] = group_col
+    _worker_data['fit_kwargs'] = fit_kwargs
+    _worker_data['cache_dir'] = cache_dir
+
+
+def _fit_bundle_task(task):
+
+    group_key, independent_vars = task
+    group_col = _worker_data['group_col']
+
+    design = _worker_data['bundle'].design(group_col, independent_vars, group_key)
+
+    return fit_group(None, group_key, group_col, independent_vars, _worker_data['fit_kwargs'], design,
+                     _worker_data['cache_dir'])
+
+
+def run_bundle_regressions(bundle_dir, group_col, independent_vars, groups = None, processes = None,
+                           fit_kwargs = None, solver = 'grouped', maxiter = 35, tol = 1e-8, cache_dir = None):
+
+    '''
+    run_grouped_regressions or, with solver = 'batched', run_batched_regressions on a regression bundle
+    Worker processes are sent the bundle's path instead of the data, each group's rows are read from the mapped files
+    independent_vars is one list for every group or, with the grouped solver, a dict of lists keyed by group
+    With cache_dir only the groups that changed since an earlier run are fit
+    '''
+
+    bundle = open_regression_bundle(bundle_dir)
+
+    if groups is None:
+        groups = bundle.groups(group_col)
+    if len(groups) == 0:
+        return empty_group_fits(group_col, cache_dir)
+
+    if solver == 'batched':
+        if isinstance(independent_vars, dict):
+            raise ValueError('The batched solver fits every group with the same variables')
+
+        return fit_batched_design(bundle.design(group_col, independent_vars), bundle.offsets(group_col), group_col,
+                                  groups, maxiter, tol, cache_dir)
+
+    tasks = []
+    for group_key in groups:
+        group_vars = independent_vars[group_key] if isinstance(independent_vars, dict) else list(independent_vars)
+        tasks.append((group_key, group_vars))
+
+    if processes == 1:
+        _init_bundle_worker(bundle_dir, group_col, fit_kwargs, cache_dir = cache_dir)
+        fits = [_fit_bundle_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes, initializer = _init_bundle_worker,
+                                  initargs = (bundle_dir, group_col, fit_kwargs, True, cache_dir)) as pool:
+            fits = pool.map(_fit_bundle_task, tasks, chunksize = 1)
+
+    if cache_dir is not None:
+        evict_cache(cache_dir, MAX_FIT_CACHE_BYTES)
+
+    results_df = pd.concat([results for results, fit_info in fits], ignore_index = True)
+    fit_info_df = fit_info_frame([fit_info for results, fit_info in fits])
+
+    return results_df, fit_info_df
@@ -0,0 +1,185 @@
+import os
+import sys
+import hashlib
+import inspect
+import pickle
+
+import pandas as pd
+import numpy as np
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+CACHE_DIR = os.path.join(DATA_DIR, 'hmda_lar', 'cache')
+
+### Evict the least recently used artifacts once the cache is bigger than this
+MAX_CACHE_BYTES = 20 * 1024 ** 3
+
+
+def hash_value(value, hasher):
+
+    '''
+    Feed anything a stage takes as input into the hash
+    Dataframes and series are hashed by content, paths to files by size and modification time
+    '''
+
+    if isinstance(value, pd.DataFrame):
+        hasher.update(b'dataframe')
+        hasher.update(str(list(value.columns)).encode())
+        hasher.update(str(list(value.dtypes.astype(str))).encode())
+        hasher.update(pd.util.hash_pandas_object(value, index = True).values.tobytes())
+
+    elif isinstance(value, pd.Series):
+        hasher.update(b'series')
+        hasher.update(str((value.name, str(value.dtype))).encode())
+        hasher.update(pd.util.hash_pandas_object(value, index = True).values.tobytes())
+
+    elif isinstance(value, np.ndarray):
+        hasher.update(b'array')
+        hasher.update(str((value.dtype, value.shape)).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+
+    elif isinstance(value, dict):
+        hasher.update(b'dict')
+        for key in sorted(value, key = str):
+            hasher.update(str(key).encode())
+            hash_value(value[key], hasher)
+
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b'list')
+        for item in value:
+            hash_value(item, hasher)
+
+    elif isinstance(value, str) and os.path.isfile(value):
+        file_stat = os.stat(value)
+        hasher.update(str(('file', os.path.abspath(value), file_stat.st_size, file_stat.st_mtime_ns)).encode())
+
+    elif callable(value):
+        hash_value(function_source(value), hasher)
+
+    else:
+        hasher.update(repr(value).encode())
+
+
+def utils_modules(module, found = None):
+
+    '''
+    A module plus every utils module it pulls functions or constants from, followed recursively
+    '''
+
+    if found is None:
+        found = {}
+
+    found[module.__name__] = module
+
+    for value in vars(module).values():
+        source_name = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+
+        if isinstance(source_name, str) and source_name.startswith('utils.') and source_name not in found:
+            source_module = sys.modules.get(source_name)
+            if source_module is not None:
+                utils_modules(source_module, found)
+
+    return found
+
+
+def function_source(function):
+
+    '''
+    Source of the module a function lives in and of the utils modules it uses,
+    so a change to any helper or threshold counts as a change to the stage
+    '''
+
+    module = sys.modules.get(getattr(function, '__module__', None))
+
+    try:
+        modules = utils_modules(module)
+        return ''.join(inspect.getsource(modules[name]) for name in sorted(modules)) + function.__qualname__
+    except (TypeError, OSError):
+        pass
+
+    try:
+        return inspect.getsource(function)
+    except (TypeError, OSError):
+        return function.__qualname__
+
+
+def stage_key(function, args, kwargs):
+
+    '''
+    Hash of a stage's function source, inputs and parameters
+    '''
+
+    hasher = hashlib.sha256()
+
+    hasher.update(function_source(function).encode())
+    hash_value(list(args), hasher)
+    hash_value(kwargs, hasher)
+
+    return hasher.hexdigest()
+
+
+def evict_cache(cache_dir = CACHE_DIR, max_bytes = MAX_CACHE_BYTES):
+
+    '''
+    Delete the least recently used artifacts until the cache fits in max_bytes
+    '''
+
+    if not os.path.isdir(cache_dir):
+        return
+
+    artifacts = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith('.pkl'):
+            file_stat = os.stat(os.path.join(cache_dir, file_name))
+            artifacts.append((file_stat.st_mtime, file_stat.st_size, file_name))
+
+    artifacts.sort()
+    total_bytes = sum(size for mtime, size, file_name in artifacts)
+
+    for mtime, size, file_name in artifacts:
+        if total_bytes <= max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, file_name))
+        total_bytes -= size
+
+
+def cached_stage(function, *args, cache_dir = CACHE_DIR, max_bytes = MAX_CACHE_BYTES, **kwargs):
+
+    '''
+    Run a pipeline stage, or load its output from the cache if its inputs, parameters and source haven't changed
+    Example: cached_stage(categorize_chunk, hmda19_df, references)
+    '''
+
+    key = stage_key(function, args, kwargs)
+    artifact_path = os.path.join(cache_dir, function.__name__ + '_' + key[:32] + '.pkl')
+
+    if os.path.isfile(artifact_path):
+        ### Loading counts as a use for the LRU eviction
+        os.utime(artifact_path, None)
+
+        with open(artifact_path, 'rb') as artifact:
+            return pickle.load(artifact)
+
+    result = function(*args, **kwargs)
+
+    os.makedirs(cache_dir, exist_ok = True)
+
+    ### Write to a temporary file first so an interrupted run never leaves a broken artifact
+    temp_path = artifact_path + '.tmp'
+    with open(temp_path, 'wb') as artifact:
+        pickle.dump(result, artifact, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, artifact_path)
+
+    evict_cache(cache_dir, max_bytes)
+
+    return result
+
+
+def clear_cache(cache_dir = CACHE_DIR):
+
+    '''
+    Remove every cached artifact
+    '''
+
+    evict_cache(cache_dir, max_bytes = 0)
@@ -0,0 +1,97 @@
+import pandas as pd
+
+
+### Every derived category column, its codes and what they mean
+### The codes stay the strings the notebooks already filter on, stored as pandas Categoricals they take
+### one byte per record instead of a Python string
+CATEGORY_SCHEMA = {
+    'app_race_ethnicity': {'1': 'Native American', '2': 'Asian', '3': 'Black', '4': 'Pacific Islander',
+                           '5': 'White', '6': 'Latino', '7': 'Race NA', '8': 'No co-applicant'},
+
+    'coapp_race_ethnicity': {'1': 'Native American', '2': 'Asian', '3': 'Black', '4': 'Pacific Islander',
+                             '5': 'White', '6': 'Latino', '7': 'Race NA', '8': 'No co-applicant'},
+
+    'coapp_same_race': {'1': 'Same race', '2': 'Different race', '3': 'Not applicable', '4': 'No co-applicant'},
+
+    'app_credit_model': {'1': 'Equifax', '2': 'Experian', '3': 'TransUnion', '4': 'Vantage',
+                         '5': 'More than one', '6': 'Other model', '7': 'Credit NA'},
+
+    'co_applicant': {'1': 'Co-applicant', '2': 'No co-applicant', '3': 'Not applicable'},
+
+    'loan_outcome': {'1': 'Loan', '3': 'Denied', '4': 'Other outcome', '6': 'Purchased loan'},
+
+    'aus_cat': {'1': 'One AUS', '2': 'Same AUS multiple times', '3': 'Different AUS', '4': 'Exempt'},
+
+    'dti_cat': {'1': 'Healthy', '2': 'Manageable', '3': 'Unmanageable', '4': 'Struggling', '5': 'Exempt',
+                '6': 'Null'},
+
+    'downpayment_flag': {'1': '20 percent or more', '2': 'Less than 20 percent', '3': 'Null'},
+
+    'prop_value_cat': {'1': 'More than one standard deviation below', '2': 'Between minus one and zero',
+                       '3': 'Between zero and one', '4': 'Between one and two',
+                       '5': 'More than two, ratio below 10', '6': 'Ratio of 10 or more', '7': 'No ratio'},
+
+    'applicant_age_cat': {'1': 'Less than 25', '2': '25 through 34', '3': '35 through 44', '4': '45 through 54',
+                          '5': '55 through 64', '6': '65 through 74', '7': 'Greater than 74',
+                          '8': 'Not applicable'},
+
+    'applicant_sex_cat': {'1': 'Male', '2': 'Female', '3': 'Not applicable', '6': 'Marked both'},
+
+    'main_aus': {'1': 'Desktop Underwriter', '2': 'Loan Prospector',
+                 '3': 'Technology Open to Approved Lenders', '4': 'Guaranteed Underwriting System',
+                 '5': 'Other', '6': 'No main AUS', '7': 'Not applicable'},
+
+    'mortgage_term': {'1': '30 year mortgage', '2': 'Less than 30 years', '3': 'More than 30 years',
+                      '4': 'Not applicable'},
+
+    'lmi_def': {'1': 'Low', '2': 'Moderate', '3': 'Middle', '4': 'Upper', '5': 'None'},
+
+    'diverse_def': {'0': 'No census match', '1': 'More than 75 percent white', '2': '50 to 75 percent white',
+                    '3': '25 to 50 percent white', '4': '25 percent white or less', '5': 'No census data'}}
+
+
+def category_dtype(field):
+
+    '''
+    The fixed categorical dtype for a derived field
+    '''
+
+    return pd.CategoricalDtype(categories = list(CATEGORY_SCHEMA[field]))
+
+
+def as_category(values, field):
+
+    '''
+    Store a derived column with its fixed categories, codes outside the schema become null
+    '''
+
+    values = pd.Series(values)
+
+    ### Categoricals read back from a stage only need their categories swapped, not every value rebuilt
+    if isinstance(values.dtype, pd.CategoricalDtype) and values.cat.categories.inferred_type in ('string', 'empty'):
+        return values.cat.set_categories(list(CATEGORY_SCHEMA[field]))
+
+    return values.astype(object).astype(category_dtype(field))
+
+
+def apply_category_schema(df):
+
+    '''
+    Convert every derived category column in a dataframe, for frames built with the row functions
+    or read back from CSV
+    '''
+
+    for field in CATEGORY_SCHEMA:
+        if field in df.columns:
+            df[field] = as_category(df[field], field)
+
+    return df
+
+
+def label_categories(values, field):
+
+    '''
+    Replace the codes with their labels, for tables and charts
+    '''
+
+    return as_category(values, field).cat.rename_categories(CATEGORY_SCHEMA[field])
@@ -1,3 +1,14 @@
+import pandas as pd
+import numpy as np
+
+from utils.clean_data import apply_rules
+from utils.categories import as_category
+
+
+### Property value z-score parameters, these numbers come from 1_property_value_analysis Jupyter Notebook
+PROP_VALUE_MEAN = 1.475
+PROP_VALUE_STD = 0.907
+
 
 def setup_dti_cat(row):
     
@@ -54,9 +65,8 @@ def calculate_prop_zscore(row):
     '''
     
     
-    ### This numbers come from 1_property_value_analysis Jupyter Notebook
-    standard_deviation = 0.907
-    mean = 1.475
+    standard_deviation = PROP_VALUE_STD
+    mean = PROP_VALUE_MEAN
     
     prop_value_ratio = row['property_value_ratio']
     
@@ -239,8 +249,250 @@ def categorize_lmi(row):
     ### None
     elif tract_msa_ratio == 0:
         return '5'
+
+
+
+def make_prop_value_bins(mean = PROP_VALUE_MEAN, standard_deviation = PROP_VALUE_STD):
+    
+    '''
+    Bin spec for the property value ratio categories, cut points are standard deviations away from the mean
+    '''
+    
+    edges = [0.009, 
+             round(mean - standard_deviation, 3), 
+             mean, 
+             round(mean + standard_deviation, 3), 
+             round(mean + (2 * standard_deviation), 3), 
+             10, 
+             np.inf]
+    
+    return {'edges': edges, 'closed': 'left', 'codes': ['1', '2', '3', '4', '5', '6'], 'fallback': '7'}
+
+
+### Bin specs: edges, which side of each bin is closed, the code for each bin,
+### exact values that get their own code and the code for everything else (nulls included)
+PROP_VALUE_BINS = make_prop_value_bins()
+
+CLTV_BINS = {'edges': [-np.inf, 80, np.inf], 'closed': 'right', 'codes': ['1', '2'], 'fallback': '3'}
+
+LOAN_TERM_BINS = {'edges': [-np.inf, 360, np.inf], 'closed': 'left', 'codes': ['2', '3'], 
+                  'values': {360: '1'}, 'fallback': '4'}
+
+LMI_BINS = {'edges': [0, 50, 80, 120, np.inf], 'closed': 'left', 'codes': ['1', '2', '3', '4'], 
+            'values': {0: '5'}, 'fallback': None}
+
+
+def categorize_bins(values, bin_spec):
+    
+    '''
+    Assign every value in a numeric column to its bin code with one searchsorted call
+    An infinite outer edge leaves that end open, so inf lands in the top bin when the last edge is inf
+    and -inf in the bottom bin when the first edge is -inf, the same as the row functions' comparisons
+    Values beyond a finite outer edge and nulls get the fallback code
+    '''
+    
+    x = np.asarray(values, dtype = float)
+    edges = np.asarray(bin_spec['edges'], dtype = float)
+    codes = np.array(list(bin_spec['codes']) + [bin_spec.get('fallback')], dtype = object)
+    
+    ### Left closed bins are [low, high), right closed bins are (low, high]
+    side = 'right' if bin_spec.get('closed', 'left') == 'left' else 'left'
+    bin_index = np.searchsorted(edges, x, side = side) - 1
+    
+    ### searchsorted puts inf on the inf edge itself, outside every bin
+    if edges[-1] == np.inf:
+        bin_index[x == np.inf] = len(edges) - 2
+    if edges[0] == -np.inf:
+        bin_index[x == -np.inf] = 0
+    
+    ### Values outside the edges and nulls fall back
+    outside = (bin_index < 0) | (bin_index >= len(codes) - 1) | np.isnan(x)
+    bin_index[outside] = len(codes) - 1
+    
+    categories = codes[bin_index]
+    
+    for value, code in bin_spec.get('values', {}).items():
+        categories[x == value] = code
+    
+    return pd.Series(categories, index = getattr(values, 'index', None))
+
+
+def calculate_property_value_ratio(prop_value, median_prop_value):
+    
+    '''
+    Property value compared to the county median, rounded like the notebook
+    '''
+    
+    return prop_value.div(median_prop_value).round(3)
+
+
+def calculate_prop_zscore_series(property_value_ratio, mean = PROP_VALUE_MEAN, 
+                                 standard_deviation = PROP_VALUE_STD):
+    
+    '''
+    Column version of calculate_prop_zscore
+    '''
+    
+    return (property_value_ratio - mean)/standard_deviation
+
+
+def accumulate_prop_value_moments(property_value_ratio, moments = None):
+    
+    '''
+    Add a chunk of property value ratios to the running count, mean and sum of squared deviations
+    Only ratios below 10 count, same as PROP_VALUE_MEAN and PROP_VALUE_STD
+    '''
+    
+    x = np.asarray(property_value_ratio, dtype = float)
+    x = x[x < 10]
+    
+    chunk_mean = x.mean() if len(x) else 0.0
+    chunk = {'count': len(x), 'mean': chunk_mean, 'squares': ((x - chunk_mean) ** 2).sum()}
+    
+    if moments is None or moments['count'] == 0:
+        return chunk
+    if chunk['count'] == 0:
+        return moments
+    
+    ### Centered sums merged the same way as the VIF moments, accurate over millions of records
+    count = moments['count'] + chunk['count']
+    delta = chunk['mean'] - moments['mean']
+    
+    return {'count': count,
+            'mean': moments['mean'] + delta * chunk['count']/count,
+            'squares': moments['squares'] + chunk['squares'] + delta ** 2 * moments['count'] * chunk['count']/count}
+
+
+def prop_value_params(moments):
+    
+    '''
+    The z-score mean and standard deviation for a year's property value ratios, rounded like the notebook's
+    '''
+    
+    if moments is None or moments['count'] < 2:
+        raise ValueError('Not enough property value ratios to find the z-score parameters')
+    
+    return {'mean': round(float(moments['mean']), 3),
+            'standard_deviation': round(float(np.sqrt(moments['squares']/(moments['count'] - 1))), 3)}
+
+
+def categorize_property_value_ratio_series(property_value_ratio, bin_spec = PROP_VALUE_BINS):
     
+    '''
+    Column version of categorize_property_value_ratio
+    '''
+    
+    return as_category(categorize_bins(property_value_ratio, bin_spec), 'prop_value_cat')
+
+
+def categorize_cltv_series(cltv_ratio, bin_spec = CLTV_BINS):
+    
+    '''
+    Column version of categorize_cltv
+    '''
+    
+    return as_category(categorize_bins(cltv_ratio, bin_spec), 'downpayment_flag')
+
+
+def categorize_loan_term_series(loan_term, bin_spec = LOAN_TERM_BINS):
+    
+    '''
+    Column version of categorize_loan_term
+    '''
+    
+    return as_category(categorize_bins(loan_term, bin_spec), 'mortgage_term')
+
+
+def categorize_lmi_series(tract_msa_ratio, bin_spec = LMI_BINS):
+    
+    '''
+    Column version of categorize_lmi
+    '''
+    
+    return as_category(categorize_bins(tract_msa_ratio, bin_spec), 'lmi_def')
+
+
+def setup_dti_cat_series(dti):
+    
+    '''
+    Column version of setup_dti_cat, nulls get the 'null' category
+    '''
+    
+    healthy = ['<20%', '20%-<30%', '30%-<36%', ]
+    manageable = ['36', '37', '38', '39', '40', '41', '42',]
+    unmanageable = ['43', '44', '45', '46', '47', '48', '49']
+    struggling = ['50%-60%', '>60%']
+    
+    rules = [(dti.isin(healthy), '1'),
+             (dti.isin(manageable), '2'),
+             (dti.isin(unmanageable), '3'),
+             (dti.isin(struggling), '4'),
+             (dti == 'Exempt', '5'),
+             (dti.isnull() | (dti == 'null'), '6')]
+    
+    return apply_rules(rules, dti.index, 'dti_cat')
+
+
+def categorize_age_series(age):
+    
+    '''
+    Column version of categorize_age
+    '''
+    
+    rules = [(age == '<25', '1'),
+             (age == '25-34', '2'),
+             (age == '35-44', '3'),
+             (age == '45-54', '4'),
+             (age == '55-64', '5'),
+             (age == '65-74', '6'),
+             (age == '>74', '7'),
+             (age.isin(['8888', '9999']), '8')]
+    
+    return apply_rules(rules, age.index, 'applicant_age_cat')
+
+
+def categorize_sex_series(sex):
+    
+    '''
+    Column version of categorize_sex
+    '''
     
+    rules = [(sex == '1', '1'),
+             (sex == '2', '2'),
+             (sex.isin(['3', '4']), '3'),
+             (sex == '6', '6')]
     
+    return apply_rules(rules, sex.index, 'applicant_sex_cat')
+
+
+def categorize_underwriter_series(aus_cat, aus1):
+    
+    '''
+    Column version of categorize_underwriter
+    '''
+    
+    one_aus = aus_cat.isin(['1', '2'])
+    
+    rules = [(one_aus & (aus1 == '1'), '1'),
+             (one_aus & (aus1 == '2'), '2'),
+             (one_aus & (aus1 == '3'), '3'),
+             (one_aus & (aus1 == '4'), '4'),
+             (one_aus & (aus1 == '5'), '5'),
+             (aus_cat == '3', '6'),
+             (aus1.isin(['6', '1111']), '7')]
+    
+    return apply_rules(rules, aus_cat.index, 'main_aus')
+
+
+### Tract white population share: more than 75, 50 to 75, 25 to 50, 25 or less, no census data
+DIVERSE_BINS = {'edges': [-np.inf, 25, 50, 75, np.inf], 'closed': 'right', 'codes': ['4', '3', '2', '1'], 
+                'fallback': '5'}
+
+
+def categorize_diverse_series(white_pct, bin_spec = DIVERSE_BINS):
+    
+    '''
+    Create the white gradient for census tracts
+    '''
     
-    
\ No newline at end of file
+    return as_category(categorize_bins(white_pct, bin_spec), 'diverse_def')
@@ -1,4 +1,7 @@
 import pandas as pd
+import numpy as np
+
+from utils.categories import as_category
 
 def clean_location(row):
     
@@ -286,39 +289,42 @@ def clean_outcomes(row):
     elif outcome == '6':
         return '6'
         
-def find_aus_patterns(df):
+def count_aus_patterns(aus_df):
+    
+    '''
+    Count the distinct values and the nulls in every row of the aus columns in one pass
+    Nulls count as a distinct value, same as value_counts(dropna = False)
+    '''
+    
+    ### Integer codes for the whole block, nulls become -1
+    codes, uniques = pd.factorize(aus_df.values.ravel())
+    codes = codes.reshape(aus_df.shape)
+    
+    ### Sorting each row puts repeated values next to each other
+    sorted_codes = np.sort(codes, axis = 1)
+    number_of_values = 1 + (np.diff(sorted_codes, axis = 1) != 0).sum(axis = 1)
+    number_of_nulls = (codes == -1).sum(axis = 1)
+    
+    return number_of_values, number_of_nulls
+
+
+def find_aus_patterns(df, aus_cols = None):
     
     
     '''
     Looking for the patterns within the five aus columns
     Answering questions: How many times was the same aus used or were different ones used
+    Counts across every column of df unless aus_cols is passed, so it can run on the full HMDA frame
+    The two count columns are added to df itself, which is returned so aus_df = find_aus_patterns(aus_df) still works
     '''
     
+    if aus_cols is None:
+        aus_cols = df.columns
     
-    df_container = []
+    number_of_values, number_of_nulls = count_aus_patterns(df[aus_cols])
     
-    for index_num in df.index:
-        
-        ### take a single row
-        single_row_df = df.loc[[index_num]].copy()
-        
-        ### convert to series
-        row = pd.Series(single_row_df.values[0])
-        ### Count the values in that series
-        
-        valuescount_df = pd.DataFrame(row.value_counts(dropna = False))
-        num_unqiue_values = valuescount_df.index.nunique(dropna = False)
-        
-        try:
-            number_nulls = valuescount_df[(valuescount_df.index.isnull())].values[0][0]
-        except IndexError:
-            number_nulls = 0
-            
-        single_row_df['number_of_values'] = num_unqiue_values
-        single_row_df['number_of_nulls'] = number_nulls
-        df_container.append(single_row_df)
-    
-    df = pd.concat(df_container)
+    df['number_of_values'] = number_of_values
+    df['number_of_nulls'] = number_of_nulls
     
     return df
     
@@ -348,8 +354,205 @@ def clean_aus(row):
     ## Exempt  
     elif aus1 == '1111':
         return '4'
+
+
+
+def apply_rules(rules, index, field = None):
+    
+    '''
+    Evaluate an ordered list of (condition, code) rules over whole columns
+    The first rule that matches wins, records that match no rule get None, same as the row functions
+    Passing the derived field name returns its fixed categorical dtype
+    '''
+    
+    conditions = [np.asarray(condition, dtype = bool) for condition, code in rules]
+    codes = [code for condition, code in rules]
+    
+    categories = pd.Series(np.select(conditions, codes, default = None), index = index)
     
+    if field is not None:
+        categories = as_category(categories, field)
+    
+    return categories
+
+
+def clean_location_series(census_tract, county_code):
+    
+    '''
+    Column version of clean_location
+    Raw nulls and 'Na' are treated like the '00-00' and 'ii-ii' placeholders used in the notebook
+    '''
+    
+    null = ['00-00', 'ii-ii', 'Na']
+    
+    tract_null = census_tract.isnull() | census_tract.isin(null)
+    county_null = county_code.isnull() | county_code.isin(null)
+    
+    ### Tract when there is one, county when there isn't, '-----' when both are null
+    conditions = [~tract_null, tract_null & ~county_null, tract_null & county_null]
+    choices = [census_tract.values, county_code.values, '-----']
+    
+    location = pd.Series(np.select(conditions, choices, default = None), index = census_tract.index)
+    
+    return location
+
+
+def clean_race_ethnicity_series(race, ethnicity, field = 'app_race_ethnicity'):
+    
+    '''
+    Column version of clean_race_ethnicity, works for applicants and co-applicants
+    '''
+    
+    latinx = ['1', '11', '12', '13', '14']
+    asian = ['2', '21', '22', '23', '24', '25', '26', '27']
+    pac_islander = ['4', '41', '42', '43', '44']
+    black = ['3']
+    white = ['5']
+    native = ['1']
+    ethnicity_na = ['2', '3', '4', '000']
+    race_na = ['6', '7', '-1', '000']
+    
+    ### Used for co-applicants
+    ethnicity_nocoapp = ['5']
+    race_nocoapp = ['8']
+    
+    ### Nulls are NA, same as the '000' placeholder used in the notebook
+    is_latinx = ethnicity.isin(latinx)
+    is_ethnicity_na = ethnicity.isin(ethnicity_na) | ethnicity.isnull()
+    is_race_na = race.isin(race_na) | race.isnull()
+    
+    rules = [(is_latinx, '6'),
+             (~is_latinx & race.isin(black), '3'),
+             (~is_latinx & race.isin(asian), '2'),
+             (~is_latinx & race.isin(pac_islander), '4'),
+             (~is_latinx & race.isin(native), '1'),
+             (~is_latinx & race.isin(white), '5'),
+             (is_ethnicity_na & is_race_na, '7'),
+             ((ethnicity.isin(ethnicity_nocoapp) & race.isin(race_nocoapp)) |\
+              (race.isin(race_nocoapp) & is_ethnicity_na) |\
+              (ethnicity.isin(ethnicity_nocoapp) & is_race_na), '8')]
+    
+    return apply_rules(rules, race.index, field)
+
+
+def find_same_race_series(app_race_ethnicity, coapp_race_ethnicity):
+    
+    '''
+    Column version of find_same_race
+    '''
+    
+    race_yes = ['1', '2', '3', '4', '5', '6']
+    race_na = ['7']
+    no_coapp = ['8']
+    
+    app_na = app_race_ethnicity.isin(race_na)
+    app_yes = app_race_ethnicity.isin(race_yes)
+    coapp_na = coapp_race_ethnicity.isin(race_na)
+    coapp_yes = coapp_race_ethnicity.isin(race_yes)
+    coapp_none = coapp_race_ethnicity.isin(no_coapp)
+    
+    ### Compared as plain values so categoricals with different categories still line up
+    same_race = app_race_ethnicity.astype(object) == coapp_race_ethnicity.astype(object)
+    
+    rules = [(~app_na & ~coapp_none & same_race, '1'),
+             (~app_na & ~coapp_na & ~coapp_none & ~same_race, '2'),
+             ((app_na & coapp_na) | (app_yes & coapp_na) | (app_na & coapp_yes), '3'),
+             (coapp_none, '4')]
+    
+    return apply_rules(rules, app_race_ethnicity.index, 'coapp_same_race')
+
+
+def clean_credit_model_series(credit_model):
+    
+    '''
+    Column version of clean_credit_model
+    '''
+    
+    rules = [(credit_model.isin(['1']), '1'),
+             (credit_model.isin(['2']), '2'),
+             (credit_model.isin(['3', '4']), '3'),
+             (credit_model.isin(['5', '6']), '4'),
+             (credit_model.isin(['7']), '5'),
+             (credit_model.isin(['8']), '6'),
+             (credit_model.isin(['9', '1111']), '7')]
+    
+    return apply_rules(rules, credit_model.index, 'app_credit_model')
+
+
+def find_coapplicants_series(co_race, co_sex, co_age, co_credit):
+    
+    '''
+    Column version of find_coapplicants, the rules are in the same order as the row function
+    '''
+    
+    ### Co-Applicants
+    race_y = co_race.isin(['1', '2', '3', '4', '5', '6'])
+    sex_y = co_sex.isin(['1', '2'])
+    age_y = co_age.isin(['<25', '25-34', '35-44', '45-54', '55-64', '65-74', '>74'])
+    credit_y = co_credit.isin(['1', '2', '3', '4', '5', '6', '7', '8'])
+    
+    ### NA Co-Applicants
+    race_na = co_race.isin(['7'])
+    sex_na = co_sex.isin(['3', '4', '6'])
+    age_na = co_age.isin(['8888'])
+    credit_na = co_credit.isin(['9', '1111'])
+    
+    ### No Co-Applicants
+    race_n = co_race.isin(['8'])
+    sex_n = co_sex.isin(['5'])
+    age_n = co_age.isin(['9999'])
+    credit_n = co_credit.isin(['10'])
+    
+    rules = [
+        # CO APPLICANTS: 1
+        (race_y & ~sex_n & ~age_n & ~credit_n, '1'),
+        (~race_n & sex_y & ~age_n & ~credit_n, '1'),
+        (~race_n & ~sex_n & age_y & ~credit_n, '1'),
+        (~race_n & ~sex_n & ~age_n & credit_y, '1'),
+        ((race_y & sex_y) & (age_n | credit_n), '1'),
+        (((race_na & sex_y) | (race_y & sex_na)) & (age_n | credit_n), '1'),
         
+        # NO CO APPLICANTS: 2
+        (race_n & ~sex_y & ~age_y & ~credit_y, '2'),
+        (~race_y & sex_n & ~age_y & ~credit_y, '2'),
+        (~race_y & ~sex_y & age_n & ~credit_y, '2'),
+        (~race_y & ~sex_y & ~age_y & credit_n, '2'),
         
+        ### NA CO-APPLICANTS: 3
+        (race_na & sex_na & age_na & credit_na, '3'),
+        (((race_n & sex_n) | (race_n & sex_na) | (race_na & sex_n)) & (age_y | credit_y), '3'),
+        ((race_y & sex_n) | (race_n & sex_y), '3'),
+        ((race_na & sex_na) & ((age_y & credit_n) | (age_n & credit_y)), '3')]
+    
+    return apply_rules(rules, co_race.index, 'co_applicant')
+
+
+def clean_outcomes_series(outcome):
+    
+    '''
+    Column version of clean_outcomes
+    '''
+    
+    rules = [(outcome == '1', '1'),
+             (outcome == '3', '3'),
+             (outcome.isin(['2', '4', '5', '7', '8']), '4'),
+             (outcome == '6', '6')]
+    
+    return apply_rules(rules, outcome.index, 'loan_outcome')
+
+
+def clean_aus_series(aus1, number_of_values, number_of_nulls):
+    
+    '''
+    Column version of clean_aus
+    '''
+    
+    unique_values = pd.Series(number_of_values, index = aus1.index)
+    nulls = pd.Series(number_of_nulls, index = aus1.index)
     
+    rules = [((aus1 != '1111') & (unique_values == 2) & (nulls == 4), '1'),
+             (((unique_values == 2) & (nulls > 0) & (nulls < 4)) | ((unique_values == 1) & (nulls == 0)), '2'),
+             (((unique_values >= 2) & (nulls == 0)) | ((unique_values >= 3) & (nulls <= 3)), '3'),
+             (aus1 == '1111', '4')]
     
+    return apply_rules(rules, aus1.index, 'aus_cat')
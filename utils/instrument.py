@@ -0,0 +1,373 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+import collections
+
+import pandas as pd
+import numpy as np
+
+
+### How often the memory and profiler threads look at the process, in seconds
+SAMPLE_INTERVAL = 0.02
+
+### Hot functions kept per stage when profiling
+PROFILE_TOP = 25
+
+
+def current_rss():
+
+    '''
+    Resident memory of this process in bytes, read from /proc on Linux
+    Elsewhere falls back to the peak so far, which is all the resource module reports
+    '''
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ### Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def children_peak_rss():
+
+    '''
+    Largest resident memory of any finished child process in bytes, for stages that use a process pool
+    This is the peak over the whole life of this process, not of one stage, see RunManifest.stage
+    '''
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemorySampler:
+
+    '''
+    Track the peak resident memory while a stage runs by sampling it on a background thread
+    '''
+
+    def __init__(self, interval = SAMPLE_INTERVAL):
+
+        self.interval = interval
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+
+    def run(self):
+
+        while not self.stopping.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def start(self):
+
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        self.stopping.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+
+class SamplingProfiler:
+
+    '''
+    Count which functions the main thread is in at every sample, the stages run at full speed
+    unlike with cProfile. Time per function is the number of samples times the interval
+    '''
+
+    def __init__(self, interval = SAMPLE_INTERVAL):
+
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.samples = 0
+        self.own_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+
+    def run(self):
+
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            self.samples += 1
+            self.own_counts[self.frame_name(frame)] += 1
+
+            ### Every function on the stack counts once towards its total time
+            seen = set()
+            while frame is not None:
+                name = self.frame_name(frame)
+                if name not in seen:
+                    self.total_counts[name] += 1
+                    seen.add(name)
+                frame = frame.f_back
+
+    @staticmethod
+    def frame_name(frame):
+
+        code = frame.f_code
+        return os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ' ' + code.co_name
+
+    def start(self):
+
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        self.stopping.set()
+        self.thread.join()
+
+    def top(self, count = PROFILE_TOP):
+
+        return [{'function': name, 'total_seconds': round(samples * self.interval, 3),
+                 'own_seconds': round(self.own_counts[name] * self.interval, 3)}
+                for name, samples in self.total_counts.most_common(count)]
+
+
+class CProfileHook:
+
+    '''
+    The same interface as SamplingProfiler with cProfile, exact call counts at the cost of slowing the stage down
+    '''
+
+    def __init__(self):
+
+        import cProfile
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+
+        self.profiler.enable()
+        return self
+
+    def stop(self):
+
+        self.profiler.disable()
+
+    def top(self, count = PROFILE_TOP):
+
+        import pstats
+
+        stats = pstats.Stats(self.profiler).stats
+        rows = sorted(stats.items(), key = lambda item: item[1][3], reverse = True)[:count]
+
+        return [{'function': os.path.basename(file_name) + ':' + str(line) + ' ' + function_name,
+                 'calls': calls, 'total_seconds': round(cumulative, 3), 'own_seconds': round(own, 3)}
+                for (file_name, line, function_name), (primitive, calls, own, cumulative, callers) in rows]
+
+
+def count_records(value):
+
+    '''
+    Rows in a stage input or output, None for anything that isn't a table
+    '''
+
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+
+    if isinstance(value, dict) and 'rows_out' in value:
+        return value['rows_out']
+
+    ### A design matrix from use_regression
+    if isinstance(value, dict) and 'endog' in value:
+        return len(value['endog'])
+
+    return None
+
+
+def summarize_fits(value):
+
+    '''
+    Iteration counts and convergence from whatever a fitting function returned:
+    a statsmodels results object, a fit info dict, or a (results, fit info frame) pair from the grouped runners
+    '''
+
+    if isinstance(value, tuple) and len(value) == 2:
+        value = value[1]
+
+    if isinstance(value, pd.DataFrame) and 'iterations' in value.columns:
+        iterations = pd.to_numeric(value['iterations'], errors = 'coerce')
+        converged = value['converged'] if 'converged' in value.columns else pd.Series(dtype = object)
+
+        return {'fits': len(value),
+                'fits_converged': int((converged == True).sum()),
+                'fits_failed': int(value['error'].notnull().sum()) if 'error' in value.columns else None,
+                'iterations_mean': None if iterations.isnull().all() else float(iterations.mean()),
+                'iterations_max': None if iterations.isnull().all() else int(iterations.max())}
+
+    retvals = getattr(value, 'mle_retvals', None)
+    if isinstance(value, dict) and 'iterations' in value:
+        retvals = value
+
+    if isinstance(retvals, dict) and 'iterations' in retvals:
+        return {'fits': 1, 'fits_converged': int(bool(retvals.get('converged'))), 'fits_failed': 0,
+                'iterations_mean': float(retvals['iterations']), 'iterations_max': int(retvals['iterations'])}
+
+    return {}
+
+
+class RunManifest:
+
+    '''
+    Record wall time, CPU time, peak memory, row counts and fit iterations for every stage of a run,
+    then write them out as one JSON or Parquet manifest
+
+    manifest = RunManifest('2019 national model')
+    with manifest.stage('categorize', rows_in = len(df)) as record:
+        df = categorize_chunk(df, references)
+        record['rows_out'] = len(df)
+    fit = manifest.track(run_batched_regressions)
+    results_df, fit_info_df = fit(df, 'metro_code', independent_vars)
+    manifest.write('data/hmda_lar/manifests/national.json')
+
+    profile is None, 'sample' for the sampling profiler or 'cprofile', the hot functions go in each stage's record
+    '''
+
+    def __init__(self, name = None, profile = None, sample_interval = SAMPLE_INTERVAL):
+
+        self.name = name
+        self.profile = profile
+        self.sample_interval = sample_interval
+        self.started_at = pd.Timestamp.now().isoformat(timespec = 'seconds')
+        self.records = []
+
+    def make_profiler(self):
+
+        if self.profile == 'sample':
+            return SamplingProfiler(self.sample_interval)
+        elif self.profile == 'cprofile':
+            return CProfileHook()
+        elif self.profile is None:
+            return None
+
+        raise ValueError('profile is None, sample or cprofile, not ' + repr(self.profile))
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in = None, **fields):
+
+        '''
+        Measure everything run inside the with block as one stage, set rows_out or any other field on the record
+        '''
+
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        record.update(fields)
+
+        sampler = MemorySampler(self.sample_interval).start()
+        profiler = self.make_profiler()
+        if profiler is not None:
+            profiler.start()
+
+        start_wall = time.perf_counter()
+        start_times = os.times()
+        start_children_peak = children_peak_rss()
+        record['started_at'] = pd.Timestamp.now().isoformat(timespec = 'milliseconds')
+
+        try:
+            yield record
+            record['status'] = 'ok'
+
+        except BaseException as error:
+            record['status'] = 'failed'
+            record['error'] = repr(error)
+            raise
+
+        finally:
+            end_times = os.times()
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = (end_times.user - start_times.user) + (end_times.system - start_times.system)
+            record['children_cpu_seconds'] = (end_times.children_user - start_times.children_user) + \
+                                             (end_times.children_system - start_times.children_system)
+
+            sampler.stop()
+            record['start_rss_mb'] = sampler.start_rss/1024 ** 2
+            record['peak_rss_mb'] = sampler.peak_rss/1024 ** 2
+            record['peak_rss_increase_mb'] = (sampler.peak_rss - sampler.start_rss)/1024 ** 2
+
+            ### The children's peak only covers this stage when a child finishing in it raised the peak,
+            ### otherwise it is an earlier stage's and a smaller child of this one can't be told apart
+            children_peak = children_peak_rss()
+            raised = children_peak is not None and children_peak > (start_children_peak or 0)
+            record['children_peak_rss_mb'] = children_peak/1024 ** 2 if raised else None
+
+            if profiler is not None:
+                profiler.stop()
+                record['profile'] = profiler.top()
+
+            self.records.append(record)
+
+    def track(self, function, name = None):
+
+        '''
+        Wrap a utils function so every call is recorded as a stage, row counts and fit iterations
+        are read off its first argument and its result
+        '''
+
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def tracked(*args, **kwargs):
+
+            rows_in = count_records(args[0]) if args else None
+            with self.stage(stage_name, rows_in = rows_in) as record:
+                result = function(*args, **kwargs)
+
+                if isinstance(result, dict) and 'rows_in' in result:
+                    record['rows_in'] = result['rows_in']
+                record['rows_out'] = count_records(result[0] if isinstance(result, tuple) else result)
+                record.update(summarize_fits(result))
+
+            return result
+
+        return tracked
+
+    def to_frame(self):
+
+        '''
+        One row per stage, the profiles stay as lists in their column
+        '''
+
+        manifest_df = pd.DataFrame(self.records)
+        manifest_df.insert(0, 'run', self.name)
+        manifest_df.insert(1, 'run_started_at', self.started_at)
+
+        return manifest_df
+
+    def write(self, path):
+
+        '''
+        Write the manifest as JSON, or as Parquet when the path ends in .parquet
+        '''
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+
+        if path.endswith('.parquet'):
+            manifest_df = self.to_frame()
+            if 'profile' in manifest_df.columns:
+                manifest_df['profile'] = manifest_df['profile'].map(lambda profile: json.dumps(profile)
+                                                                    if isinstance(profile, list) else None)
+            manifest_df.to_parquet(path, index = False)
+            return
+
+        manifest = {'run': self.name, 'started_at': self.started_at,
+                    'python': sys.version.split()[0], 'pandas': pd.__version__, 'numpy': np.__version__,
+                    'stages': self.records}
+
+        with open(path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent = 2, default = str)
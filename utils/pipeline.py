@@ -0,0 +1,883 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import traceback
+import concurrent.futures
+
+import pandas as pd
+
+from utils.read_data import LAR_PATH, read_lar
+from utils.store_data import StageWriter, iter_stage, read_stage, write_stage
+from utils.cache_data import CACHE_DIR, hash_value, function_source, cached_stage
+from utils.instrument import RunManifest
+from utils.reference_data import MANIFEST_FILE, update_reference_store, store_references
+from utils.bundle_data import BUNDLE_FILE, write_regression_bundle, run_bundle_regressions
+from utils.process_data import (LENDER_PATH, COUNTIES_PATH, PROP_VALUES_PATH, TRACT_RACE_PATH, HOME_PURCHASE_COLS,
+                                load_references, clean_chunk, categorize_chunk, filter_home_purchase,
+                                measure_prop_values, chunk_stage)
+from utils.categorize_data import PROP_VALUE_MEAN, PROP_VALUE_STD
+from utils.use_regression import (FIT_CACHE_DIR, create_dummy_vars, calculate_vif, design_matrix, fit_design,
+                                  convert_results_to_df, count_group_outcomes, calculate_group_vif,
+                                  empty_group_fits)
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+PIPELINE_DIR = os.path.join(DATA_DIR, 'hmda_lar', 'pipeline')
+
+STATE_FILE = 'pipeline_state.json'
+
+### The dummy variables 1_regression_analysis creates
+REGRESSION_COLS = [{'loan_outcome': {'denied': ['3']}},
+                   {'app_race_ethnicity': {'black': ['3'], 'latino': ['6'], 'asian': ['2'], 'native': ['1'],
+                                           'pac_islander': ['4'], 'race_na': ['7'], 'asian_cb': ['2', '4']}},
+                   {'co_applicant': {'no_coapplicant': ['2'], 'na_coapplicant': ['3']}},
+                   {'applicant_sex_cat': {'female': ['2'], 'sex_na': ['3', '6']}},
+                   {'applicant_age_cat': {'less_than25': ['1'], 'between25_34': ['2'],
+                                          'between45_54': ['4'], 'between55_64': ['5'], 'between65_74': ['6'],
+                                          'greater74': ['7'], 'age_na': ['8'],
+                                          'younger_than_34': ['1', '2'], 'older_than_55': ['5', '6', '7'],
+                                          'older_than65': ['6', '7']}},
+                   {'prop_value_cat': {'pvr_bucket1': ['1'], 'pvr_bucket4': ['4'], 'pvr_bucket5': ['5'],
+                                       'pvr_bucket6': ['6'], 'pvr_bucket_none': ['7']}},
+                   {'mortgage_term': {'less30yrs_mortgage': ['2'], 'more30yrs_mortgage': ['3'],
+                                      'mortgage_term_na': ['4'], 'not30yr_mortgage': ['2', '3']}},
+                   {'app_credit_model': {'equifax': ['1'], 'experian': ['2'], 'other_model': ['4', '6'],
+                                         'more_than_one': ['5'], 'model_na': ['7']}},
+                   {'dti_cat': {'dti_manageable': ['2'], 'dti_unmanageable': ['3'],
+                                'dti_struggling': ['4'], 'dti_na': ['5', '6']}},
+                   {'downpayment_flag': {'less20pct_downpayment': ['2'], 'downpayment_na': ['3', '5']}},
+                   {'lmi_def': {'low_lmi': ['1'], 'moderate_lmi': ['2'], 'middle_lmi': ['3'], 'na_lmi': ['5']}},
+                   {'diverse_def': {'white_cat2': ['2'], 'white_cat3': ['3'], 'white_cat4': ['4'],
+                                    'white_cat_na': ['0', '5']}},
+                   {'lender_def': {'credit_union': ['2'], 'independent': ['3'], 'lender_na': ['4', '6']}},
+                   {'main_aus': {'non_desktop': ['2', '3', '4', '5', '6'], 'aus_na': ['7']}},
+                   {'metro_percentile': {'metro_90th': ['9'], 'metro_80th': ['8'],
+                                         'metro_70th': ['7'], 'metro_60th': ['6'], 'metro_50th': ['5'],
+                                         'metro_40th': ['4'], 'metro_30th': ['3'], 'metro_20th': ['2'],
+                                         'metro_10th': ['1'], 'metro_less10th': ['0'], 'micro_area': ['111'],
+                                         'metro_none': ['000']}}]
+
+### The variables 1_regression_analysis checks for collinearity before picking the national model
+NATIONAL_CANDIDATE_VARS = ['black', 'latino', 'asian_cb', 'native', 'race_na',
+                           'no_coapplicant', 'na_coapplicant',
+                           'female', 'sex_na',
+                           'less_than25', 'between25_34', 'between45_54', 'between55_64', 'older_than65', 'age_na',
+                           'income_log', 'loan_log',
+                           'pvr_bucket1', 'pvr_bucket4', 'pvr_bucket5', 'pvr_bucket6', 'pvr_bucket_none',
+                           'less30yrs_mortgage', 'more30yrs_mortgage', 'mortgage_term_na',
+                           'equifax', 'experian', 'other_model', 'more_than_one', 'model_na',
+                           'dti_manageable', 'dti_unmanageable', 'dti_struggling', 'dti_na',
+                           'less20pct_downpayment', 'downpayment_na',
+                           'moderate_lmi', 'middle_lmi', 'low_lmi', 'na_lmi',
+                           'credit_union', 'independent', 'lender_na',
+                           'lar_count',
+                           'non_desktop', 'aus_na',
+                           'white_cat2', 'white_cat3', 'white_cat4', 'white_cat_na',
+                           'metro_90th', 'metro_80th', 'metro_70th', 'metro_60th', 'metro_50th', 'metro_40th',
+                           'metro_30th', 'metro_20th', 'metro_10th', 'metro_less10th', 'micro_area', 'metro_none']
+
+### Kept in the national model even with a high VIF, and dropped from it regardless
+NATIONAL_KEEP_VARS = ['income_log', 'loan_log', 'metro_90th']
+NATIONAL_DROP_VARS = ['pvr_bucket1', 'pvr_bucket4', 'pvr_bucket5', 'pvr_bucket6', 'less20pct_downpayment']
+
+METRO_VARS = ['black', 'latino', 'native', 'asian_cb', 'race_na', 'female', 'sex_na', 'no_coapplicant',
+              'younger_than_34', 'older_than_55', 'income_log', 'loan_log', 'property_value_ratio',
+              'not30yr_mortgage', 'equifax', 'experian', 'other_model', 'more_than_one', 'model_na',
+              'dti_manageable', 'dti_unmanageable', 'dti_struggling', 'combined_loan_to_value_ratio',
+              'low_lmi', 'moderate_lmi', 'middle_lmi', 'credit_union', 'independent', 'lar_count',
+              'non_desktop', 'aus_na', 'white_cat2', 'white_cat3', 'white_cat4']
+METRO_CONTINUOUS_VARS = ['income_log', 'loan_log', 'combined_loan_to_value_ratio', 'lar_count', 'prop_zscore']
+
+LENDER_VARS = ['black', 'latino', 'asian_cb', 'native', 'race_na', 'female', 'sex_na', 'no_coapplicant',
+               'younger_than_34', 'older_than_55', 'income_log', 'loan_log', 'property_value_ratio',
+               'not30yr_mortgage', 'equifax', 'experian', 'other_model', 'more_than_one', 'model_na',
+               'dti_manageable', 'dti_unmanageable', 'dti_struggling', 'combined_loan_to_value_ratio',
+               'low_lmi', 'moderate_lmi', 'middle_lmi', 'non_desktop', 'aus_na',
+               'white_cat2', 'white_cat3', 'white_cat4']
+LENDER_CONTINUOUS_VARS = ['income_log', 'loan_log', 'combined_loan_to_value_ratio', 'property_value_ratio']
+
+### Lenders with fewer applications than this aren't modeled
+MIN_LENDER_APPS = 5000
+
+### Columns of the categorized data the regression data is built from
+REGRESSION_SOURCE_COLS = ['loan_type', 'income', 'loan_outcome', 'app_race_ethnicity', 'co_applicant',
+                          'applicant_sex_cat', 'applicant_age_cat', 'prop_value_cat', 'mortgage_term',
+                          'app_credit_model', 'dti_cat', 'downpayment_flag', 'lmi_def', 'diverse_def', 'lender_def',
+                          'main_aus', 'metro_percentile', 'metro_code', 'lei', 'income_log', 'loan_log',
+                          'lar_count', 'property_value_ratio', 'prop_zscore', 'combined_loan_to_value_ratio']
+
+
+def stage_paths(run_dir, year):
+
+    '''
+    Where every stage writes its outputs inside the run directory
+    Each year's outputs go in a directory named for the year, the stages shared by every year write to the run directory
+    '''
+
+    def path(file_name):
+        return os.path.join(run_dir, str(year), file_name)
+
+    return {'reference_store': {'store_path': os.path.join(run_dir, 'reference_store', MANIFEST_FILE)},
+            'pooled_national': {'findings_path': os.path.join(run_dir, 'pooled_national_findings.csv')},
+            'clean': {'clean_path': path('1_hmda' + str(year) + '.parquet')},
+            'prop_values': {'params_path': path('prop_value_params.json')},
+            'categorize': {'categorized_path': path('2_hmda' + str(year) + '.parquet')},
+            'regression_data': {'regression_path': path('3_hmda' + str(year) + '_regressiondata.parquet'),
+                                'vif_path': path('national_vif.csv'),
+                                'bundle_path': path(os.path.join('regression_bundle', BUNDLE_FILE))},
+            'national': {'findings_path': path('national_findings.csv')},
+            'metro': {'results_path': path('metro_results.csv'), 'fit_info_path': path('metro_fit_info.csv')},
+            'lender': {'results_path': path('lender_results.csv'), 'fit_info_path': path('lender_fit_info.csv'),
+                       'vif_path': path('lender_vif.csv')}}
+
+
+def reference_store_stage(outputs, inputs, options, manifest):
+
+    '''
+    Compile the census inputs into the memory mapped reference store the categorize stage reads,
+    a store built from the same inputs and code by an earlier run is kept
+    '''
+
+    store_manifest = update_reference_store(os.path.dirname(outputs['store_path']), options['counties_path'],
+                                            options['prop_values_path'], options['tract_race_path'])
+
+    return {'rows_out': sum(table['rows'] for table in store_manifest['tables'].values())}
+
+
+def clean_stage(outputs, inputs, options, manifest):
+
+    '''
+    Everything 1_clean_data does, streamed from the raw LAR a chunk at a time
+    '''
+
+    rows_in = 0
+
+    with StageWriter(outputs['clean_path']) as writer:
+        for chunk_number, chunk in enumerate(read_lar(options['lar_path'], chunksize = options['chunksize'])):
+            rows_in += len(chunk)
+
+            with chunk_stage(manifest, 'clean_chunk', len(chunk), chunk_number) as record:
+                clean_df = clean_chunk(chunk)
+                record['rows_out'] = len(clean_df)
+
+            writer.write(clean_df)
+
+    return {'rows_in': rows_in, 'rows_out': writer.rows}
+
+
+def measure_stage_prop_values(clean_path, store_path, chunksize):
+
+    '''
+    The property value z-score parameters of a cleaned stage file
+    Takes the files rather than the chunks so cached_stage can key it by them
+    '''
+
+    references = store_references(os.path.dirname(store_path))
+    chunks = iter_stage(clean_path, chunksize = chunksize,
+                        columns = HOME_PURCHASE_COLS + ['state_fips', 'county_fips', 'property_value'])
+
+    return measure_prop_values(chunks, references)
+
+
+def prop_values_stage(outputs, inputs, options, manifest):
+
+    '''
+    The year's property value z-score mean and standard deviation, measured on its home purchase records
+    unless the run keeps the 2019 notebook's
+    '''
+
+    if options['fixed_prop_zscore']:
+        prop_params = {'mean': PROP_VALUE_MEAN, 'standard_deviation': PROP_VALUE_STD}
+    else:
+        measure_args = (inputs['clean']['clean_path'], inputs['reference_store']['store_path'], options['chunksize'])
+
+        with manifest.stage('measure_prop_values'):
+            if options['stage_cache_dir'] is None:
+                prop_params = measure_stage_prop_values(*measure_args)
+            else:
+                prop_params = cached_stage(measure_stage_prop_values, *measure_args,
+                                           cache_dir = options['stage_cache_dir'])
+
+    with open(outputs['params_path'], 'w') as params_file:
+        json.dump(prop_params, params_file, indent = 2)
+
+    return {'prop_params': prop_params}
+
+
+def categorize_stage(outputs, inputs, options, manifest):
+
+    '''
+    Everything 2_categorize_data does, streamed from the cleaned data a chunk at a time
+    with the year's property value z-score parameters
+    '''
+
+    references = load_references(options['lender_path'],
+                                 store_dir = os.path.dirname(inputs['reference_store']['store_path']))
+    rows_in = 0
+
+    with StageWriter(outputs['categorized_path']) as writer:
+        chunks = iter_stage(inputs['clean']['clean_path'], chunksize = options['chunksize'])
+
+        for chunk_number, chunk in enumerate(chunks):
+            rows_in += len(chunk)
+
+            with chunk_stage(manifest, 'categorize_chunk', len(chunk), chunk_number) as record:
+                categorized_df = filter_home_purchase(categorize_chunk(chunk, references,
+                                                                       inputs['prop_values']['prop_params']))
+                record['rows_out'] = len(categorized_df)
+
+            writer.write(categorized_df)
+
+    return {'rows_in': rows_in, 'rows_out': writer.rows}
+
+
+def pick_national_vars(vif_df):
+
+    '''
+    The national model's variables: the candidates without a high VIF, less the ones 1_regression_analysis drops,
+    with the property value and loan to value ratios added in the notebook's positions
+    '''
+
+    highvif_vars = vif_df[(vif_df['threshold'] == '1') & ~(vif_df['independent_var'].isin(NATIONAL_KEEP_VARS))]\
+                   ['independent_var'].unique().tolist()
+
+    national_vars = [var for var in NATIONAL_CANDIDATE_VARS
+                     if var not in highvif_vars and var not in NATIONAL_DROP_VARS]
+    national_vars.insert(17, 'property_value_ratio')
+    national_vars.insert(28, 'combined_loan_to_value_ratio')
+
+    return national_vars
+
+
+def regression_data_stage(outputs, inputs, options, manifest):
+
+    '''
+    The regression dataset 1_regression_analysis exports for the metro and lender notebooks,
+    along with its collinearity check and the variables picked for the national model
+    '''
+
+    categorized_path = inputs['categorize']['categorized_path']
+
+    with manifest.stage('read_stage') as record:
+        hmda_df = read_stage(categorized_path, columns = REGRESSION_SOURCE_COLS)
+        record['rows_out'] = len(hmda_df)
+
+    for column in ['income', 'income_log', 'loan_log', 'lar_count', 'property_value_ratio', 'prop_zscore',
+                   'combined_loan_to_value_ratio']:
+        hmda_df[column] = pd.to_numeric(hmda_df[column])
+
+    hmda_df = hmda_df[(hmda_df['loan_type'] == '1') & (hmda_df['income'] > 0) &
+                      hmda_df['loan_outcome'].isin(['1', '3'])].copy()
+
+    with manifest.stage('create_dummy_vars', rows_in = len(hmda_df)) as record:
+        hmda_df = create_dummy_vars(hmda_df, REGRESSION_COLS)
+        record['rows_out'] = len(hmda_df)
+
+    with manifest.stage('calculate_vif', rows_in = len(hmda_df)):
+        vif_df = calculate_vif(hmda_df[NATIONAL_CANDIDATE_VARS])
+        vif_df.to_csv(outputs['vif_path'], index = False)
+
+    national_vars = pick_national_vars(vif_df)
+
+    ### Records the national model leaves out: unknown property values, loan terms, debt-to-income,
+    ### downpayments, incomes and diversity, and loans for more than the property is worth
+    hmda_df = hmda_df[(hmda_df['prop_value_cat'] != '7') & (hmda_df['mortgage_term'] != '4') &
+                      (hmda_df['dti_cat'] != '5') & (hmda_df['dti_cat'] != '6') &
+                      (hmda_df['downpayment_flag'] != '3') & (hmda_df['lmi_def'] != '5') &
+                      (hmda_df['diverse_def'] != '0') & (hmda_df['diverse_def'] != '5') &
+                      (hmda_df['combined_loan_to_value_ratio'] <= 100)]
+
+    ### The unknown categories the filter removes are left with one value, in the 2019 data the VIF check
+    ### already drops them but a year or sample where it doesn't would make the national model singular
+    national_vars = [var for var in national_vars if hmda_df[var].nunique() > 1]
+
+    cols_to_export = list(dict.fromkeys(national_vars + METRO_VARS + LENDER_VARS +
+                                        ['denied', 'loan_outcome', 'na_coapplicant', 'age_na', 'lender_na',
+                                         'metro_code', 'lei', 'app_race_ethnicity', 'app_credit_model']))
+
+    with manifest.stage('write_stage', rows_in = len(hmda_df)) as record:
+        write_stage(hmda_df[cols_to_export], outputs['regression_path'], sort_by = ['metro_code'])
+        record['rows_out'] = len(hmda_df)
+
+    ### The metro and lender models' records as memory mapped arrays sorted by metro and by lender,
+    ### their fitting workers all read the one copy in the page cache instead of getting the data pickled
+    with manifest.stage('write_regression_bundle', rows_in = len(hmda_df)) as record:
+        group_df = group_records(hmda_df)
+        write_regression_bundle(group_df, os.path.dirname(outputs['bundle_path']),
+                                list(dict.fromkeys(METRO_VARS + LENDER_VARS)), ['metro_code', 'lei'])
+        record['rows_out'] = len(group_df)
+
+    return {'rows_out': len(hmda_df), 'national_vars': national_vars}
+
+
+def national_stage(outputs, inputs, options, manifest):
+
+    '''
+    The national model from 1_regression_analysis
+    '''
+
+    national_vars = inputs['regression_data']['national_vars']
+    hmda_df = read_stage(inputs['regression_data']['regression_path'], columns = ['denied'] + national_vars)
+
+    design = design_matrix(hmda_df, national_vars)
+    fit = manifest.track(fit_design)
+    results = fit(design, independent_vars = national_vars, fit_kwargs = {'disp': 0})
+
+    national_findings_df = convert_results_to_df(results)
+    national_findings_df.to_csv(outputs['findings_path'], index = False)
+
+    return {'rows_in': len(hmda_df), 'rows_out': len(national_findings_df),
+            'converged': bool(results.mle_retvals['converged']), 'psuedo_rsquare': float(results.prsquared)}
+
+
+def group_records(df):
+
+    '''
+    The records the metro and lender notebooks model: known co-applicants, ages and lenders
+    '''
+
+    return df[(df['na_coapplicant'] != 0) & (df['age_na'] != 0) & (df['lender_na'] != 0)]
+
+
+def read_years(year_paths, columns = None):
+
+    '''
+    One year partitioned stage output read as one frame with a year column, for pooled models
+    year_paths maps each year to its file, e.g. every year's regression_path
+    '''
+
+    year_dfs = []
+
+    for year, path in sorted(year_paths.items()):
+        year_df = read_stage(path, columns = columns)
+        year_df['year'] = str(year)
+        year_dfs.append(year_df)
+
+    return pd.concat(year_dfs, ignore_index = True)
+
+
+def pooled_national_stage(outputs, inputs, options, manifest):
+
+    '''
+    The national model fit on every year's regression data at once, with a dummy for each year after the first
+    Only the variables every year's model picked are used
+    '''
+
+    year_inputs = inputs['regression_data']
+    years = sorted(year_inputs)
+
+    national_vars = [var for var in year_inputs[years[0]]['national_vars']
+                     if all(var in year_inputs[year]['national_vars'] for year in years)]
+
+    with manifest.stage('read_years') as record:
+        hmda_df = read_years({year: year_inputs[year]['regression_path'] for year in years},
+                             columns = ['denied'] + national_vars)
+        record['rows_out'] = len(hmda_df)
+
+    ### Same encoding as the other dummies, 0 for the records from that year
+    year_vars = ['year_' + str(year) for year in years[1:]]
+    hmda_df = create_dummy_vars(hmda_df, {'year': {'year_' + str(year): [str(year)] for year in years[1:]}})
+
+    design = design_matrix(hmda_df, national_vars + year_vars)
+    fit = manifest.track(fit_design)
+    results = fit(design, independent_vars = national_vars + year_vars, fit_kwargs = {'disp': 0})
+
+    pooled_findings_df = convert_results_to_df(results)
+    pooled_findings_df.to_csv(outputs['findings_path'], index = False)
+
+    return {'rows_in': len(hmda_df), 'rows_out': len(pooled_findings_df), 'years': years,
+            'converged': bool(results.mle_retvals['converged']), 'psuedo_rsquare': float(results.prsquared)}
+
+
+def load_group_data(path, group_col, independent_vars):
+
+    '''
+    The records the metro and lender notebooks model in a known group
+    '''
+
+    hmda_df = read_stage(path, columns = list(dict.fromkeys([group_col, 'denied', 'loan_outcome', 'na_coapplicant',
+                                                              'age_na', 'lender_na'] + independent_vars)))
+    hmda_df = group_records(hmda_df)
+
+    return hmda_df[hmda_df[group_col].notnull()].reset_index(drop = True)
+
+
+def fit_groups(manifest, bundle_path, group_col, independent_vars, groups, options):
+
+    '''
+    One model per group from the regression bundle with the solver picked for the run
+    The batched solver needs one variable list, so groups with their own lists always use the grouped runner
+    With a fit cache only the groups whose records or variables changed since an earlier run are fit
+    '''
+
+    solver = 'grouped' if isinstance(independent_vars, dict) else options['solver']
+
+    fit = manifest.track(run_bundle_regressions)
+    return fit(os.path.dirname(bundle_path), group_col, independent_vars, groups = groups,
+               processes = options['processes'], solver = solver, cache_dir = options['fit_cache_dir'])
+
+
+def metro_stage(outputs, inputs, options, manifest):
+
+    '''
+    The metro by metro models from 2_metro_by_metro_regression, with the loan and denial counts
+    for every variable that the notebook merges onto the results
+    '''
+
+    hmda_df = load_group_data(inputs['regression_data']['regression_path'], 'metro_code', METRO_VARS)
+
+    count_vars = [var for var in METRO_VARS if var not in METRO_CONTINUOUS_VARS]
+    zero_vars = [var for var in METRO_VARS if var in METRO_CONTINUOUS_VARS]
+    count = manifest.track(count_group_outcomes)
+    varcount_df = count(hmda_df, 'metro_code', count_vars, zero_vars = zero_vars)
+
+    ### The counts at the reference level, 0 with the inverted dummy encoding,
+    ### the continuous variables get zero counts like the notebook's missing rows
+    varcount_df = varcount_df[varcount_df['variable_flag'] == 0]
+
+    metros = hmda_df['metro_code'].unique().tolist()
+    if metros:
+        results_df, fit_info_df = fit_groups(manifest, inputs['regression_data']['bundle_path'], 'metro_code',
+                                             METRO_VARS, metros, options)
+    else:
+        log('no metro has records to fit, skipping the metro models')
+        results_df, fit_info_df = empty_group_fits('metro_code', options['fit_cache_dir'])
+
+    results_df = pd.merge(results_df, varcount_df, how = 'left', on = ['metro_code', 'variable_name'])
+    results_df.to_csv(outputs['results_path'], index = False)
+    fit_info_df.to_csv(outputs['fit_info_path'], index = False)
+
+    return {'rows_in': len(hmda_df), 'rows_out': len(results_df), 'groups': len(fit_info_df)}
+
+
+def lender_stage(outputs, inputs, options, manifest):
+
+    '''
+    The lender by lender models from 3_lender_by_lender_regression: lenders with enough applications,
+    each fit with the variables it has records for, and the lenders' VIFs
+    '''
+
+    hmda_df = load_group_data(inputs['regression_data']['regression_path'], 'lei', LENDER_VARS)
+
+    lender_apps = hmda_df['lei'].value_counts()
+    lenders = lender_apps[lender_apps >= options['min_lender_apps']].index.tolist()
+    hmda_df = hmda_df[hmda_df['lei'].isin(lenders)].reset_index(drop = True)
+
+    count_vars = [var for var in LENDER_VARS if var not in LENDER_CONTINUOUS_VARS]
+    count = manifest.track(count_group_outcomes)
+    varcount_df = count(hmda_df, 'lei', count_vars)
+    varcount_df = varcount_df[(varcount_df['variable_flag'] == 0) & (varcount_df['total_count'] > 0)]
+
+    ### Variables with no records at the reference level are left out of that lender's model
+    lender_vars = {lender: varcount_df[varcount_df['lei'] == lender]['variable_name'].unique().tolist() +
+                           LENDER_CONTINUOUS_VARS for lender in lenders}
+
+    if lenders:
+        results_df, fit_info_df = fit_groups(manifest, inputs['regression_data']['bundle_path'], 'lei', lender_vars,
+                                             lenders, options)
+    else:
+        log('no lender has ' + str(options['min_lender_apps']) + ' applications, skipping the lender models')
+        results_df, fit_info_df = empty_group_fits('lei', options['fit_cache_dir'])
+
+    results_df = pd.merge(results_df, varcount_df, how = 'left', on = ['lei', 'variable_name'])
+    results_df.to_csv(outputs['results_path'], index = False)
+    fit_info_df.to_csv(outputs['fit_info_path'], index = False)
+
+    vif = manifest.track(calculate_group_vif)
+    vif(hmda_df, 'lei', LENDER_VARS).to_csv(outputs['vif_path'], index = False)
+
+    return {'rows_in': len(hmda_df), 'rows_out': len(results_df), 'groups': len(fit_info_df)}
+
+
+### Every stage, what it needs to run first, the options its outputs depend on and whether it runs once per year
+### A stage shared by every year that depends on a yearly stage gets every year's outputs, keyed by year
+STAGES = {'reference_store': {'function': reference_store_stage, 'depends_on': [], 'per_year': False,
+                              'options': ['counties_path', 'prop_values_path', 'tract_race_path']},
+          'clean': {'function': clean_stage, 'depends_on': [], 'per_year': True,
+                    'options': ['lar_path']},
+          'prop_values': {'function': prop_values_stage, 'depends_on': ['clean', 'reference_store'], 'per_year': True,
+                          'options': ['fixed_prop_zscore']},
+          'categorize': {'function': categorize_stage, 'depends_on': ['clean', 'reference_store', 'prop_values'],
+                         'per_year': True, 'options': ['lender_path']},
+          'regression_data': {'function': regression_data_stage, 'depends_on': ['categorize'], 'per_year': True,
+                              'options': []},
+          'national': {'function': national_stage, 'depends_on': ['regression_data'], 'per_year': True,
+                       'options': []},
+          'pooled_national': {'function': pooled_national_stage, 'depends_on': ['regression_data'], 'per_year': False,
+                              'options': []},
+          'metro': {'function': metro_stage, 'depends_on': ['regression_data'], 'per_year': True,
+                    'options': ['solver']},
+          'lender': {'function': lender_stage, 'depends_on': ['regression_data'], 'per_year': True,
+                     'options': ['solver', 'min_lender_apps']}}
+
+
+def stage_order(targets = None):
+
+    '''
+    The stages needed for the targets, every stage after the ones it depends on
+    '''
+
+    if targets is None:
+        targets = list(STAGES)
+
+    order = []
+
+    def visit(name, path):
+        if name not in STAGES:
+            raise ValueError('Unknown stage ' + repr(name) + ', the stages are ' + ', '.join(STAGES))
+        if name in path:
+            raise ValueError('Stages depend on each other in a cycle: ' + ' -> '.join(path + [name]))
+        if name in order:
+            return
+
+        for dependency in STAGES[name]['depends_on']:
+            visit(dependency, path + [name])
+        order.append(name)
+
+    for target in targets:
+        visit(target, [])
+
+    return order
+
+
+def node_name(name, year):
+
+    '''
+    What a stage is called in the state file and the manifests, with the year for the stages run once per year
+    '''
+
+    return name if year is None else name + '_' + str(year)
+
+
+def stage_nodes(order, years):
+
+    '''
+    Every (stage, year) to run, the stages shared by every year once with no year
+    Each stage is listed for every year before the next stage, so the years run side by side
+    '''
+
+    nodes = []
+
+    for name in order:
+        if STAGES[name]['per_year']:
+            nodes.extend((name, year) for year in years)
+        else:
+            nodes.append((name, None))
+
+    return nodes
+
+
+def node_dependencies(node, years):
+
+    '''
+    The nodes a node needs first: the same year of a yearly stage, or every year when the node is shared
+    '''
+
+    name, year = node
+    dependencies = []
+
+    for dependency in STAGES[name]['depends_on']:
+        if not STAGES[dependency]['per_year']:
+            dependencies.append((dependency, None))
+        elif year is None:
+            dependencies.extend((dependency, dependency_year) for dependency_year in years)
+        else:
+            dependencies.append((dependency, year))
+
+    return dependencies
+
+
+def stage_key(name, outputs, inputs, options):
+
+    '''
+    Hash of a stage's source, options and upstream outputs, files are hashed by size and modification time
+    so rerunning a stage invalidates every stage after it
+    The source is the stage's module and every utils module it uses, so a change to a helper like clean_data's
+    or categorize_data's reruns the stages on resume too
+    '''
+
+    hasher = hashlib.sha256()
+
+    hash_value(name, hasher)
+    hash_value(function_source(STAGES[name]['function']), hasher)
+    hash_value({option: options[option] for option in STAGES[name]['options']}, hasher)
+    ### Output paths by name only, their files change every time the stage runs
+    hasher.update(repr(sorted(outputs.values())).encode())
+    hash_value({dependency: inputs[dependency] for dependency in STAGES[name]['depends_on']}, hasher)
+
+    return hasher.hexdigest()
+
+
+def load_state(run_dir):
+
+    state_path = os.path.join(run_dir, STATE_FILE)
+
+    if not os.path.isfile(state_path):
+        return {}
+
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def save_state(run_dir, state):
+
+    ### Replace the file in one step so a node dying mid-write never loses the completed stages
+    state_path = os.path.join(run_dir, STATE_FILE)
+    temp_path = state_path + '.tmp'
+
+    with open(temp_path, 'w') as state_file:
+        json.dump(state, state_file, indent = 2, default = str)
+    os.replace(temp_path, state_path)
+
+
+def is_complete(stage_state, key):
+
+    return stage_state is not None and stage_state.get('status') == 'ok' and stage_state.get('key') == key and \
+           all(os.path.isfile(path) for path in stage_state['outputs'].values())
+
+
+def run_stage(name, run_dir, outputs, inputs, options, node = None):
+
+    '''
+    Run one stage in a worker process, writing its manifest next to its outputs
+    Returns the stage's info, which downstream stages get as their inputs
+    '''
+
+    node = node or name
+    manifest = RunManifest(node, profile = options.get('profile'))
+
+    with manifest.stage(name) as record:
+        info = STAGES[name]['function'](outputs, inputs, options, manifest)
+        record['rows_in'] = info.get('rows_in')
+        record['rows_out'] = info.get('rows_out')
+
+    manifest.write(os.path.join(run_dir, 'manifests', node + '.json'))
+
+    return info
+
+
+def log(message):
+
+    print(pd.Timestamp.now().isoformat(timespec = 'seconds') + ' ' + message, flush = True)
+
+
+def lar_paths_for(years, lar_path = None, lar_paths = None):
+
+    '''
+    The raw LAR file for every year, one lar_path is enough for a single year
+    '''
+
+    if lar_paths is None:
+        if len(years) > 1:
+            raise ValueError('Give a LAR file for every year, e.g. --lar 2018=path 2019=path')
+        lar_paths = {years[0]: lar_path}
+
+    lar_paths = {int(year): path for year, path in lar_paths.items()}
+
+    missing = [str(year) for year in years if year not in lar_paths]
+    if missing:
+        raise ValueError('No LAR file for ' + ', '.join(missing))
+
+    return lar_paths
+
+
+def run_pipeline(run_dir = PIPELINE_DIR, years = None, stages = None, resume = False, workers = None, **options):
+
+    '''
+    Run the stages as a DAG for one or more years, every stage whose dependencies are done goes to the worker pool,
+    so the years run side by side and so do the national, metro and lender models
+    The reference store is built once and shared by every year, each year gets its own property value z-scores
+    With more than one year the pooled national model is fit on every year's regression data
+    With resume, stages that finished in an earlier run with the same options and inputs are skipped
+    The state file in run_dir records every completed stage, the pipeline can be killed and resumed at any point
+    '''
+
+    run_options = {'lar_path': LAR_PATH, 'lar_paths': None, 'lender_path': LENDER_PATH,
+                   'counties_path': COUNTIES_PATH, 'prop_values_path': PROP_VALUES_PATH,
+                   'tract_race_path': TRACT_RACE_PATH, 'chunksize': 1000000, 'solver': 'batched', 'processes': 1,
+                   'min_lender_apps': MIN_LENDER_APPS, 'fixed_prop_zscore': False, 'fit_cache_dir': None,
+                   'stage_cache_dir': None, 'profile': None}
+    run_options.update(options)
+
+    if years is None:
+        years = [2019]
+    elif isinstance(years, int):
+        years = [years]
+    years = sorted(set(int(year) for year in years))
+
+    lar_paths = lar_paths_for(years, run_options['lar_path'], run_options.pop('lar_paths'))
+
+    ### A pooled model needs more than one year
+    if stages is None:
+        stages = [name for name in STAGES if name != 'pooled_national' or len(years) > 1]
+
+    os.makedirs(run_dir, exist_ok = True)
+    for year in years:
+        os.makedirs(os.path.join(run_dir, str(year)), exist_ok = True)
+
+    nodes = stage_nodes(stage_order(stages), years)
+    state = load_state(run_dir) if resume else {}
+    infos = {}
+    done = set()
+
+    def outputs_for(node):
+        name, year = node
+        return stage_paths(run_dir, years[0] if year is None else year)[name]
+
+    def options_for(node):
+        name, year = node
+        return run_options if year is None else dict(run_options, lar_path = lar_paths[year], year = year)
+
+    def inputs_for(node):
+        inputs = {}
+        for dependency in node_dependencies(node, years):
+            dependency_name, dependency_year = dependency
+            dependency_info = dict(outputs_for(dependency), **infos[dependency])
+
+            ### A shared stage gets every year of a yearly one
+            if node[1] is None and dependency_year is not None:
+                inputs.setdefault(dependency_name, {})[dependency_year] = dependency_info
+            else:
+                inputs[dependency_name] = dependency_info
+        return inputs
+
+    pending = list(nodes)
+    running = {}
+    failed = []
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        while pending or running:
+
+            ### Submit everything that is ready, unless a stage has failed
+            for node in list(pending):
+                if failed:
+                    break
+                if any(dependency not in done for dependency in node_dependencies(node, years)):
+                    continue
+
+                pending.remove(node)
+                name = node[0]
+                node_key = node_name(*node)
+                outputs = outputs_for(node)
+                inputs = inputs_for(node)
+                node_options = options_for(node)
+                key = stage_key(name, outputs, inputs, node_options)
+
+                if resume and is_complete(state.get(node_key), key):
+                    log('skipping ' + node_key + ', already complete')
+                    infos[node] = state[node_key]['info']
+                    done.add(node)
+                    continue
+
+                ### Anything after a rerun stage has to run again
+                state.pop(node_key, None)
+                log('starting ' + node_key)
+                future = pool.submit(run_stage, name, run_dir, outputs, inputs, node_options, node_key)
+                future.started = time.perf_counter()
+                future.key = key
+                running[future] = node
+
+            if not running:
+                if pending and not failed:
+                    continue
+                break
+
+            finished, not_done = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+
+            for future in finished:
+                node = running.pop(future)
+                node_key = node_name(*node)
+                seconds = time.perf_counter() - future.started
+
+                try:
+                    info = future.result()
+                except Exception:
+                    failed.append(node_key)
+                    state[node_key] = {'status': 'failed', 'key': future.key, 'seconds': seconds,
+                                       'error': traceback.format_exc()}
+                    log(node_key + ' failed after ' + str(round(seconds, 1)) + 's, waiting for running stages to stop')
+                else:
+                    infos[node] = info
+                    done.add(node)
+                    state[node_key] = {'status': 'ok', 'key': future.key, 'seconds': seconds,
+                                       'outputs': outputs_for(node),
+                                       'finished_at': pd.Timestamp.now().isoformat(timespec = 'seconds'), 'info': info}
+                    log('finished ' + node_key + ' in ' + str(round(seconds, 1)) + 's')
+
+                save_state(run_dir, state)
+
+    if failed:
+        raise RuntimeError('Stages failed: ' + ', '.join(failed) + '\n' + state[failed[0]]['error'])
+
+    return state
+
+
+def parse_lar_paths(values):
+
+    '''
+    --lar values as a lar_paths dict when they are YEAR=PATH pairs, otherwise the one path
+    '''
+
+    if len(values) == 1 and '=' not in values[0]:
+        return None, values[0]
+
+    lar_paths = {}
+    for value in values:
+        year, separator, path = value.partition('=')
+        if not separator or not year.isdigit():
+            raise ValueError('LAR files for more than one year are given as YEAR=PATH, not ' + repr(value))
+        lar_paths[int(year)] = path
+
+    return lar_paths, None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Run the HMDA pipeline from the raw LAR to the metro and lender '
+                                                   'models, resuming from the last completed stage with --resume')
+    parser.add_argument('--run-dir', default = PIPELINE_DIR, help = 'where the outputs and the state file go')
+    parser.add_argument('--years', type = int, nargs = '+', default = [2019], help = 'the LAR years to process')
+    parser.add_argument('--lar', nargs = '+', default = [LAR_PATH],
+                        help = 'the raw LAR file, or YEAR=PATH for each year when there is more than one')
+    parser.add_argument('--lender', default = LENDER_PATH)
+    parser.add_argument('--counties', default = COUNTIES_PATH)
+    parser.add_argument('--prop-values', default = PROP_VALUES_PATH)
+    parser.add_argument('--tract-race', default = TRACT_RACE_PATH)
+    parser.add_argument('--stages', nargs = '+', default = None,
+                        help = 'run only these stages and the ones they depend on: ' + ', '.join(STAGES))
+    parser.add_argument('--resume', action = 'store_true', help = 'skip stages completed by an earlier run')
+    parser.add_argument('--workers', type = int, default = None, help = 'stages run at the same time')
+    parser.add_argument('--processes', type = int, default = 1, help = 'worker processes for the grouped solver')
+    parser.add_argument('--solver', choices = ['batched', 'grouped'], default = 'batched')
+    parser.add_argument('--chunksize', type = int, default = 1000000)
+    parser.add_argument('--min-lender-apps', type = int, default = MIN_LENDER_APPS)
+    parser.add_argument('--fixed-prop-zscore', action = 'store_true',
+                        help = "use the 2019 notebook's property value z-score parameters for every year")
+    parser.add_argument('--fit-cache', default = None,
+                        help = 'keep the metro and lender fits here and only refit the groups that changed, '
+                               'e.g. ' + FIT_CACHE_DIR)
+    parser.add_argument('--stage-cache', default = None,
+                        help = 'keep the property value measurements here and reuse them while the cleaned data '
+                               'and the code are unchanged, e.g. ' + CACHE_DIR)
+    parser.add_argument('--profile', choices = ['sample', 'cprofile'], default = None)
+    arguments = parser.parse_args()
+
+    try:
+        lar_paths, lar_path = parse_lar_paths(arguments.lar)
+        run_pipeline(arguments.run_dir, arguments.years, arguments.stages, arguments.resume, arguments.workers,
+                     lar_path = lar_path, lar_paths = lar_paths, lender_path = arguments.lender,
+                     counties_path = arguments.counties, prop_values_path = arguments.prop_values,
+                     tract_race_path = arguments.tract_race, chunksize = arguments.chunksize,
+                     solver = arguments.solver, processes = arguments.processes,
+                     min_lender_apps = arguments.min_lender_apps, fixed_prop_zscore = arguments.fixed_prop_zscore,
+                     fit_cache_dir = arguments.fit_cache, stage_cache_dir = arguments.stage_cache,
+                     profile = arguments.profile)
+    except (RuntimeError, ValueError) as error:
+        log(str(error))
+        sys.exit(1)
+
+    sys.exit(0)
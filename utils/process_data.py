@@ -0,0 +1,396 @@
+import os
+import contextlib
+
+import pandas as pd
+import numpy as np
+
+from utils.read_data import LAR_PATH, REMOVE_COLS, read_lar
+from utils.store_data import StageWriter
+from utils.clean_data import (clean_location_series, clean_race_ethnicity_series, find_same_race_series,
+                              clean_credit_model_series, find_coapplicants_series, clean_outcomes_series,
+                              count_aus_patterns, clean_aus_series)
+from utils.categorize_data import (setup_dti_cat_series, categorize_cltv_series, calculate_property_value_ratio,
+                                   calculate_prop_zscore_series, categorize_property_value_ratio_series,
+                                   categorize_age_series, categorize_sex_series, categorize_underwriter_series,
+                                   categorize_loan_term_series, categorize_lmi_series, categorize_diverse_series,
+                                   make_prop_value_bins, accumulate_prop_value_moments, prop_value_params,
+                                   PROP_VALUE_MEAN, PROP_VALUE_STD)
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+LENDER_PATH = os.path.join(DATA_DIR, 'supplemental_hmda_data', 'cleaned', 'lender_definitions_em210513.csv')
+COUNTIES_PATH = os.path.join(DATA_DIR, 'census_data', 'county_to_metro_crosswalk', 'clean',
+                             'all_counties_210804.csv')
+PROP_VALUES_PATH = os.path.join(DATA_DIR, 'census_data', 'property_values',
+                                'ACSDT5Y2019.B25077_data_with_overlays_2021-06-23T115616.csv')
+TRACT_RACE_PATH = os.path.join(DATA_DIR, 'census_data', 'racial_ethnic_demographics', 'clean',
+                               'tract_race_pct2019_210204.csv')
+
+AUS_COLS = ['aus_1', 'aus_2', 'aus_3', 'aus_4', 'aus_5']
+
+### Columns filter_home_purchase looks at
+HOME_PURCHASE_COLS = ['loan_type', 'occupancy_type', 'total_units', 'loan_purpose', 'action_taken',
+                      'construction_method', 'lien_status', 'business_or_commercial_purpose']
+
+
+def load_lender_def(path = LENDER_PATH):
+
+    '''
+    Lender definitions joined on lei
+    '''
+
+    lender_def = pd.read_csv(path, dtype = str)
+
+    return lender_def[['lei', 'lar_count', 'assets', 'lender_def', 'con_apps']].copy()
+
+
+def load_counties(path = COUNTIES_PATH):
+
+    '''
+    County to metro crosswalk joined on state and county fips
+    '''
+
+    counties_df = pd.read_csv(path, dtype = str)
+
+    counties_df2 = counties_df[['fips_state_code', 'fips_county_code', 'metro_code', 'metro_type_def',
+                                'metro_percentile']].copy()
+
+    return counties_df2.rename(columns = {'fips_state_code': 'state_fips', 'fips_county_code': 'county_fips'})
+
+
+def load_prop_values(path = PROP_VALUES_PATH):
+
+    '''
+    Median property value by county, '-' means there is no value for the county
+    '''
+
+    prop_values_df = pd.read_csv(path, dtype = str)
+    prop_values_df = prop_values_df[(prop_values_df['GEO_ID'] != 'id')]
+
+    prop_values_df2 = pd.DataFrame({'state_fips': prop_values_df['GEO_ID'].str[9:11],
+                                    'county_fips': prop_values_df['GEO_ID'].str[11:],
+                                    'median_value': prop_values_df['B25077_001E']})
+
+    prop_values_df2['median_prop_value'] = pd.to_numeric(prop_values_df2['median_value'].replace('-', np.nan))
+
+    return prop_values_df2.reset_index(drop = True)
+
+
+def load_tract_race(path = TRACT_RACE_PATH):
+
+    '''
+    Race and ethnicity percentages per census tract along with the white gradient
+    '''
+
+    race_df = pd.read_csv(path, dtype = str)
+
+    race_df['white_pct'] = pd.to_numeric(race_df['white_pct'])
+    race_df['census_tract'] = race_df['state'] + race_df['county'] + race_df['tract']
+
+    race_df2 = race_df[['census_tract', 'total_estimate', 'white_pct', 'black_pct', 'native_pct', 'latino_pct',
+                        'asian_pct', 'pacislander_pct', 'othercb_pct', 'asiancb_pct']].copy()
+
+    race_df2['diverse_def'] = categorize_diverse_series(race_df2['white_pct'])
+
+    return race_df2
+
+
+def load_references(lender_path = LENDER_PATH, counties_path = COUNTIES_PATH,
+                    prop_values_path = PROP_VALUES_PATH, tract_race_path = TRACT_RACE_PATH, store_dir = None):
+
+    '''
+    Load all the supplemental datasets used to categorize HMDA data
+    With store_dir the census datasets come from the reference store built by reference_data.py
+    instead of being parsed from the CSVs, as the store itself under 'store'
+    '''
+
+    if store_dir is not None:
+        from utils.reference_data import store_references
+
+        references = {'lender_def': load_lender_def(lender_path)}
+        references.update(store_references(store_dir))
+        return references
+
+    return {'lender_def': load_lender_def(lender_path),
+            'counties': load_counties(counties_path),
+            'prop_values': load_prop_values(prop_values_path),
+            'tract_race': load_tract_race(tract_race_path)}
+
+
+def clean_chunk(df):
+
+    '''
+    Everything 1_clean_data does, for one chunk of raw HMDA data
+    '''
+
+    df = df.drop(columns = REMOVE_COLS, errors = 'ignore')
+
+    ### Location
+    location_code = clean_location_series(df['census_tract'], df['county_code'])
+    df['state_fips'] = location_code.str[0:2].replace('--', np.nan)
+    df['county_fips'] = location_code.str[2:5].replace('---', np.nan)
+
+    ### Race and ethnicity
+    df['app_race_ethnicity'] = clean_race_ethnicity_series(df['applicant_race_1'], df['applicant_ethnicity_1'])
+    df['coapp_race_ethnicity'] = clean_race_ethnicity_series(df['co_applicant_race_1'],
+                                                             df['co_applicant_ethnicity_1'], 'coapp_race_ethnicity')
+    df['coapp_same_race'] = find_same_race_series(df['app_race_ethnicity'], df['coapp_race_ethnicity'])
+
+    ### Credit model, co-applicants and outcomes
+    df['app_credit_model'] = clean_credit_model_series(df['applicant_credit_score_type'])
+    df['co_applicant'] = find_coapplicants_series(df['coapp_race_ethnicity'], df['co_applicant_sex'],
+                                                  df['co_applicant_age'], df['co_applicant_credit_score_type'])
+    df['loan_outcome'] = clean_outcomes_series(df['action_taken'])
+
+    ### Automated underwriting systems
+    number_of_values, number_of_nulls = count_aus_patterns(df[AUS_COLS])
+    df['aus_cat'] = clean_aus_series(df['aus_1'], number_of_values, number_of_nulls)
+
+    return df
+
+
+def factorize_with_nulls(values):
+
+    '''
+    pd.factorize with nulls given a code of their own
+    pandas before 1.5 asks for na_sentinel = None, newer versions for use_na_sentinel = False
+    '''
+
+    try:
+        return pd.factorize(values, use_na_sentinel = False)
+    except TypeError:
+        return pd.factorize(values, na_sentinel = None)
+
+
+def factorize_keys(df, on):
+
+    '''
+    One integer code per record for the key columns, plus a frame of the distinct keys in code order
+    Nulls get a code of their own since pd.merge matches null keys to each other
+    '''
+
+    codes, uniques = factorize_with_nulls(df[on[0]])
+    keys = pd.DataFrame({on[0]: uniques})
+
+    for key_col in on[1:]:
+        col_codes, col_uniques = factorize_with_nulls(df[key_col])
+
+        ### Refactorizing the combined codes keeps them small however many key columns there are
+        codes, combined = pd.factorize(codes * len(col_uniques) + col_codes)
+        keys = keys.take(combined // len(col_uniques)).reset_index(drop = True)
+        keys[key_col] = col_uniques.take(combined % len(col_uniques))
+
+    return codes, keys
+
+
+def enrich(df, lookup, on, key_codes = None):
+
+    '''
+    Same columns as pd.merge(df, lookup, how = 'left', on = on) without rebuilding df:
+    the distinct keys are matched to the lookup's rows, then only the lookup's columns are taken for every record
+    The lookup's columns are added to df in place and df is returned, records with no match get nulls
+    Pass key_codes from factorize_keys to reuse them for several lookups on the same keys
+    The lookup needs one row per key and no columns other than its keys that df already has
+    '''
+
+    if key_codes is None:
+        key_codes = factorize_keys(df, on)
+
+    codes, keys = key_codes
+    new_cols = [col for col in lookup.columns if col not in on]
+
+    overlap = [col for col in new_cols if col in df.columns]
+    if overlap:
+        raise ValueError('The lookup has columns the records already have: ' + ', '.join(overlap))
+
+    ### Merging the distinct keys is cheap and matches them with the exact semantics of pd.merge
+    key_rows = pd.merge(keys, lookup[on].assign(lookup_row = np.arange(len(lookup))), how = 'left', on = on)
+
+    if len(key_rows) != len(keys):
+        raise ValueError('The lookup has more than one row for some ' + ', '.join(on))
+
+    rows = key_rows['lookup_row'].fillna(-1).to_numpy(dtype = np.int64)[codes]
+
+    for col in new_cols:
+        df[col] = pd.api.extensions.take(lookup[col].array, rows, allow_fill = True)
+
+    return df
+
+
+def categorize_chunk(df, references, prop_params = None):
+
+    '''
+    Everything 2_categorize_data does before filtering, for one chunk of cleaned HMDA data
+    The new columns are added to df itself
+    prop_params is the property value z-score mean and standard deviation, the 2019 notebook's by default
+    References from the reference store are looked up by integer county and tract keys instead of merged
+    '''
+
+    if prop_params is None:
+        prop_params = {'mean': PROP_VALUE_MEAN, 'standard_deviation': PROP_VALUE_STD}
+
+    store = references.get('store')
+
+    df = enrich(df, references['lender_def'], ['lei'])
+
+    ### Supplemental data, the counties and property values share their keys
+    if store is None:
+        county_codes = factorize_keys(df, ['state_fips', 'county_fips'])
+        df = enrich(df, references['counties'], ['state_fips', 'county_fips'], county_codes)
+        df = enrich(df, references['prop_values'], ['state_fips', 'county_fips'], county_codes)
+    else:
+        df = store.enrich_counties(df)
+
+    df['prop_value'] = pd.to_numeric(df['property_value'].replace('Exempt', np.nan))
+
+    if store is None:
+        df = enrich(df, references['tract_race'], ['census_tract'])
+    else:
+        df = store.enrich_tracts(df)
+    df['diverse_def'] = df['diverse_def'].fillna('0')
+
+    ### Debt-to-income and downpayment
+    df['dti_cat'] = setup_dti_cat_series(df['debt_to_income_ratio'])
+
+    cltv_ratio = pd.to_numeric(df['combined_loan_to_value_ratio'].replace('Exempt', np.nan))
+    df['downpayment_flag'] = categorize_cltv_series(cltv_ratio)
+
+    ### Property value ratio
+    df['property_value_ratio'] = calculate_property_value_ratio(df['prop_value'], df['median_prop_value'])
+    df['prop_zscore'] = calculate_prop_zscore_series(df['property_value_ratio'], prop_params['mean'],
+                                                     prop_params['standard_deviation']).round(3)
+    df['prop_value_cat'] = categorize_property_value_ratio_series(df['property_value_ratio'],
+                                                                  make_prop_value_bins(**prop_params))
+
+    ### Applicant
+    df['applicant_age_cat'] = categorize_age_series(df['applicant_age'])
+
+    df['income'] = pd.to_numeric(df['income'])
+    df['loan_amount'] = pd.to_numeric(df['loan_amount'])
+    df['income_log'] = np.log(df['income'])
+    df['loan_log'] = np.log(df['loan_amount'])
+
+    df['applicant_sex_cat'] = categorize_sex_series(df['applicant_sex'])
+
+    ### The notebook groups aus_1 and aus_cat without dropna, so nulls in either don't get a main aus
+    main_aus = categorize_underwriter_series(df['aus_cat'], df['aus_1'])
+    df['main_aus'] = main_aus.where(df['aus_cat'].notnull() & df['aus_1'].notnull())
+
+    ### Loan term and LMI
+    loan_term = pd.to_numeric(df['loan_term'].replace('Exempt', np.nan))
+    df['mortgage_term'] = categorize_loan_term_series(loan_term)
+
+    tract_msa_ratio = pd.to_numeric(df['tract_to_msa_income_percentage'])
+    df['lmi_def'] = categorize_lmi_series(tract_msa_ratio)
+
+    return df
+
+
+def filter_home_purchase(df):
+
+    '''
+    Conventional and FHA loans that are first-lien, one-to-four unit, site built units for home purchase
+    where the applicant is going to live in that property
+    '''
+
+    one_to_four = ['1', '2', '3', '4']
+
+    return df[((df['loan_type'] == '1') | (df['loan_type'] == '2')) &\
+              (df['occupancy_type'] == '1') &\
+              (df['total_units'].isin(one_to_four)) &\
+              (df['loan_purpose'] == '1') &\
+              (df['action_taken'] != '6') &\
+              (df['construction_method'] == '1') &\
+              (df['lien_status'] == '1') &\
+              (df['business_or_commercial_purpose'] != '1')].copy()
+
+
+def measure_prop_values(chunks, references):
+
+    '''
+    The property value z-score mean and standard deviation for a year of cleaned HMDA data,
+    from the home purchase records' property value ratios
+    '''
+
+    moments = None
+
+    store = references.get('store')
+
+    for chunk in chunks:
+        chunk = filter_home_purchase(chunk)
+        if store is None:
+            chunk = enrich(chunk, references['prop_values'], ['state_fips', 'county_fips'])
+        else:
+            chunk = store.enrich_counties(chunk, crosswalk = False)
+        prop_value = pd.to_numeric(chunk['property_value'].replace('Exempt', np.nan))
+
+        moments = accumulate_prop_value_moments(calculate_property_value_ratio(prop_value, chunk['median_prop_value']),
+                                                moments)
+
+    return prop_value_params(moments)
+
+
+def chunk_stage(manifest, name, rows_in, chunk_number):
+
+    '''
+    A stage record on the run manifest, or nothing when the run isn't instrumented
+    '''
+
+    if manifest is None:
+        return contextlib.nullcontext({})
+
+    return manifest.stage(name, rows_in = rows_in, chunk = chunk_number)
+
+
+def stream_hmda(output_path, lar_path = LAR_PATH, references = None, chunksize = 1000000,
+                clean_output_path = None, columns = None, manifest = None, prop_params = None):
+
+    '''
+    Clean, categorize and filter the raw HMDA data one chunk at a time, appending each chunk to output_path
+    Memory is bounded by the chunk size instead of the national row count
+    Optionally writes the cleaned but unfiltered records to clean_output_path too
+    The raw file is read with the typed LAR schema, columns defaults to every field the notebooks keep
+    Outputs are CSV, Parquet or Arrow IPC depending on the file extension
+    Pass a RunManifest from instrument.py to record the time, memory and rows of every step of every chunk
+    prop_params is the property value z-score mean and standard deviation for a year other than 2019
+    '''
+
+    if references is None:
+        references = load_references()
+
+    rows_in = 0
+    writer = StageWriter(output_path)
+    clean_writer = StageWriter(clean_output_path) if clean_output_path is not None else None
+
+    try:
+        for chunk_number, chunk in enumerate(read_lar(lar_path, columns = columns, chunksize = chunksize)):
+            rows_in += len(chunk)
+
+            with chunk_stage(manifest, 'clean_chunk', len(chunk), chunk_number) as record:
+                clean_df = clean_chunk(chunk)
+                record['rows_out'] = len(clean_df)
+            del chunk
+
+            if clean_writer is not None:
+                clean_writer.write(clean_df)
+
+            with chunk_stage(manifest, 'categorize_chunk', len(clean_df), chunk_number) as record:
+                categorized_df = categorize_chunk(clean_df, references, prop_params)
+                record['rows_out'] = len(categorized_df)
+            del clean_df
+
+            with chunk_stage(manifest, 'filter_home_purchase', len(categorized_df), chunk_number) as record:
+                categorized_df = filter_home_purchase(categorized_df)
+                record['rows_out'] = len(categorized_df)
+
+            with chunk_stage(manifest, 'write_stage', len(categorized_df), chunk_number) as record:
+                writer.write(categorized_df)
+                record['rows_out'] = len(categorized_df)
+
+    finally:
+        writer.close()
+        if clean_writer is not None:
+            clean_writer.close()
+
+    return {'rows_in': rows_in, 'rows_out': writer.rows}
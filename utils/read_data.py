@@ -0,0 +1,130 @@
+import os
+
+import pandas as pd
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+LAR_PATH = os.path.join(DATA_DIR, 'hmda_lar', 'raw_data', '2019_public_lar_csv210810.csv')
+
+
+### Types for every field in the public LAR
+### str: identifiers and geography keys, kept as text so they join to the supplemental data
+### category: coded fields, sentinels like '1111', '8888', '9999' and 'Exempt' stay as their own category
+### float: amounts and ratios, 'Exempt' and 'NA' are parsed as nulls
+LAR_SCHEMA = {'activity_year': 'category', 'lei': 'str', 'derived_msa-md': 'str', 'state_code': 'category',
+              'county_code': 'str', 'census_tract': 'str', 'conforming_loan_limit': 'category',
+              'derived_loan_product_type': 'category', 'derived_dwelling_category': 'category',
+              'derived_ethnicity': 'category', 'derived_race': 'category', 'derived_sex': 'category',
+              'action_taken': 'category', 'purchaser_type': 'category', 'preapproval': 'category',
+              'loan_type': 'category', 'loan_purpose': 'category', 'lien_status': 'category',
+              'reverse_mortgage': 'category', 'open-end_line_of_credit': 'category',
+              'business_or_commercial_purpose': 'category', 'loan_amount': 'float',
+              'combined_loan_to_value_ratio': 'float', 'interest_rate': 'float', 'rate_spread': 'float',
+              'hoepa_status': 'category', 'total_loan_costs': 'float', 'total_points_and_fees': 'float',
+              'origination_charges': 'float', 'discount_points': 'float', 'lender_credits': 'float',
+              'loan_term': 'float', 'prepayment_penalty_term': 'float', 'intro_rate_period': 'float',
+              'negative_amortization': 'category', 'interest_only_payment': 'category',
+              'balloon_payment': 'category', 'other_nonamortizing_features': 'category',
+              'property_value': 'float', 'construction_method': 'category', 'occupancy_type': 'category',
+              'manufactured_home_secured_property_type': 'category',
+              'manufactured_home_land_property_interest': 'category', 'total_units': 'category',
+              'multifamily_affordable_units': 'float', 'income': 'float', 'debt_to_income_ratio': 'category',
+              'applicant_credit_score_type': 'category', 'co_applicant_credit_score_type': 'category',
+              'applicant_ethnicity_1': 'category', 'applicant_ethnicity_2': 'category',
+              'applicant_ethnicity_3': 'category', 'applicant_ethnicity_4': 'category',
+              'applicant_ethnicity_5': 'category', 'co_applicant_ethnicity_1': 'category',
+              'co_applicant_ethnicity_2': 'category', 'co_applicant_ethnicity_3': 'category',
+              'co_applicant_ethnicity_4': 'category', 'co_applicant_ethnicity_5': 'category',
+              'applicant_ethnicity_observed': 'category', 'co_applicant_ethnicity_observed': 'category',
+              'applicant_race_1': 'category', 'applicant_race_2': 'category', 'applicant_race_3': 'category',
+              'applicant_race_4': 'category', 'applicant_race_5': 'category', 'co_applicant_race_1': 'category',
+              'co_applicant_race_2': 'category', 'co_applicant_race_3': 'category',
+              'co_applicant_race_4': 'category', 'co_applicant_race_5': 'category',
+              'applicant_race_observed': 'category', 'co_applicant_race_observed': 'category',
+              'applicant_sex': 'category', 'co_applicant_sex': 'category', 'applicant_sex_observed': 'category',
+              'co_applicant_sex_observed': 'category', 'applicant_age': 'category',
+              'co_applicant_age': 'category', 'applicant_age_above_62': 'category',
+              'co_applicant_age_above_62': 'category', 'submission_of_application': 'category',
+              'initially_payable_to_institution': 'category', 'aus_1': 'category', 'aus_2': 'category',
+              'aus_3': 'category', 'aus_4': 'category', 'aus_5': 'category', 'denial_reason_1': 'category',
+              'denial_reason_2': 'category', 'denial_reason_3': 'category', 'denial_reason_4': 'category',
+              'tract_population': 'float', 'tract_minority_population_percent': 'float',
+              'ffiec_msa_md_median_family_income': 'float', 'tract_to_msa_income_percentage': 'float',
+              'tract_owner_occupied_units': 'float', 'tract_one_to_four_family_homes': 'float',
+              'median_age_of_housing_units': 'float'}
+
+### Text that means "no number" in the amount and ratio fields
+NUMERIC_SENTINELS = ['Exempt', 'NA']
+
+### Columns added by the CFPB and the extra race and ethnicity slots, not using them
+REMOVE_COLS = ['derived_loan_product_type', 'derived_dwelling_category', 'derived_ethnicity',
+               'derived_race', 'derived_sex',
+               'applicant_ethnicity_2','applicant_ethnicity_3', 'applicant_ethnicity_4', 'applicant_ethnicity_5',
+               'co_applicant_ethnicity_2', 'co_applicant_ethnicity_3', 'co_applicant_ethnicity_4',
+               'co_applicant_ethnicity_5',
+               'applicant_race_2','applicant_race_3', 'applicant_race_4', 'applicant_race_5',
+               'co_applicant_race_2', 'co_applicant_race_3', 'co_applicant_race_4',
+               'co_applicant_race_5']
+
+### Every field the notebooks keep
+LAR_COLS = [column for column in LAR_SCHEMA if column not in REMOVE_COLS]
+
+
+def lar_read_options(columns = None):
+
+    '''
+    The usecols, dtype and na_values arguments for read_csv based on the LAR schema
+    '''
+
+    if columns is None:
+        columns = LAR_COLS
+
+    unknown = [column for column in columns if column not in LAR_SCHEMA]
+    if unknown:
+        raise KeyError('Not in the LAR schema: ' + str(unknown))
+
+    dtypes = {}
+    na_values = {}
+
+    for column in columns:
+        field_type = LAR_SCHEMA[column]
+
+        if field_type == 'float':
+            dtypes[column] = 'float64'
+            na_values[column] = NUMERIC_SENTINELS
+        else:
+            ### Coded fields are parsed as text and made categorical after reading, see convert_lar_codes
+            dtypes[column] = 'str'
+
+    return {'usecols': list(columns), 'dtype': dtypes, 'na_values': na_values}
+
+
+def convert_lar_codes(df):
+
+    '''
+    Store the coded fields as categoricals once a block of the LAR is read
+    read_csv builds categoricals from its own internal blocks and fails to combine them when a mostly null field,
+    like aus_2 through aus_5, has no values in one of them
+    '''
+
+    for column in df.columns:
+        if LAR_SCHEMA.get(column) == 'category':
+            df[column] = df[column].astype('category')
+
+    return df
+
+
+def read_lar(path = LAR_PATH, columns = None, chunksize = None):
+
+    '''
+    Read the raw LAR with typed columns, only loading the columns that are needed
+    Returns an iterator of chunks when chunksize is passed
+    '''
+
+    lar_data = pd.read_csv(path, chunksize = chunksize, **lar_read_options(columns))
+
+    if chunksize is None:
+        return convert_lar_codes(lar_data)
+
+    return (convert_lar_codes(chunk) for chunk in lar_data)
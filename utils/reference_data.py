@@ -0,0 +1,460 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import pandas as pd
+import numpy as np
+
+from utils.cache_data import function_source
+from utils.categories import category_dtype
+from utils.process_data import (COUNTIES_PATH, PROP_VALUES_PATH, TRACT_RACE_PATH, load_counties, load_prop_values,
+                                load_tract_race)
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+REFERENCE_DIR = os.path.join(DATA_DIR, 'census_data', 'reference_store')
+
+MANIFEST_FILE = 'reference_store.json'
+
+### FIPS codes never use these, they stand in for null codes so the crosswalk's row with no state or county
+### keeps matching the records with no location, the same as pd.merge matching null keys
+NULL_STATE = 99
+NULL_COUNTY = 999
+NULL_KEY = -1
+
+### Keys that aren't FIPS codes, they match nothing
+BAD_KEY = -2
+
+### Columns each table keeps next to its integer key
+COUNTY_COLS = ['state_fips', 'county_fips', 'metro_code', 'metro_type_def', 'metro_percentile', 'median_value',
+               'median_prop_value', 'in_counties', 'in_prop_values']
+TRACT_COLS = ['census_tract', 'total_estimate', 'white_pct', 'black_pct', 'native_pct', 'latino_pct', 'asian_pct',
+              'pacislander_pct', 'othercb_pct', 'asiancb_pct', 'diverse_def']
+METRO_COLS = ['metro_code', 'metro_name', 'metro_type', 'metro_pop']
+
+### The county table's columns from the crosswalk and from the property values, in load_counties' and
+### load_prop_values' order
+CROSSWALK_COLS = ['metro_code', 'metro_type_def', 'metro_percentile']
+PROP_VALUE_COLS = ['median_value', 'median_prop_value']
+
+### Stores opened by this process, keyed by directory
+_stores = {}
+
+
+def fips_key(values, null_key = NULL_KEY):
+
+    '''
+    Integer codes from FIPS strings, null_key for nulls and BAD_KEY for anything that isn't a number
+    '''
+
+    values = pd.Series(values).astype(object)
+    numbers = pd.to_numeric(values, errors = 'coerce')
+
+    keys = np.where(values.isnull(), null_key, BAD_KEY).astype(np.int64)
+    parsed = numbers.notnull().to_numpy()
+    keys[parsed] = numbers[parsed].to_numpy(dtype = np.int64)
+
+    return keys
+
+
+def county_keys(state_fips, county_fips):
+
+    '''
+    One integer per county, state code times 1000 plus county code
+    '''
+
+    state_keys = fips_key(state_fips, NULL_STATE)
+    county_keys = fips_key(county_fips, NULL_COUNTY)
+
+    return np.where((state_keys == BAD_KEY) | (county_keys == BAD_KEY), BAD_KEY, state_keys * 1000 + county_keys)
+
+
+def tract_keys(census_tract):
+
+    '''
+    One integer per census tract from the 11 digit tract FIPS
+    '''
+
+    return fips_key(census_tract)
+
+
+def check_keys(keys, source, key_name):
+
+    '''
+    Stop the build if the keys repeat or aren't numbers,
+    a store row per key can't reproduce pd.merge repeating records
+    '''
+
+    if (keys == BAD_KEY).any():
+        raise ValueError(source + ' has ' + key_name + ' values that are not numbers')
+    if len(np.unique(keys)) != len(keys):
+        raise ValueError(source + ' has more than one row for some ' + key_name)
+
+
+def build_county_table(counties_path, prop_values_path):
+
+    '''
+    The county crosswalk and median property values, one row per county in either file
+    '''
+
+    counties_df = load_counties(counties_path)
+    prop_values_df = load_prop_values(prop_values_path)
+
+    for source, source_df in [(counties_path, counties_df), (prop_values_path, prop_values_df)]:
+        source_df['key'] = county_keys(source_df['state_fips'], source_df['county_fips'])
+        check_keys(source_df['key'].to_numpy(), source, 'state and county FIPS')
+
+    counties_df['in_counties'] = True
+    prop_values_df['in_prop_values'] = True
+
+    county_df = pd.merge(counties_df, prop_values_df, how = 'outer', on = ['key', 'state_fips', 'county_fips'])
+    county_df['in_counties'] = county_df['in_counties'].fillna(False).astype(bool)
+    county_df['in_prop_values'] = county_df['in_prop_values'].fillna(False).astype(bool)
+
+    return county_df[['key'] + COUNTY_COLS]
+
+
+def build_tract_table(tract_race_path):
+
+    '''
+    Race and ethnicity shares and the white gradient, one row per census tract
+    The gradient is stored as its category codes
+    '''
+
+    race_df = load_tract_race(tract_race_path)
+
+    race_df['key'] = tract_keys(race_df['census_tract'])
+    check_keys(race_df['key'].to_numpy(), tract_race_path, 'census tract')
+
+    race_df['diverse_def'] = race_df['diverse_def'].cat.codes.astype(np.int8)
+
+    return race_df[['key'] + TRACT_COLS]
+
+
+def build_metro_table(counties_path):
+
+    '''
+    Name, type and population of every metro area in the crosswalk, the table the metro notebook builds
+    '''
+
+    counties_df = pd.read_csv(counties_path, dtype = str)
+
+    metros_df = counties_df.groupby(by = ['metro_code', 'metro_name', 'metro_type', 'metro_pop'],
+                                    dropna = False).size().reset_index().drop(columns = [0])
+    metros_df['metro_pop'] = pd.to_numeric(metros_df['metro_pop'])
+
+    metros_df['key'] = fips_key(metros_df['metro_code'])
+    check_keys(metros_df['key'].to_numpy(), counties_path, 'metro code')
+
+    return metros_df[['key'] + METRO_COLS]
+
+
+def write_table(df, path):
+
+    '''
+    Write a table sorted by its key as an uncompressed Arrow IPC file, so it can be memory mapped without copying
+    The file is replaced rather than written over, processes with the old one mapped keep reading it safely
+    '''
+
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df.sort_values(by = 'key', kind = 'mergesort'), preserve_index = False)
+
+    temp_path = path + '.tmp'
+    with pa.OSFile(temp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, path)
+
+
+def build_code_hash():
+
+    '''
+    Hash of the code that builds the store, a store built by older code is stale
+    '''
+
+    return hashlib.sha256(function_source(build_reference_store).encode()).hexdigest()
+
+
+def build_reference_store(store_dir = REFERENCE_DIR, counties_path = COUNTIES_PATH,
+                          prop_values_path = PROP_VALUES_PATH, tract_race_path = TRACT_RACE_PATH):
+
+    '''
+    Compile the census inputs 2_categorize_data and the metro notebook parse into county, tract and metro tables
+    keyed by integer FIPS codes, which any process can memory map
+    '''
+
+    os.makedirs(store_dir, exist_ok = True)
+
+    tables = {'county': build_county_table(counties_path, prop_values_path),
+              'tract': build_tract_table(tract_race_path),
+              'metro': build_metro_table(counties_path)}
+
+    manifest = {'built_at': pd.Timestamp.now().isoformat(timespec = 'seconds'), 'code': build_code_hash(),
+                'sources': {}, 'tables': {}}
+
+    for source in [counties_path, prop_values_path, tract_race_path]:
+        source_stat = os.stat(source)
+        manifest['sources'][os.path.abspath(source)] = {'size': source_stat.st_size,
+                                                        'mtime_ns': source_stat.st_mtime_ns}
+
+    for table_name, table_df in tables.items():
+        write_table(table_df, os.path.join(store_dir, table_name + '.arrow'))
+        manifest['tables'][table_name] = {'rows': len(table_df), 'columns': list(table_df.columns)}
+
+    ### The manifest goes last, a store without one is incomplete
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return manifest
+
+
+class ReferenceStore:
+
+    '''
+    Read only view of a built reference store, each table is memory mapped the first time it is used
+    '''
+
+    def __init__(self, store_dir = REFERENCE_DIR):
+
+        self.store_dir = store_dir
+
+        manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+        if not os.path.isfile(manifest_path):
+            raise FileNotFoundError('No reference store in ' + store_dir + ', build it with build_reference_store')
+
+        with open(manifest_path) as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+        self.tables = {}
+        self.keys = {}
+
+    def table(self, table_name):
+
+        '''
+        The table as an Arrow table backed by the mapped file
+        '''
+
+        if table_name not in self.tables:
+            import pyarrow as pa
+
+            source = pa.memory_map(os.path.join(self.store_dir, table_name + '.arrow'), 'r')
+            self.tables[table_name] = pa.ipc.open_file(source).read_all()
+            self.keys[table_name] = self.tables[table_name].column('key').to_numpy()
+
+        return self.tables[table_name]
+
+    def rows(self, table_name, keys, present_col = None):
+
+        '''
+        Row of the table for every key, -1 where the table has no row
+        With present_col, rows where that flag is false count as missing too
+        '''
+
+        table = self.table(table_name)
+        table_keys = self.keys[table_name]
+        keys = np.asarray(keys, dtype = np.int64)
+
+        if len(table_keys) == 0:
+            return np.full(len(keys), -1)
+
+        positions = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+        found = table_keys[positions] == keys
+
+        if present_col is not None:
+            found &= table.column(present_col).to_numpy()[positions]
+
+        return np.where(found, positions, -1)
+
+    def take(self, table_name, columns, keys, present_col = None):
+
+        '''
+        The columns' values for every key as a frame, nulls where the table has no row
+        Only the rows the keys need are converted to pandas, not the whole table
+        '''
+
+        import pyarrow as pa
+
+        rows = self.rows(table_name, keys, present_col)
+        indices = pa.array(rows, mask = rows < 0)
+
+        return self.frame(table_name, columns, self.table(table_name).select(columns).take(indices))
+
+    def enrich(self, df, table_name, columns, keys, present_col = None):
+
+        '''
+        Add the columns' values for every key to df in place, the keyed counterpart of process_data's enrich
+        '''
+
+        overlap = [col for col in columns if col in df.columns]
+        if overlap:
+            raise ValueError('The reference store has columns the records already have: ' + ', '.join(overlap))
+
+        values = self.take(table_name, columns, keys, present_col)
+        for col in columns:
+            df[col] = values[col].array
+
+        return df
+
+    def enrich_counties(self, df, crosswalk = True, prop_values = True):
+
+        '''
+        Add the crosswalk's and the property values' columns for every record's state and county,
+        the same columns as merging load_counties and load_prop_values on state_fips and county_fips
+        '''
+
+        keys = county_keys(df['state_fips'], df['county_fips'])
+
+        if crosswalk:
+            self.enrich(df, 'county', CROSSWALK_COLS, keys, 'in_counties')
+        if prop_values:
+            self.enrich(df, 'county', PROP_VALUE_COLS, keys, 'in_prop_values')
+
+        return df
+
+    def enrich_tracts(self, df):
+
+        '''
+        Add the race shares and white gradient for every record's census tract,
+        the same columns as merging load_tract_race on census_tract
+        '''
+
+        return self.enrich(df, 'tract', TRACT_COLS[1:], tract_keys(df['census_tract']))
+
+    def frame(self, table_name, columns = None, table = None):
+
+        if table is None:
+            table = self.table(table_name)
+        if columns is not None:
+            table = table.select(columns)
+
+        df = table.to_pandas()
+
+        if 'diverse_def' in df.columns:
+            codes = df['diverse_def'].fillna(-1).to_numpy(dtype = np.int8)
+            df['diverse_def'] = pd.Categorical.from_codes(codes, dtype = category_dtype('diverse_def'))
+
+        return df
+
+    def is_stale(self, paths):
+
+        '''
+        Whether any of the source files changed after the store was built, or the code that builds it did
+        '''
+
+        if self.manifest.get('code') != build_code_hash():
+            return True
+
+        for path in paths:
+            source = self.manifest['sources'].get(os.path.abspath(path))
+            source_stat = os.stat(path)
+
+            if source is None or source['size'] != source_stat.st_size or \
+               source['mtime_ns'] != source_stat.st_mtime_ns:
+                return True
+
+        return False
+
+    def counties(self):
+
+        '''
+        Same frame as load_counties
+        '''
+
+        table = self.table('county')
+        table = table.filter(table.column('in_counties'))
+
+        return self.frame('county', ['state_fips', 'county_fips', 'metro_code', 'metro_type_def',
+                                     'metro_percentile'], table)
+
+    def prop_values(self):
+
+        '''
+        Same frame as load_prop_values
+        '''
+
+        table = self.table('county')
+        table = table.filter(table.column('in_prop_values'))
+
+        return self.frame('county', ['state_fips', 'county_fips', 'median_value', 'median_prop_value'], table)
+
+    def tract_race(self):
+
+        '''
+        Same frame as load_tract_race
+        '''
+
+        return self.frame('tract', TRACT_COLS)
+
+    def metros(self):
+
+        '''
+        The metro code, name, type and population table the metro notebook builds from the crosswalk
+        '''
+
+        return self.frame('metro', METRO_COLS)
+
+
+def open_reference_store(store_dir = REFERENCE_DIR):
+
+    '''
+    The reference store, opened once per process, a rebuilt store is reopened
+    '''
+
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    store_key = (os.path.abspath(store_dir), os.stat(manifest_path).st_mtime_ns if os.path.isfile(manifest_path)
+                 else None)
+
+    if store_key not in _stores:
+        _stores[store_key] = ReferenceStore(store_dir)
+
+    return _stores[store_key]
+
+
+def update_reference_store(store_dir = REFERENCE_DIR, counties_path = COUNTIES_PATH,
+                           prop_values_path = PROP_VALUES_PATH, tract_race_path = TRACT_RACE_PATH):
+
+    '''
+    Build the reference store only if there is none yet or it is stale, returns its manifest
+    '''
+
+    if os.path.isfile(os.path.join(store_dir, MANIFEST_FILE)):
+        store = open_reference_store(store_dir)
+        if not store.is_stale([counties_path, prop_values_path, tract_race_path]):
+            return store.manifest
+
+    return build_reference_store(store_dir, counties_path, prop_values_path, tract_race_path)
+
+
+def store_references(store_dir = REFERENCE_DIR):
+
+    '''
+    The census references for categorize_chunk and measure_prop_values as the reference store itself,
+    they look up every record's county and tract by its integer key instead of merging the frames
+    ReferenceStore.counties, prop_values and tract_race still give the frames the CSV loaders return
+    '''
+
+    return {'store': open_reference_store(store_dir)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Build the memory mapped census reference store')
+    parser.add_argument('--store-dir', default = REFERENCE_DIR)
+    parser.add_argument('--counties', default = COUNTIES_PATH)
+    parser.add_argument('--prop-values', default = PROP_VALUES_PATH)
+    parser.add_argument('--tract-race', default = TRACT_RACE_PATH)
+    parser.add_argument('--force', action = 'store_true', help = 'rebuild the store even if it is up to date')
+    arguments = parser.parse_args()
+
+    build = build_reference_store if arguments.force else update_reference_store
+    manifest = build(arguments.store_dir, arguments.counties, arguments.prop_values, arguments.tract_race)
+
+    for table_name, table in manifest['tables'].items():
+        print(table_name + ': ' + str(table['rows']) + ' rows')
+    sys.exit(0)
@@ -0,0 +1,268 @@
+import os
+
+import pandas as pd
+import numpy as np
+
+from utils.categories import CATEGORY_SCHEMA, apply_category_schema
+from utils.read_data import LAR_SCHEMA
+
+
+### Rows per Parquet row group, small enough that filters on a sorted column skip most of the file
+ROW_GROUP_SIZE = 250000
+
+PARQUET_EXTENSIONS = ['.parquet', '.pq']
+ARROW_EXTENSIONS = ['.arrow', '.feather']
+
+
+def find_stage_format(path):
+
+    '''
+    Pick the on-disk format from the file extension, anything unknown is treated as CSV
+    '''
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in PARQUET_EXTENSIONS:
+        return 'parquet'
+    elif extension in ARROW_EXTENSIONS:
+        return 'arrow'
+    else:
+        return 'csv'
+
+
+def table_from_frame(df):
+
+    '''
+    Convert a dataframe to an Arrow table with stable column types
+    Categoricals become dictionary encoded strings and text columns become strings,
+    so chunks of the same stage always share a schema
+    '''
+
+    import pyarrow as pa
+
+    arrays = []
+
+    for column in df.columns:
+        values = df[column]
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            array = pa.array(values.astype(object), type = pa.string(), from_pandas = True).dictionary_encode()
+        elif values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            array = pa.array(values.astype(object), type = pa.string(), from_pandas = True)
+        else:
+            array = pa.array(values, from_pandas = True)
+
+        arrays.append(array)
+
+    return pa.Table.from_arrays(arrays, names = [str(column) for column in df.columns])
+
+
+def stage_schema(schema, dictionaries = True):
+
+    '''
+    The schema every chunk of a stage is written with, fixed before the first chunk
+    Derived categories and the LAR's coded fields are strings, dictionary encoded unless dictionaries is False,
+    the LAR's text and numeric fields keep their schema types, and other integer columns are widened to floats
+    since a later chunk can have nulls in them
+    '''
+
+    import pyarrow as pa
+
+    string_type = pa.dictionary(pa.int32(), pa.string()) if dictionaries else pa.string()
+    fields = []
+
+    for field in schema:
+        lar_type = LAR_SCHEMA.get(field.name)
+
+        if field.name in CATEGORY_SCHEMA or lar_type == 'category':
+            field_type = string_type
+        elif lar_type == 'str':
+            field_type = pa.string()
+        elif lar_type == 'float' or pa.types.is_integer(field.type):
+            field_type = pa.float64()
+        elif pa.types.is_dictionary(field.type):
+            field_type = string_type
+        else:
+            field_type = field.type
+
+        fields.append(pa.field(field.name, field_type))
+
+    return pa.schema(fields)
+
+
+def write_stage(df, path, sort_by = None, row_group_size = ROW_GROUP_SIZE):
+
+    '''
+    Write a stage output as CSV, Parquet or Arrow IPC depending on the extension
+    Sorting by the column downstream notebooks filter on (metro_code, lei) makes Parquet filters skip row groups
+    '''
+
+    if sort_by is not None:
+        df = df.sort_values(by = sort_by, kind = 'mergesort')
+
+    stage_format = find_stage_format(path)
+
+    if stage_format == 'csv':
+        df.to_csv(path, index = False)
+        return
+
+    table = table_from_frame(df)
+
+    if stage_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, path, row_group_size = row_group_size, compression = 'zstd')
+
+    elif stage_format == 'arrow':
+        import pyarrow.feather as feather
+        feather.write_feather(table, path, compression = 'zstd')
+
+
+def filter_frame(df, filters):
+
+    '''
+    Apply read_parquet style filters, a list of (column, op, value) tuples or a list of those lists for an OR
+    '''
+
+    if not filters:
+        return df
+
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    operations = {'==': lambda col, value: col == value,
+                  '=': lambda col, value: col == value,
+                  '!=': lambda col, value: col != value,
+                  '<': lambda col, value: col < value,
+                  '<=': lambda col, value: col <= value,
+                  '>': lambda col, value: col > value,
+                  '>=': lambda col, value: col >= value,
+                  'in': lambda col, value: col.isin(value),
+                  'not in': lambda col, value: ~col.isin(value)}
+
+    keep = np.zeros(len(df), dtype = bool)
+
+    for conjunction in filters:
+        conjunction_keep = np.ones(len(df), dtype = bool)
+
+        for column, operation, value in conjunction:
+            conjunction_keep &= np.asarray(operations[operation](df[column], value), dtype = bool)
+
+        keep |= conjunction_keep
+
+    return df[keep].reset_index(drop = True)
+
+
+def read_stage(path, columns = None, filters = None):
+
+    '''
+    Read a stage output, only loading the columns asked for
+    Parquet pushes the filters down to the row groups, CSV and Arrow files are filtered after reading
+    CSV is read as text, same as the notebooks, and in every format the derived category columns get their
+    fixed categories back
+    '''
+
+    stage_format = find_stage_format(path)
+
+    if stage_format == 'parquet':
+        import pyarrow.parquet as pq
+        return apply_category_schema(pq.read_table(path, columns = columns, filters = filters).to_pandas())
+
+    elif stage_format == 'arrow':
+        import pyarrow.feather as feather
+        df = feather.read_table(path, columns = columns).to_pandas()
+
+    else:
+        df = pd.read_csv(path, dtype = str, usecols = columns)
+
+    return apply_category_schema(filter_frame(df, filters))
+
+
+def iter_stage(path, columns = None, chunksize = ROW_GROUP_SIZE):
+
+    '''
+    Read a stage output a chunk at a time, for passes over data that doesn't fit in memory
+    '''
+
+    stage_format = find_stage_format(path)
+
+    if stage_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = chunksize, columns = columns):
+            yield apply_category_schema(batch.to_pandas())
+
+    elif stage_format == 'arrow':
+        import pyarrow as pa
+
+        ### Record batches are the chunks the file was written in
+        with pa.memory_map(path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for batch_number in range(reader.num_record_batches):
+                batch = reader.get_batch(batch_number)
+                if columns is not None:
+                    batch = batch.select(columns)
+                yield apply_category_schema(batch.to_pandas())
+
+    else:
+        for chunk in pd.read_csv(path, dtype = str, usecols = columns, chunksize = chunksize):
+            yield apply_category_schema(chunk)
+
+
+class StageWriter:
+
+    '''
+    Append chunks of a stage output to one file, used when streaming
+    '''
+
+    def __init__(self, path, row_group_size = ROW_GROUP_SIZE):
+
+        self.path = path
+        self.row_group_size = row_group_size
+        self.stage_format = find_stage_format(path)
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+
+    def write(self, df):
+
+        if self.stage_format == 'csv':
+            df.to_csv(self.path, mode = 'w' if self.rows == 0 else 'a', header = self.rows == 0, index = False)
+
+        else:
+            table = table_from_frame(df)
+
+            if self.writer is None:
+                import pyarrow as pa
+
+                if self.stage_format == 'parquet':
+                    import pyarrow.parquet as pq
+                    self.schema = stage_schema(table.schema)
+                    self.writer = pq.ParquetWriter(self.path, self.schema, compression = 'zstd')
+
+                else:
+                    ### Arrow IPC files allow one dictionary per column, every chunk has its own categories,
+                    ### so chunked Arrow files store the categories as plain strings
+                    self.schema = stage_schema(table.schema, dictionaries = False)
+                    self.writer = pa.ipc.new_file(self.path, self.schema,
+                                                  options = pa.ipc.IpcWriteOptions(compression = 'zstd'))
+
+            table = table.select(self.schema.names).cast(self.schema)
+
+            if self.stage_format == 'parquet':
+                self.writer.write_table(table, row_group_size = self.row_group_size)
+            else:
+                self.writer.write_table(table)
+
+        self.rows += len(df)
+
+    def close(self):
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
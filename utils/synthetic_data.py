@@ -0,0 +1,342 @@
+import os
+
+import pandas as pd
+import numpy as np
+
+from utils.read_data import LAR_SCHEMA
+from utils.process_data import load_lender_def, load_counties, load_prop_values
+
+
+### Census tracts made up for every county, the synthetic tract race table covers the same tracts
+TRACTS_PER_COUNTY = 20
+
+### Coded fields, their values and roughly how often each shows up in the 2019 public LAR
+### Sentinels like '1111' (exempt), '8888' and '9999' (not applicable) are included where the LAR has them
+CODED_FIELDS = {
+    'conforming_loan_limit': (['C', 'NC', 'U', 'NA'], [0.93, 0.04, 0.01, 0.02]),
+    'action_taken': (['1', '2', '3', '4', '5', '6', '7', '8'], [0.52, 0.02, 0.12, 0.08, 0.03, 0.22, 0.005, 0.005]),
+    'purchaser_type': (['0', '1', '2', '3', '4', '5', '6', '71', '72', '8', '9'],
+                       [0.45, 0.15, 0.08, 0.12, 0.01, 0.01, 0.05, 0.03, 0.02, 0.03, 0.05]),
+    'preapproval': (['1', '2'], [0.05, 0.95]),
+    'loan_type': (['1', '2', '3', '4'], [0.78, 0.13, 0.07, 0.02]),
+    'loan_purpose': (['1', '2', '31', '32', '4', '5'], [0.38, 0.08, 0.28, 0.17, 0.07, 0.02]),
+    'lien_status': (['1', '2'], [0.9, 0.1]),
+    'reverse_mortgage': (['1', '2', '1111'], [0.005, 0.98, 0.015]),
+    'open-end_line_of_credit': (['1', '2', '1111'], [0.08, 0.9, 0.02]),
+    'business_or_commercial_purpose': (['1', '2', '1111'], [0.03, 0.95, 0.02]),
+    'hoepa_status': (['1', '2', '3'], [0.001, 0.6, 0.399]),
+    'negative_amortization': (['1', '2', '1111'], [0.001, 0.98, 0.019]),
+    'interest_only_payment': (['1', '2', '1111'], [0.01, 0.97, 0.02]),
+    'balloon_payment': (['1', '2', '1111'], [0.01, 0.97, 0.02]),
+    'other_nonamortizing_features': (['1', '2', '1111'], [0.001, 0.98, 0.019]),
+    'construction_method': (['1', '2'], [0.96, 0.04]),
+    'occupancy_type': (['1', '2', '3'], [0.88, 0.04, 0.08]),
+    'manufactured_home_secured_property_type': (['1', '2', '3', '1111'], [0.01, 0.01, 0.96, 0.02]),
+    'manufactured_home_land_property_interest': (['1', '2', '3', '4', '5', '1111'],
+                                                 [0.005, 0.005, 0.003, 0.002, 0.965, 0.02]),
+    'total_units': (['1', '2', '3', '4', '5-24', '25-49', '50-99', '100-149', '>149'],
+                    [0.95, 0.02, 0.005, 0.005, 0.012, 0.003, 0.002, 0.001, 0.002]),
+    'debt_to_income_ratio': (['<20%', '20%-<30%', '30%-<36%', '36', '37', '38', '39', '40', '41', '42', '43', '44',
+                              '45', '46', '47', '48', '49', '50%-60%', '>60%', 'Exempt', 'NA'],
+                             [0.06, 0.12, 0.11, 0.025, 0.025, 0.025, 0.025, 0.025, 0.025, 0.025, 0.025, 0.025,
+                              0.02, 0.02, 0.02, 0.02, 0.02, 0.06, 0.03, 0.02, 0.25]),
+    'applicant_credit_score_type': (['1', '2', '3', '4', '5', '6', '7', '8', '9', '1111'],
+                                    [0.3, 0.08, 0.05, 0.01, 0.005, 0.005, 0.07, 0.2, 0.25, 0.03]),
+    'co_applicant_credit_score_type': (['1', '2', '3', '7', '8', '9', '10', '1111'],
+                                       [0.12, 0.03, 0.02, 0.02, 0.05, 0.15, 0.58, 0.03]),
+    'applicant_ethnicity_1': (['1', '11', '12', '13', '14', '2', '3', '4', None],
+                              [0.05, 0.03, 0.005, 0.005, 0.01, 0.7, 0.19, 0.009, 0.001]),
+    'co_applicant_ethnicity_1': (['1', '11', '2', '3', '4', '5', None], [0.02, 0.01, 0.33, 0.05, 0.005, 0.58, 0.005]),
+    'applicant_ethnicity_observed': (['1', '2', '3'], [0.03, 0.77, 0.2]),
+    'co_applicant_ethnicity_observed': (['1', '2', '3', '4'], [0.01, 0.35, 0.06, 0.58]),
+    'applicant_race_1': (['1', '2', '21', '22', '23', '24', '25', '26', '27', '3', '4', '41', '5', '6', '7', None],
+                         [0.008, 0.03, 0.008, 0.005, 0.004, 0.004, 0.003, 0.005, 0.003, 0.07, 0.002, 0.001, 0.64,
+                          0.19, 0.005, 0.017]),
+    'co_applicant_race_1': (['1', '2', '3', '4', '5', '6', '7', '8', None],
+                            [0.003, 0.015, 0.02, 0.001, 0.3, 0.06, 0.001, 0.58, 0.02]),
+    'applicant_race_observed': (['1', '2', '3'], [0.03, 0.77, 0.2]),
+    'co_applicant_race_observed': (['1', '2', '3', '4'], [0.01, 0.35, 0.06, 0.58]),
+    'applicant_sex': (['1', '2', '3', '4', '6'], [0.6, 0.25, 0.12, 0.02, 0.01]),
+    'co_applicant_sex': (['1', '2', '3', '4', '5', '6'], [0.05, 0.3, 0.05, 0.02, 0.575, 0.005]),
+    'applicant_sex_observed': (['1', '2', '3'], [0.03, 0.77, 0.2]),
+    'co_applicant_sex_observed': (['1', '2', '3', '4'], [0.01, 0.35, 0.06, 0.58]),
+    'applicant_age': (['<25', '25-34', '35-44', '45-54', '55-64', '65-74', '>74', '8888'],
+                      [0.04, 0.18, 0.2, 0.18, 0.15, 0.08, 0.03, 0.14]),
+    'co_applicant_age': (['<25', '25-34', '35-44', '45-54', '55-64', '65-74', '>74', '8888', '9999'],
+                         [0.01, 0.07, 0.08, 0.08, 0.07, 0.04, 0.01, 0.06, 0.58]),
+    'applicant_age_above_62': (['Yes', 'No', 'NA'], [0.2, 0.66, 0.14]),
+    'co_applicant_age_above_62': (['Yes', 'No', 'NA'], [0.08, 0.28, 0.64]),
+    'submission_of_application': (['1', '2', '3', '1111'], [0.75, 0.03, 0.2, 0.02]),
+    'initially_payable_to_institution': (['1', '2', '3', '1111'], [0.65, 0.13, 0.2, 0.02]),
+    'aus_1': (['1', '2', '3', '4', '5', '6', '7', '1111'], [0.42, 0.14, 0.06, 0.02, 0.02, 0.3, 0.01, 0.03]),
+    'denial_reason_1': (['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '1111'],
+                        [0.03, 0.03, 0.03, 0.02, 0.01, 0.005, 0.02, 0.005, 0.02, 0.8, 0.03])}
+
+### Amount and ratio fields, the share of 'Exempt' and 'NA' values in each
+NUMERIC_SENTINEL_SHARES = {'combined_loan_to_value_ratio': (0.02, 0.25), 'interest_rate': (0.02, 0.3),
+                           'rate_spread': (0.02, 0.45), 'total_loan_costs': (0.02, 0.5),
+                           'total_points_and_fees': (0.02, 0.95), 'origination_charges': (0.02, 0.5),
+                           'discount_points': (0.02, 0.7), 'lender_credits': (0.02, 0.7), 'loan_term': (0.02, 0.02),
+                           'prepayment_penalty_term': (0.02, 0.95), 'intro_rate_period': (0.02, 0.9),
+                           'property_value': (0.02, 0.1), 'multifamily_affordable_units': (0.02, 0.97),
+                           'income': (0.0, 0.12)}
+
+
+def choose_codes(rng, rows, values, weights):
+
+    '''
+    Draw coded values with the given weights, None becomes a blank
+    '''
+
+    weights = np.asarray(weights, dtype = float)
+    codes = np.asarray(values, dtype = object)[rng.choice(len(values), size = rows, p = weights/weights.sum())]
+
+    return codes
+
+
+def add_sentinels(rng, values, exempt_share, na_share):
+
+    '''
+    Replace a share of the numbers with 'Exempt' and 'NA', same as the public LAR
+    '''
+
+    values = np.asarray(values, dtype = object)
+    draw = rng.random(len(values))
+
+    values[draw < exempt_share] = 'Exempt'
+    values[(draw >= exempt_share) & (draw < exempt_share + na_share)] = 'NA'
+
+    return values
+
+
+def format_numbers(values, decimals = 0):
+
+    '''
+    Numbers written the way the LAR writes them, integers without a decimal point
+    '''
+
+    if decimals == 0:
+        return np.round(values).astype(np.int64).astype(str).astype(object)
+
+    return np.round(values, decimals).astype(str).astype(object)
+
+
+def make_tract_universe(counties):
+
+    '''
+    Made up census tracts for every county in the crosswalk, as state and county fips plus a six digit tract
+    '''
+
+    counties = counties.dropna(subset = ['state_fips', 'county_fips'])
+    county_codes = (counties['state_fips'] + counties['county_fips']).unique()
+
+    tract_numbers = np.array(['%06d' % ((position + 1) * 100) for position in range(TRACTS_PER_COUNTY)], dtype = object)
+
+    return np.repeat(np.asarray(county_codes, dtype = object), TRACTS_PER_COUNTY) + \
+           np.tile(tract_numbers, len(county_codes))
+
+
+def make_synthetic_tract_race(counties, seed = 0):
+
+    '''
+    A tract race table with the columns load_tract_race reads, for the made up tracts
+    The 2019 tract race file isn't in the repo, so the synthetic pipeline uses this instead
+    '''
+
+    rng = np.random.default_rng(seed)
+    tracts = make_tract_universe(counties)
+    rows = len(tracts)
+
+    white_pct = format_numbers(rng.beta(2.5, 1.2, rows) * 100, 1)
+    white_pct[rng.random(rows) < 0.01] = np.nan
+
+    race_df = pd.DataFrame({'state': [tract[:2] for tract in tracts],
+                            'county': [tract[2:5] for tract in tracts],
+                            'tract': [tract[5:] for tract in tracts],
+                            'total_estimate': format_numbers(rng.integers(500, 8000, rows))})
+    race_df['white_pct'] = white_pct
+
+    for column in ['black_pct', 'native_pct', 'latino_pct', 'asian_pct', 'pacislander_pct', 'othercb_pct',
+                   'asiancb_pct']:
+        race_df[column] = format_numbers(rng.beta(0.6, 6, rows) * 100, 1)
+
+    return race_df
+
+
+def make_synthetic_lar(rows, seed = 0, lender_def = None, counties = None, prop_values = None):
+
+    '''
+    A synthetic public LAR with every field in the LAR schema, written as text the way the CSV is
+    Lenders, counties and property values come from the supplemental data in the repo,
+    so the records join to them like the real LAR does
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    if lender_def is None:
+        lender_def = load_lender_def()
+    if counties is None:
+        counties = load_counties()
+    if prop_values is None:
+        prop_values = load_prop_values()
+
+    lar = {'activity_year': np.full(rows, '2019', dtype = object)}
+
+    ### Bigger lenders file more applications
+    lar_count = pd.to_numeric(lender_def['lar_count'], errors = 'coerce').fillna(1).clip(lower = 1).values
+    lar['lei'] = lender_def['lei'].values[rng.choice(len(lender_def), size = rows, p = lar_count/lar_count.sum())]
+
+    ### Geography, with the missing and malformed codes 1_clean_data handles
+    ### Most applications are in metro areas, so tracts in metro counties are drawn more often
+    tracts = make_tract_universe(counties)
+    metro_counties = counties.dropna(subset = ['state_fips', 'county_fips', 'metro_code'])
+    in_metro = pd.Index(tracts.astype(str)).str[:5].isin(metro_counties['state_fips'] + metro_counties['county_fips'])
+    tract_weights = np.where(in_metro, 15.0, 1.0)
+    census_tract = tracts[rng.choice(len(tracts), size = rows, p = tract_weights/tract_weights.sum())]
+    county_code = np.array([tract[:5] for tract in census_tract], dtype = object)
+
+    geo_draw = rng.random(rows)
+    census_tract[geo_draw < 0.02] = 'NA'
+    county_code[geo_draw < 0.01] = 'NA'
+
+    lar['state_code'] = np.array([code[:2] if code != 'NA' else 'NA' for code in county_code], dtype = object)
+    lar['county_code'] = county_code
+    lar['census_tract'] = census_tract
+    lar['derived_msa-md'] = np.full(rows, '99999', dtype = object)
+
+    for field, values in [('derived_loan_product_type', ['Conventional:First Lien', 'FHA:First Lien',
+                                                         'Conventional:Subordinate Lien', 'VA:First Lien']),
+                          ('derived_dwelling_category', ['Single Family (1-4 Units):Site-Built',
+                                                         'Single Family (1-4 Units):Manufactured']),
+                          ('derived_ethnicity', ['Not Hispanic or Latino', 'Hispanic or Latino',
+                                                 'Ethnicity Not Available', 'Joint']),
+                          ('derived_race', ['White', 'Black or African American', 'Asian', 'Race Not Available',
+                                            'Joint']),
+                          ('derived_sex', ['Male', 'Female', 'Joint', 'Sex Not Available'])]:
+        lar[field] = choose_codes(rng, rows, values, np.ones(len(values)))
+
+    for field, (values, weights) in CODED_FIELDS.items():
+        lar[field] = choose_codes(rng, rows, values, weights)
+
+    ### Applications without a co-applicant have the no co-applicant code in every co-applicant field
+    no_coapplicant = (lar['co_applicant_race_1'] == '8') | (lar['co_applicant_sex'] == '5') | \
+                     (lar['co_applicant_age'] == '9999')
+    for field, code in [('co_applicant_race_1', '8'), ('co_applicant_ethnicity_1', '5'), ('co_applicant_sex', '5'),
+                        ('co_applicant_age', '9999'), ('co_applicant_credit_score_type', '10'),
+                        ('co_applicant_ethnicity_observed', '4'), ('co_applicant_race_observed', '4'),
+                        ('co_applicant_sex_observed', '4'), ('co_applicant_age_above_62', 'NA')]:
+        lar[field][no_coapplicant] = code
+
+    ### Amounts, loan amounts are reported at the midpoint of a 10,000 dollar range
+    loan_amount = np.floor(rng.lognormal(np.log(220000), 0.7, rows)/10000) * 10000 + 5000
+    lar['loan_amount'] = format_numbers(loan_amount)
+
+    ### Property values sit around the county median, so the property value ratio looks like the real one
+    county_median = pd.Series(prop_values['median_prop_value'].values,
+                              index = prop_values['state_fips'] + prop_values['county_fips'])
+    county_median = county_median[~county_median.index.duplicated()]
+    median_value = county_median.reindex(county_code).fillna(200000).values
+
+    property_value = np.floor(median_value * rng.lognormal(np.log(1.3), 0.6, rows)/10000) * 10000 + 5000
+    lar['property_value'] = format_numbers(property_value)
+
+    cltv = np.clip(loan_amount/property_value * 100 * rng.uniform(0.9, 1.1, rows), 1, 150)
+    lar['combined_loan_to_value_ratio'] = format_numbers(cltv, 3)
+
+    income = np.round(loan_amount/1000/rng.uniform(2, 5, rows))
+    income[rng.random(rows) < 0.005] *= -1
+    lar['income'] = format_numbers(income)
+
+    lar['interest_rate'] = format_numbers(rng.normal(4.2, 0.6, rows), 3)
+    lar['rate_spread'] = format_numbers(rng.normal(0.3, 0.5, rows), 3)
+    lar['total_loan_costs'] = format_numbers(rng.gamma(2, 2500, rows), 2)
+    lar['total_points_and_fees'] = format_numbers(rng.gamma(2, 1500, rows), 2)
+    lar['origination_charges'] = format_numbers(rng.gamma(2, 1000, rows), 2)
+    lar['discount_points'] = format_numbers(rng.gamma(1.5, 1000, rows), 2)
+    lar['lender_credits'] = format_numbers(rng.gamma(1.5, 500, rows), 2)
+    lar['loan_term'] = choose_codes(rng, rows, ['360', '180', '240', '120', '300', '480'],
+                                    [0.82, 0.1, 0.03, 0.02, 0.02, 0.01])
+    lar['prepayment_penalty_term'] = choose_codes(rng, rows, ['12', '24', '36', '60'], [0.3, 0.3, 0.3, 0.1])
+    lar['intro_rate_period'] = choose_codes(rng, rows, ['60', '84', '120'], [0.5, 0.3, 0.2])
+    lar['multifamily_affordable_units'] = format_numbers(rng.integers(0, 100, rows))
+
+    for field, (exempt_share, na_share) in NUMERIC_SENTINEL_SHARES.items():
+        lar[field] = add_sentinels(rng, lar[field], exempt_share, na_share)
+
+    ### Up to five AUS per application, most have one
+    aus_count = choose_codes(rng, rows, [1, 2, 3, 4, 5], [0.88, 0.08, 0.025, 0.01, 0.005]).astype(int)
+    aus_values = ['1', '2', '3', '4', '5', '7']
+    for position in range(2, 6):
+        extra_aus = choose_codes(rng, rows, aus_values, [0.5, 0.3, 0.1, 0.05, 0.03, 0.02])
+        lar['aus_' + str(position)] = np.where(aus_count >= position, extra_aus, None)
+
+    for position in range(2, 5):
+        lar['denial_reason_' + str(position)] = np.where(rng.random(rows) < 0.03,
+                                                         choose_codes(rng, rows, ['1', '3', '4'], [1, 1, 1]), None)
+
+    ### Extra race and ethnicity slots are almost always blank
+    for prefix in ['applicant_ethnicity_', 'co_applicant_ethnicity_', 'applicant_race_', 'co_applicant_race_']:
+        for position in range(2, 6):
+            lar[prefix + str(position)] = np.where(rng.random(rows) < 0.01, '5', None)
+
+    ### Tract level fields come from the FFIEC census file, the same for every record in a tract
+    tract_codes, tract_index = np.unique(census_tract, return_inverse = True)
+    tract_rng = np.random.default_rng(seed + 1)
+    tract_fields = {'tract_population': format_numbers(tract_rng.integers(1000, 9000, len(tract_codes))),
+                    'tract_minority_population_percent': format_numbers(tract_rng.beta(1, 2.5, len(tract_codes))
+                                                                        * 100, 2),
+                    'ffiec_msa_md_median_family_income': format_numbers(tract_rng.integers(50, 120,
+                                                                                           len(tract_codes)) * 1000),
+                    'tract_to_msa_income_percentage': format_numbers(tract_rng.gamma(8, 13, len(tract_codes)), 0),
+                    'tract_owner_occupied_units': format_numbers(tract_rng.integers(100, 3000, len(tract_codes))),
+                    'tract_one_to_four_family_homes': format_numbers(tract_rng.integers(200, 4000,
+                                                                                        len(tract_codes))),
+                    'median_age_of_housing_units': format_numbers(tract_rng.integers(5, 80, len(tract_codes)))}
+
+    for field, values in tract_fields.items():
+        lar[field] = values[tract_index]
+
+    return pd.DataFrame(lar)[list(LAR_SCHEMA)]
+
+
+def write_synthetic_lar(path, rows, seed = 0, chunksize = 1000000):
+
+    '''
+    Write a synthetic LAR CSV a chunk at a time, so 10 million records don't have to fit in memory
+    Returns the tract race table for the made up tracts, pass it to load_references through a CSV
+    '''
+
+    lender_def = load_lender_def()
+    counties = load_counties()
+    prop_values = load_prop_values()
+
+    written = 0
+    chunk_number = 0
+
+    while written < rows:
+        chunk_rows = min(chunksize, rows - written)
+        chunk = make_synthetic_lar(chunk_rows, seed + chunk_number * 7919, lender_def, counties, prop_values)
+
+        chunk.to_csv(path, mode = 'w' if written == 0 else 'a', header = written == 0, index = False)
+
+        written += chunk_rows
+        chunk_number += 1
+
+    return make_synthetic_tract_race(counties, seed)
+
+
+def write_synthetic_data(output_dir, rows, seed = 0, chunksize = 1000000):
+
+    '''
+    Write a synthetic LAR and tract race file to output_dir, returns their paths
+    '''
+
+    os.makedirs(output_dir, exist_ok = True)
+
+    lar_path = os.path.join(output_dir, 'synthetic_lar_' + str(rows) + '.csv')
+    tract_race_path = os.path.join(output_dir, 'synthetic_tract_race.csv')
+
+    race_df = write_synthetic_lar(lar_path, rows, seed, chunksize)
+    race_df.to_csv(tract_race_path, index = False)
+
+    return {'lar_path': lar_path, 'tract_race_path': tract_race_path}
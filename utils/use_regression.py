@@ -1,29 +1,71 @@
+import os
+import pickle
+import hashlib
+import inspect
+import tempfile
+import multiprocessing
+
 import pandas as pd
 import numpy as np
 
+import statsmodels
 import statsmodels.formula.api as smf
+from statsmodels.tools.sm_exceptions import PerfectSeparationError
 
-from sklearn.metrics import confusion_matrix, accuracy_score
+from sklearn.model_selection import StratifiedKFold, train_test_split
 from functools import reduce
 from tqdm import tqdm
 
+from utils.cache_data import CACHE_DIR, hash_value, evict_cache
+
+
+### Fitted models saved by group, variables, solver options and data, see cached_fit
+FIT_CACHE_DIR = os.path.join(CACHE_DIR, 'fits')
+
+### Evict the least recently used fits once the fit cache is bigger than this
+MAX_FIT_CACHE_BYTES = 1024 ** 3
+
+### What Logit.fit raises once every fitted probability matches its outcome, the batched fit reports the same
+SEPARATION_MESSAGE = 'Perfect separation detected, results not available'
+
+### Records refit exactly and binned to measure how much binning changes a compressed fit
+BINNING_ERROR_SAMPLE = 100000
+
 
 
-def create_dummy_vars(df, columns):
+def create_dummy_vars(df, columns, dtype = np.int8):
     '''
     Create dummy variables based on values being isolated in the list of dict being passed
+    A dummy is 0 when the column's value is in its list and 1 when it isn't
+    columns can also be a list of those dicts, like regression_cols in the notebooks
+    Each column is factorized once and every dummy is read off its unique values, stored as int8
+    A column's dummies are written before the next column is read, so later columns can use earlier dummies
     '''
     
+    if isinstance(columns, dict):
+        columns = [columns]
     
-    for column in columns:
-        dummy_vars = columns[column]
-        
-        for dummy_var in dummy_vars:
+    for column_spec in columns:
+        for column in column_spec:
+            dummy_vars = column_spec[column]
             
-            var_value = dummy_vars[dummy_var]
-
-            df.loc[(df[column].isin(var_value)), dummy_var] = 0
-            df.loc[~(df[column].isin(var_value)), dummy_var] = 1
+            codes, uniques = pd.factorize(df[column])
+            uniques = pd.Index(uniques)
+            
+            dummy_block = {}
+            
+            for dummy_var in dummy_vars:
+                
+                var_value = dummy_vars[dummy_var]
+                
+                ### One entry per unique value plus a last one for nulls, which codes marks with -1
+                null_match = bool(pd.Series([np.nan]).isin(var_value)[0])
+                lookup = np.append(~uniques.isin(var_value), not null_match).astype(dtype)
+                
+                dummy_block[dummy_var] = lookup[codes]
+            
+            if dummy_block:
+                df[list(dummy_block)] = pd.DataFrame(dummy_block, index = df.index)
     
     return df
     
@@ -39,22 +81,218 @@ def create_formula(independent_vars):
     return regression_formula
     
 
-def run_regression(data, formula):
+def run_regression(data, formula, compress = False, bins = None, error_sample = BINNING_ERROR_SAMPLE):
     '''
     use statsmodel to run regression
+    compress fits the same model on the unique covariate patterns instead of every record, see CompressedLogit
     '''
     
+    if compress or bins:
+        return CompressedLogit(data = data, formula = formula, bins = bins, error_sample = error_sample)
+    
     model = smf.logit(data = data, formula = formula)
     
     return model
     
     
+def design_matrix(df, independent_vars, dependent_var = 'denied', dtype = np.float64):
+    '''
+    Build the outcome and a contiguous design matrix with an intercept straight from the columns, no formula parsing
+    Records with a null in any of the variables are dropped, same as a formula fit
+    Pass dtype = np.float32 to halve the memory, build it once and fit slices of it with fit_design
+    '''
+    
+    independent_vars = list(independent_vars)
+    keep = df[[dependent_var] + independent_vars].notnull().all(axis = 1).to_numpy()
+    
+    ### Filled one column at a time so the frame is copied once, straight into the matrix
+    exog = np.empty((int(keep.sum()), len(independent_vars) + 1), dtype = dtype)
+    exog[:, 0] = 1
+    for position, var in enumerate(independent_vars):
+        exog[:, position + 1] = df[var].to_numpy(dtype = float)[keep]
+        
+    endog = df[dependent_var].to_numpy(dtype = float)[keep]
+    
+    return {'endog': endog, 'exog': exog, 'names': ['Intercept'] + independent_vars, 'keep': keep}
+
+
+def fit_design(design, rows = None, independent_vars = None, fit_kwargs = None):
+    '''
+    Fit a logit on a design matrix, or on a slice of its rows and a subset of its variables
+    Returns the same results object as run_regression(...).fit(), ready for convert_results_to_df
+    '''
+    
+    import statsmodels.api as sm
+    
+    if fit_kwargs is None:
+        fit_kwargs = {'disp': 0}
+    if rows is None:
+        rows = slice(None)
+    
+    exog = design['exog'][rows]
+    names = design['names']
     
-def calculate_vif(independet_df):
+    if independent_vars is not None:
+        positions = [0] + [names.index(var) for var in independent_vars]
+        exog = exog[:, positions]
+        names = [names[position] for position in positions]
+    
+    ### Wrapping the arrays in pandas only adds the names, the matrix isn't copied
+    model = sm.Logit(pd.Series(design['endog'][rows], name = 'denied'), 
+                     pd.DataFrame(exog, columns = names, copy = False))
+    
+    return model.fit(**fit_kwargs)
+
+
+def formula_vars(formula):
+    '''
+    The dependent and independent variables in a formula made by create_formula
+    '''
+    
+    dependent, independent = formula.split('~')
+    
+    return dependent.strip(), [var.strip() for var in independent.split('+') if var.strip() not in ('', '1')]
+
+
+def bin_continuous(values, bin_count):
+    '''
+    Replace a continuous variable with the mean of its quantile bin, along with how far that moves the values:
+    the root mean square and largest absolute shift and the share of the variance kept
+    '''
+    
+    values = pd.Series(values, dtype = float)
+    bin_codes = pd.qcut(values, bin_count, labels = False, duplicates = 'drop')
+    binned = values.groupby(bin_codes).transform('mean')
+    
+    ### Nulls stay null, the regression drops those records either way
+    binned = binned.where(values.notnull())
+    shift = binned - values
+    
+    shift_info = {'bins': int(bin_codes.nunique()), 
+                  'rms_shift': np.sqrt(np.nanmean(shift ** 2)),
+                  'max_abs_shift': np.nanmax(np.abs(shift)),
+                  'variance_kept': np.nanvar(binned)/np.nanvar(values) if np.nanvar(values) > 0 else 1.0}
+    
+    return binned, shift_info
+
+
+def bin_records(data, bins = None):
+    '''
+    Records with the variables in bins, a dict of variable and number of quantile bins, replaced by their bin means
+    Returns the binned records and a frame with how far the binning moved each binned variable's values
+    '''
+    
+    shift_list = []
+    if bins:
+        data = data.copy()
+        for var, bin_count in bins.items():
+            data[var], shift_info = bin_continuous(data[var], bin_count)
+            shift_info['independent_var'] = var
+            shift_list.append(shift_info)
+    
+    binning_shift = pd.DataFrame(shift_list, columns = ['independent_var', 'bins', 'rms_shift', 'max_abs_shift',
+                                                        'variance_kept'])
+    
+    return data, binning_shift
+
+
+def compress_patterns(data, dependent_var, independent_vars, bins = None):
+    '''
+    Collapse the records into one row per unique combination of the independent variables and the outcome,
+    with the number of records in 'records'. Variables in bins, a dict of variable and number of quantile bins,
+    are binned first so continuous variables compress too
+    Returns the compressed frame and a frame with how far the binning moved each binned variable's values
+    '''
+    
+    columns = [dependent_var] + list(independent_vars)
+    data, binning_shift = bin_records(data[columns].dropna(), bins)
+    
+    patterns = data.groupby(columns, sort = False).size().rename('records').reset_index()
+    
+    return patterns, binning_shift
+
+
+def binning_error(formula, exact_sample, binned_sample, maxiter = 35):
+    '''
+    How much binning changes the fit: the same records fit with their exact and their binned values
+    One row per coefficient with the difference also in standard errors of the exact fit, then a log_likelihood row
+    '''
+    
+    exact = smf.logit(formula = formula, data = exact_sample).fit(disp = 0, maxiter = maxiter)
+    binned = smf.logit(formula = formula, data = binned_sample).fit(disp = 0, maxiter = maxiter)
+    
+    error_df = pd.DataFrame({'variable_name': exact.params.index, 'exact': exact.params.values, 
+                             'binned': binned.params[exact.params.index].values})
+    error_df['difference'] = error_df['binned'] - error_df['exact']
+    error_df['standard_errors'] = error_df['difference']/exact.bse.values
+    
+    llf_row = {'variable_name': 'log_likelihood', 'exact': exact.llf, 'binned': binned.llf, 
+               'difference': binned.llf - exact.llf, 'standard_errors': np.nan}
+    error_df = pd.concat([error_df, pd.DataFrame([llf_row])], ignore_index = True)
+    error_df['sample_records'] = len(exact_sample)
+    
+    return error_df
+
+
+class CompressedLogit:
+    
+    '''
+    Logit fit as a frequency weighted binomial GLM over the unique covariate patterns
+    With only dummy variables the coefficients, standard errors, z values and likelihoods are the same as
+    fitting every record, with binned continuous variables the fit is an approximation: binning_error on the
+    results compares the coefficients and log-likelihood of an exact and a binned fit on a sample of
+    error_sample records, and binning_shift shows how far the binning moved each variable's values
+    The results have prsquared and mle_retvals like a Logit fit, so convert_results_to_df works on them
+    '''
+    
+    def __init__(self, data, formula, bins = None, error_sample = BINNING_ERROR_SAMPLE, random_state = 303):
+        
+        import statsmodels.api as sm
+        
+        self.formula = formula
+        self.dependent_var, self.independent_vars = formula_vars(formula)
+        
+        records = data[[self.dependent_var] + self.independent_vars].dropna()
+        binned, self.binning_shift = bin_records(records, bins)
+        self.patterns = binned.groupby(list(binned.columns), sort = False).size().rename('records').reset_index()
+        
+        ### The sample keeps each record's binned value from the full data, so the error is the binning's alone
+        self.error_samples = None
+        if bins and error_sample:
+            sample_index = records.sample(min(len(records), error_sample), random_state = random_state).index
+            self.error_samples = (records.loc[sample_index], binned.loc[sample_index])
+        
+        self.model = smf.glm(formula = formula, data = self.patterns, family = sm.families.Binomial(),
+                             freq_weights = self.patterns['records'].values)
+        
+    def fit(self, disp = 0, maxiter = 35, **kwargs):
+        
+        ### disp is for Logit.fit compatibility, IRLS doesn't print anything
+        results = self.model.fit(maxiter = maxiter, **kwargs)
+        
+        results.prsquared = 1 - results.llf/results.llnull
+        results.mle_retvals = {'converged': results.converged, 'iterations': results.fit_history['iteration']}
+        results.binning_shift = self.binning_shift
+        results.binning_error = None
+        if self.error_samples is not None:
+            results.binning_error = binning_error(self.formula, *self.error_samples, maxiter = maxiter)
+        results.nobs_records = int(self.patterns['records'].sum())
+        
+        return results
+    
+    
+    
+def calculate_vif(independet_df, method = 'matrix'):
     '''
     Calculate VIF
+    method 'matrix' reads every VIF off the inverse of the correlation matrix in one pass over the data,
+    'ols' runs one regression per variable
     '''
     
+    if method == 'matrix':
+        return vif_from_moments(accumulate_vif_moments(independet_df, list(independet_df.columns)),
+                                list(independet_df.columns))
+    
     vif_list = []
     
     x_cols = independet_df.columns
@@ -81,6 +319,168 @@ def calculate_vif(independet_df):
         
     vif_df = pd.DataFrame(vif_list)
     return vif_df
+
+
+def vif_moments(values):
+    '''
+    Record count, column means and centered cross products for a block of independent variables
+    Records with a null in any variable are left out, the same records the 'ols' method's regressions drop
+    '''
+    
+    values = np.asarray(values, dtype = float)
+    values = values[~np.isnan(values).any(axis = 1)]
+    mean = values.mean(axis = 0) if len(values) else np.zeros(values.shape[1])
+    centered = values - mean
+    
+    return {'count': len(values), 'mean': mean, 'cross': centered.T @ centered}
+
+
+def combine_vif_moments(first, second):
+    '''
+    Merge the moments of two blocks, centering each block first keeps the sums accurate over millions of records
+    '''
+    
+    if first is None or first['count'] == 0:
+        return second
+    if second['count'] == 0:
+        return first
+    
+    count = first['count'] + second['count']
+    delta = second['mean'] - first['mean']
+    
+    return {'count': count, 
+            'mean': first['mean'] + delta * second['count']/count,
+            'cross': first['cross'] + second['cross'] + np.outer(delta, delta) * first['count'] * second['count']/count}
+
+
+def accumulate_vif_moments(df, independent_vars, group_col = None, moments = None):
+    '''
+    Add a chunk of records to the running moments, keyed by group or by None for all records
+    Pass the moments back in with the next chunk to stream over a file
+    '''
+    
+    if moments is None:
+        moments = {}
+    
+    if group_col is None:
+        moments[None] = combine_vif_moments(moments.get(None), 
+                                            vif_moments(df[independent_vars].to_numpy(dtype = float, na_value = np.nan)))
+        return moments
+    
+    data, offsets = sort_by_group(df, group_col, [group_col] + list(independent_vars))
+    values = data[independent_vars].to_numpy(dtype = float, na_value = np.nan)
+    
+    for group_key, (start, stop) in offsets.items():
+        moments[group_key] = combine_vif_moments(moments.get(group_key), vif_moments(values[start:stop]))
+        
+    return moments
+
+
+def vifs_from_cross(cross):
+    '''
+    VIF for every variable from the centered cross products, the diagonal of the inverse correlation matrix
+    Variables that don't vary have no VIF, perfectly collinear ones get inf
+    '''
+    
+    variance = np.diag(cross)
+    varies = variance > 0
+    
+    vifs = np.full(len(variance), np.nan)
+    
+    scale = np.sqrt(variance[varies])
+    correlation = cross[np.ix_(varies, varies)]/np.outer(scale, scale)
+    
+    ### The diagonal of the pseudo-inverse from one eigendecomposition, variables in an exact linear
+    ### dependency are the ones with weight in the null space, the rest keep their usual VIF
+    eigenvalues, eigenvectors = np.linalg.eigh(correlation)
+    null_space = eigenvalues < 1e-10 * max(len(eigenvalues), 1)
+    
+    varying_vifs = np.sum(eigenvectors[:, ~null_space] ** 2/eigenvalues[~null_space], axis = 1)
+    collinear = np.any(np.abs(eigenvectors[:, null_space]) > 1e-6, axis = 1)
+    varying_vifs[collinear] = np.inf
+    
+    vifs[varies] = varying_vifs
+    
+    return vifs
+
+
+def vif_from_moments(moments, independent_vars, group_col = None):
+    '''
+    Turn accumulated moments into the same VIF frame calculate_vif returns, with the group column first when grouped
+    '''
+    
+    independent_vars = list(independent_vars)
+    
+    ### No moments, e.g. no group qualified, gives an empty frame
+    vifs = np.round(np.concatenate([vifs_from_cross(group_moments['cross']) for group_moments in moments.values()] + 
+                                   [np.empty(0)]), 2)
+    
+    ### 1 for concern, 0 for no concern, variables that don't vary get neither
+    threshold = np.where(vifs > 2.5, '1', '0').astype(object)
+    threshold[np.isnan(vifs)] = np.nan
+    
+    vif_df = pd.DataFrame({'independent_var': independent_vars * len(moments), 'vif': vifs, 'threshold': threshold})
+    
+    if group_col is not None:
+        vif_df.insert(0, group_col, np.repeat(np.array(list(moments), dtype = object), len(independent_vars)))
+        vif_df.insert(1, 'group_apps', np.repeat([group_moments['count'] for group_moments in moments.values()], 
+                                                 len(independent_vars)))
+    
+    return vif_df
+
+
+def calculate_group_vif(df, group_col, independent_vars):
+    '''
+    VIF for every metro or lender from one pass over the data
+    '''
+    
+    return vif_from_moments(accumulate_vif_moments(df, independent_vars, group_col), independent_vars, group_col)
+
+
+def stream_vif(chunks, independent_vars, group_col = None):
+    '''
+    VIF over data too big to load at once, chunks is any iterable of dataframes such as read_stage or read_csv chunks
+    '''
+    
+    moments = {}
+    
+    for chunk in chunks:
+        moments = accumulate_vif_moments(chunk, independent_vars, group_col, moments)
+        
+    return vif_from_moments(moments, independent_vars, group_col)
+
+
+def score_predictions(actual, predicted, threshold = 0.5, calibration_bins = 10):
+    '''
+    Confusion matrix, accuracy, recall and calibration for predicted probabilities
+    denied is 0 for denials (create_dummy_vars flags a match with 0), so class 0 is the denied class
+    Calibration splits the predictions into calibration_bins equal width bins and compares each bin's mean
+    prediction to its observed rate: calibration_error is the record weighted mean gap, max_calibration_gap the largest
+    '''
+    
+    actual = np.asarray(actual, dtype = float).ravel()
+    predicted = np.asarray(predicted, dtype = float).ravel()
+    prediction = (predicted > threshold).astype(int)
+    
+    ### Rows are the actual class, columns the predicted class, same as sklearn's confusion_matrix
+    cm = np.bincount((actual.astype(int) * 2) + prediction, minlength = 4).reshape(2, 2)
+    
+    bin_codes = np.minimum((predicted * calibration_bins).astype(int), calibration_bins - 1)
+    bin_records = np.bincount(bin_codes, minlength = calibration_bins)
+    filled = bin_records > 0
+    gaps = np.abs(np.bincount(bin_codes, weights = predicted, minlength = calibration_bins)[filled] - 
+                  np.bincount(bin_codes, weights = actual, minlength = calibration_bins)[filled])/bin_records[filled]
+    
+    return {'records': len(actual), 
+            'true_denied': cm[0, 0], 'false_loan': cm[0, 1], 'false_denied': cm[1, 0], 'true_loan': cm[1, 1],
+            'accuracy': (cm[0, 0] + cm[1, 1])/len(actual) * 100,
+            'denied_recall': cm[0, 0]/(cm[0, 0] + cm[0, 1]) * 100,
+            'loan_recall': cm[1, 1]/(cm[1, 0] + cm[1, 1]) * 100,
+            'mean_predicted': predicted.mean(),
+            'observed_rate': actual.mean(),
+            'brier_score': np.mean((predicted - actual) ** 2),
+            'calibration_error': np.sum(gaps * bin_records[filled])/len(actual),
+            'max_calibration_gap': gaps.max()}
     
     
 def calcuate_confusion_matrix(df, model, indepndent_vars, dependent_vars):
@@ -94,15 +494,19 @@ def calcuate_confusion_matrix(df, model, indepndent_vars, dependent_vars):
     
     
     yhat = model.predict(testX)
-    prediction = list(map(round, yhat))
     
-    cm = confusion_matrix(testY, prediction)  
+    ### Same as rounding every prediction, round() sends 0.5 down to 0
+    scores = score_predictions(testY, yhat, threshold = 0.5)
+    
+    cm = np.array([[scores['true_denied'], scores['false_loan']], [scores['false_denied'], scores['true_loan']]])
     print ("Confusion Matrix : \n", cm)
     
     # accuracy score of the model 
-    print('Overall accuracy: ', accuracy_score(testY, prediction) * 100)
-    print('Denied accuracy: ', (cm[0, 0]/(cm[0, 0] + cm[0, 1])) * 100)
-    print('Loan accuracy : ', (cm[1, 1]/(cm[1, 0] + cm[1, 1])) * 100)
+    print('Overall accuracy: ', scores['accuracy'])
+    print('Denied accuracy: ', scores['denied_recall'])
+    print('Loan accuracy : ', scores['loan_recall'])
+    
+    return scores
     
 
 def convert_results_to_df(model):
@@ -129,9 +533,816 @@ def convert_results_to_df(model):
     results_df.insert(1, 'pseudo_rsquared', model.prsquared)
     
     return results_df
+
+
+
+class CachedFit:
+    '''
+    The parts of a fitted Logit the results frames use, loaded from the fit cache
+    Works with convert_results_to_df and fit_group the same as the statsmodels results it was saved from
+    '''
+    
+    def __init__(self, fit):
+        
+        self.params = pd.Series(fit['params'], index = fit['names'])
+        self.bse = pd.Series(fit['bse'], index = fit['names'])
+        self.tvalues = pd.Series(fit['tvalues'], index = fit['names'])
+        self.pvalues = pd.Series(fit['pvalues'], index = fit['names'])
+        self.prsquared = fit['prsquared']
+        self.mle_retvals = fit['mle_retvals']
+
+
+def fit_key(group_key, independent_vars, solver, endog, exog):
+    '''
+    Hash of one fit: the group, the variables in order, the solver and its options, and the records it is fit on
+    '''
+    
+    hasher = hashlib.sha256()
+    
+    hash_value([group_key, list(independent_vars), solver], hasher)
+    hash_value(np.asarray(endog), hasher)
+    hash_value(np.asarray(exog), hasher)
+    
+    return hasher.hexdigest()
+
+
+def fit_path(cache_dir, key):
+    
+    return os.path.join(cache_dir, 'fit_' + key[:32] + '.pkl')
+
+
+def load_fit(cache_dir, key):
+    '''
+    A cached fit, or None when the fit isn't in the cache
+    '''
+    
+    path = fit_path(cache_dir, key)
+    
+    if not os.path.isfile(path):
+        return None
+    
+    ### Loading counts as a use for the LRU eviction
+    os.utime(path, None)
+    
+    with open(path, 'rb') as fit_file:
+        return CachedFit(pickle.load(fit_file))
+
+
+def save_fit(cache_dir, key, names, params, bse, tvalues, pvalues, prsquared, mle_retvals):
+    
+    fit = {'names': list(names), 'params': np.asarray(params, dtype = float), 'bse': np.asarray(bse, dtype = float),
+           'tvalues': np.asarray(tvalues, dtype = float), 'pvalues': np.asarray(pvalues, dtype = float),
+           'prsquared': float(prsquared), 'mle_retvals': dict(mle_retvals)}
+    
+    os.makedirs(cache_dir, exist_ok = True)
+    
+    ### Write to a temporary file first so an interrupted run never leaves a broken fit
+    path = fit_path(cache_dir, key)
+    with open(path + '.tmp', 'wb') as fit_file:
+        pickle.dump(fit, fit_file, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def cached_fit(design, independent_vars, fit_kwargs, group_key = None, cache_dir = FIT_CACHE_DIR):
+    '''
+    fit_design with the result saved in cache_dir, a fit with the same group, variables, fit options and records
+    is loaded instead of refit. Returns the fit and whether it came from the cache
+    Fits that raise aren't saved, the runners evict the cache down to MAX_FIT_CACHE_BYTES once they are done
+    '''
+    
+    names = design['names']
+    exog = design['exog']
+    
+    if list(independent_vars) != names[1:]:
+        exog = exog[:, [0] + [names.index(var) for var in independent_vars]]
+    
+    solver = {'solver': 'statsmodels', 'version': statsmodels.__version__, 'fit_kwargs': fit_kwargs}
+    key = fit_key(group_key, independent_vars, solver, design['endog'], exog)
+    
+    fit = load_fit(cache_dir, key)
+    if fit is not None:
+        return fit, True
+    
+    results = fit_design(design, independent_vars = independent_vars, fit_kwargs = fit_kwargs)
+    save_fit(cache_dir, key, results.params.index, results.params, results.bse, results.tvalues, results.pvalues,
+             results.prsquared, results.mle_retvals)
+    
+    return results, False
+
+
+def fit_group(group_df, group_key, group_col, independent_vars, fit_kwargs = None, design = None, cache_dir = None):
+    '''
+    Fit one group's model, returning the results frame the metro and lender notebooks build
+    and the convergence info for the group
+    design is the group's rows of a prebuilt design matrix, otherwise one is built from group_df
+    With cache_dir the fit is saved there and loaded on later runs while the group's records don't change
+    '''
+    
+    if fit_kwargs is None:
+        fit_kwargs = {'disp': 0}
+    
+    ### Without the records, e.g. fitting from a regression bundle, the design has a keep flag for each one
+    group_apps = len(group_df) if group_df is not None else len(design['keep'])
+    fit_info = {group_col: group_key, 'group_apps': group_apps, 'converged': np.nan, 'iterations': np.nan, 
+                'psuedo_rsquare': np.nan, 'error': None}
+    if cache_dir is not None:
+        fit_info['cache_hit'] = False
+    
+    try:
+        if design is None:
+            design = design_matrix(group_df, independent_vars)
+        
+        if cache_dir is not None:
+            results, fit_info['cache_hit'] = cached_fit(design, independent_vars, fit_kwargs, group_key, cache_dir)
+        else:
+            results = fit_design(design, independent_vars = independent_vars, fit_kwargs = fit_kwargs)
+        info = results.mle_retvals['converged']
+        
+        results_df = convert_results_to_df(results)
+        results_df.insert(0, group_col, group_key)
+        results_df.insert(1, 'group_apps', group_apps)
+        results_df.insert(2, 'psuedo_rsquare', results.prsquared)
+        results_df['iteration_flag'] = info
+        
+        fit_info.update({'converged': info, 'iterations': results.mle_retvals.get('iterations'), 
+                         'psuedo_rsquare': results.prsquared})
+        
+    except Exception as error:
+        ### Same empty rows the notebooks create when a model can't be fit
+        results_df = pd.DataFrame({group_col: group_key, 'group_apps': group_apps, 'variable_name': independent_vars,
+                                   'standard_error': np.nan, 'z_value': np.nan, 'p_value': np.nan, 
+                                   'odds_ratio': np.nan, 'iteration_flag': np.nan, 'psuedo_rsquare': np.nan})
+        
+        fit_info['error'] = repr(error)
         
+    return results_df, fit_info
+
+
+def count_group_outcomes(df, group_col, independent_vars, outcomes = None, outcome_col = 'loan_outcome',
+                         zero_vars = None):
+    '''
+    Count the loans and denials for every group, variable and variable value in one pass per variable
+    Every group gets a row for every value and for 0, zero filled when a group has no records with it,
+    along with the total count and the loan and denied percentages
+    outcomes maps the outcome codes to the count columns, loans and denials by default,
+    the codes are matched as strings so an integer outcome column counts the same as a string one
+    zero_vars, the continuous variables, aren't counted but every group gets a zero row for them at variable_flag 0,
+    the missing rows the metro notebook adds
+    '''
+    
+    if outcomes is None:
+        outcomes = {'1': 'loan', '3': 'denied'}
+    
+    group_codes, groups = pd.factorize(df[group_col])
+    outcome_codes = pd.Index([str(outcome) for outcome in outcomes]).get_indexer(df[outcome_col].astype(str))
+    
+    if len(df) > 0 and not (outcome_codes >= 0).any():
+        raise ValueError('No ' + outcome_col + ' values match the outcome codes ' + repr(list(outcomes)))
+    
+    ### Records with no group or some other outcome aren't counted, same as the pivot tables in the notebooks
+    counted = (group_codes >= 0) & (outcome_codes >= 0)
+    group_count = len(groups)
+    outcome_count = len(outcomes)
+    
+    count_list = []
+    
+    for independent_var in independent_vars:
+        value_codes, values = pd.factorize(df[independent_var], sort = True)
+        
+        ### The reference level 0 always gets a row, the notebooks add it when no record has it
+        if pd.api.types.is_numeric_dtype(values) and not (values == 0).any():
+            values = values.append(pd.Index([0]))
+        value_count = len(values)
+        
+        var_counted = counted & (value_codes >= 0)
+        cells = (group_codes[var_counted] * value_count + value_codes[var_counted]) * outcome_count + \
+                outcome_codes[var_counted]
+        
+        counts = np.bincount(cells, minlength = group_count * value_count * outcome_count)
+        counts = counts.reshape(group_count * value_count, outcome_count)
         
+        var_df = pd.DataFrame({group_col: np.repeat(np.asarray(groups), value_count),
+                               'variable_flag': np.tile(np.asarray(values), group_count)})
+        for position, count_col in enumerate(outcomes.values()):
+            var_df[count_col] = counts[:, position]
+        var_df['variable_name'] = independent_var
         
+        count_list.append(var_df)
     
+    for zero_var in zero_vars or []:
+        zero_df = pd.DataFrame({group_col: np.asarray(groups), 'variable_flag': 0})
+        for count_col in outcomes.values():
+            zero_df[count_col] = 0
+        zero_df['variable_name'] = zero_var
         
-        
\ No newline at end of file
+        count_list.append(zero_df)
+    
+    count_df = pd.concat(count_list, ignore_index = True)
+    
+    count_df['total_count'] = count_df[list(outcomes.values())].sum(axis = 1)
+    for count_col in outcomes.values():
+        count_df[count_col + '_pct'] = count_df[count_col].div(count_df['total_count']).multiply(100)
+    
+    return count_df
+
+
+def empty_group_fits(group_col, cache_dir = None):
+    '''
+    The results and fit info frames of a grouped run with no groups to fit, with the columns a fit would have
+    '''
+    
+    results_df = pd.DataFrame(columns = [group_col, 'group_apps', 'psuedo_rsquare', 'variable_name', 'pseudo_rsquared',
+                                         'coefficient', 'standard_error', 'z_value', 'p_value', 'odds_ratio',
+                                         'iteration_flag'])
+    
+    info_cols = [group_col, 'group_apps', 'converged', 'iterations', 'psuedo_rsquare', 'error']
+    if cache_dir is not None:
+        info_cols.append('cache_hit')
+    
+    return results_df, pd.DataFrame(columns = info_cols)
+
+
+def fit_info_frame(info_list):
+    '''
+    Each group's fit info as a frame, error is None for the groups that fit
+    The error column is kept as objects, newer pandas would store it as strings and turn None into NaN
+    '''
+    
+    fit_info_df = pd.DataFrame(info_list)
+    if 'error' in fit_info_df.columns:
+        fit_info_df['error'] = pd.Series([info['error'] for info in info_list], index = fit_info_df.index, 
+                                         dtype = object)
+    
+    return fit_info_df
+
+
+### Set once per worker process so the regression data isn't sent with every task
+_worker_data = {}
+
+
+def _init_group_worker(data, group_col, offsets, fit_kwargs, single_thread = False, design = None, cache_dir = None):
+    
+    ### One BLAS thread per worker, otherwise every process tries to use every core
+    if single_thread:
+        from threadpoolctl import threadpool_limits
+        _worker_data['thread_limits'] = threadpool_limits(limits = 1)
+    
+    _worker_data['data'] = data
+    _worker_data['group_col'] = group_col
+    _worker_data['offsets'] = offsets
+    _worker_data['fit_kwargs'] = fit_kwargs
+    _worker_data['design'] = design
+    _worker_data['cache_dir'] = cache_dir
+    
+    ### Where each group's rows start in the design matrix, which has no null records
+    if design is not None:
+        _worker_data['design_rows'] = np.r_[0, np.cumsum(design['keep'])]
+    
+    
+def _fit_group_task(task):
+    
+    group_key, independent_vars = task
+    start, stop = _worker_data['offsets'][group_key]
+    
+    ### The data is sorted by group, so a group is one contiguous slice
+    group_df = _worker_data['data'].iloc[start:stop]
+    
+    group_design = None
+    design = _worker_data.get('design')
+    if design is not None:
+        design_rows = slice(_worker_data['design_rows'][start], _worker_data['design_rows'][stop])
+        group_design = {'endog': design['endog'][design_rows], 'exog': design['exog'][design_rows], 
+                        'names': design['names']}
+    
+    return fit_group(group_df, group_key, _worker_data['group_col'], independent_vars, _worker_data['fit_kwargs'],
+                     group_design, _worker_data['cache_dir'])
+
+
+def sort_by_group(df, group_col, columns):
+    '''
+    Sort the regression columns by group and find where each group starts and stops
+    '''
+    
+    data = df.loc[df[group_col].notnull(), columns].sort_values(by = group_col, kind = 'mergesort')
+    data = data.reset_index(drop = True)
+    
+    keys = data[group_col].values
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype = int)
+    stops = np.r_[starts[1:], len(keys)]
+    
+    offsets = {keys[start]: (start, stop) for start, stop in zip(starts, stops)}
+    
+    return data, offsets
+
+
+def run_grouped_regressions(df, group_col, independent_vars, groups = None, processes = None, fit_kwargs = None,
+                            cache_dir = None):
+    '''
+    Fit one model per group (metro_code, lei or any other column) on a pool of worker processes
+    independent_vars is either one list for every group or a dict of lists keyed by group
+    Returns the combined results frame and a frame with each group's convergence info
+    With cache_dir, e.g. FIT_CACHE_DIR, only the groups whose records, variables or fit options changed are refit
+    '''
+    
+    if isinstance(independent_vars, dict):
+        all_vars = list(dict.fromkeys(var for group_vars in independent_vars.values() for var in group_vars))
+    else:
+        all_vars = list(independent_vars)
+    
+    data, offsets = sort_by_group(df, group_col, [group_col, 'denied'] + all_vars)
+    
+    ### With one variable list every group drops the same null records, so one design matrix serves every fit
+    design = None if isinstance(independent_vars, dict) else design_matrix(data, all_vars)
+    
+    if groups is None:
+        groups = list(offsets)
+    if len(groups) == 0:
+        return empty_group_fits(group_col, cache_dir)
+    
+    tasks = []
+    for group_key in groups:
+        group_vars = independent_vars[group_key] if isinstance(independent_vars, dict) else all_vars
+        tasks.append((group_key, group_vars))
+    
+    ### Groups with no records fail the same way they do in the notebooks
+    missing = [task for task in tasks if task[0] not in offsets]
+    for group_key, group_vars in missing:
+        offsets[group_key] = (0, 0)
+    
+    if processes == 1:
+        _init_group_worker(data, group_col, offsets, fit_kwargs, design = design, cache_dir = cache_dir)
+        fits = [_fit_group_task(task) for task in tasks]
+    else:
+        ### Workers get the data once when they start, forked workers share it without copying
+        with multiprocessing.Pool(processes, initializer = _init_group_worker, 
+                                  initargs = (data, group_col, offsets, fit_kwargs, True, design, cache_dir)) as pool:
+            fits = pool.map(_fit_group_task, tasks, chunksize = 1)
+    
+    if cache_dir is not None:
+        evict_cache(cache_dir, MAX_FIT_CACHE_BYTES)
+    
+    results_df = pd.concat([results for results, fit_info in fits], ignore_index = True)
+    fit_info_df = fit_info_frame([fit_info for results, fit_info in fits])
+    
+    return results_df, fit_info_df
+
+
+def null_loglike(records, outcome_sum):
+    '''
+    Log likelihood of the intercept only model, zero when every record has the same outcome
+    '''
+    
+    mean_outcome = outcome_sum/records if records else 0.0
+    
+    if not 0 < mean_outcome < 1:
+        return 0.0
+    
+    return records * (mean_outcome * np.log(mean_outcome) + (1 - mean_outcome) * np.log(1 - mean_outcome))
+
+
+def is_separated(fitted, endog):
+    '''
+    Logit.fit's perfect separation check, every fitted probability has reached its outcome
+    '''
+    
+    return np.allclose(fitted - endog, 0)
+
+
+def newton_step(hessian, score, records):
+    '''
+    Newton step on the average negative log likelihood with a small ridge, same as statsmodels
+    Takes one model's Hessian and score or a stack of them, a singular Hessian raises LinAlgError
+    '''
+    
+    records = np.asarray(records, dtype = float).reshape(np.shape(score)[:-1] + (1,))
+    ridged = -hessian/records[..., None] + np.eye(np.shape(score)[-1]) * 1e-10
+    
+    return np.linalg.solve(ridged, (-score/records)[..., None])[..., 0]
+
+
+def logit_results_frame(names, params, bse, prsquared):
+    '''
+    The same frame convert_results_to_df makes, from coefficients and standard errors fit outside statsmodels
+    '''
+    
+    from scipy import stats
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        z_values = params/bse
+    
+    return pd.DataFrame({'variable_name': names, 'pseudo_rsquared': prsquared, 'coefficient': params, 
+                         'standard_error': bse, 'z_value': z_values, 'p_value': 2 * stats.norm.sf(np.abs(z_values)),
+                         'odds_ratio': np.exp(params)})
+
+
+def run_batched_regressions(df, group_col, independent_vars, groups = None, maxiter = 35, tol = 1e-8, 
+                            cache_dir = None):
+    '''
+    Fit one logit per group with Newton steps taken for every group at once
+    The gradients and Hessians of all the groups are stacked and solved together, groups drop out as they converge
+    Same steps, convergence rule and results as Logit.fit's newton solver, without a statsmodels fit per group
+    Returns the long results frame the metro and lender notebooks build and each group's convergence info
+    With cache_dir only the groups that changed since an earlier run are fit, the same as run_grouped_regressions
+    '''
+    
+    independent_vars = list(independent_vars)
+    data, offsets = sort_by_group(df, group_col, [group_col, 'denied'] + independent_vars)
+    design = design_matrix(data, independent_vars)
+    
+    return fit_batched_design(design, offsets, group_col, groups, maxiter, tol, cache_dir)
+
+
+def fit_batched_design(design, offsets, group_col, groups = None, maxiter = 35, tol = 1e-8, cache_dir = None):
+    '''
+    The batched Newton fit of run_batched_regressions on a prebuilt design matrix of group sorted records
+    offsets are each group's (start, stop) records before the null records were dropped, as from sort_by_group
+    Groups whose fitted probabilities all reach their outcomes get a PerfectSeparationError and a singular Hessian
+    a LinAlgError, with the empty rows fit_group returns when Logit.fit raises them
+    '''
+    
+    independent_vars = design['names'][1:]
+    offsets = dict(offsets)
+    
+    if groups is None:
+        groups = list(offsets)
+    if len(groups) == 0:
+        return empty_group_fits(group_col, cache_dir)
+    for group_key in groups:
+        offsets.setdefault(group_key, (0, 0))
+    
+    if cache_dir is not None:
+        return fit_batched_cached(design, offsets, group_col, groups, maxiter, tol, cache_dir)
+    
+    ### Each group's rows in the design matrix, which has the null records dropped
+    design_rows = np.r_[0, np.cumsum(design['keep'])]
+    bounds = np.array([(design_rows[offsets[group_key][0]], design_rows[offsets[group_key][1]]) 
+                       for group_key in groups], dtype = int).reshape(-1, 2)
+    
+    exog = design['exog']
+    endog = design['endog']
+    group_count, var_count = len(groups), exog.shape[1]
+    records = bounds[:, 1] - bounds[:, 0]
+    
+    params = np.zeros((group_count, var_count))
+    iterations = np.zeros(group_count, dtype = int)
+    errors = np.array([None if count > 0 else 'No records' for count in records], dtype = object)
+    active = records > 0
+    separation_error = repr(PerfectSeparationError(SEPARATION_MESSAGE))
+    
+    def score_and_hessian(positions):
+        
+        scores = np.empty((len(positions), var_count))
+        hessians = np.empty((len(positions), var_count, var_count))
+        
+        for position, group in enumerate(positions):
+            start, stop = bounds[group]
+            group_exog = exog[start:stop]
+            with np.errstate(over = 'ignore'):
+                fitted = 1/(1 + np.exp(-(group_exog @ params[group])))
+            
+            ### Logit.fit checks every iteration's params the same way and raises
+            if is_separated(fitted, endog[start:stop]):
+                errors[group] = separation_error
+            
+            scores[position] = group_exog.T @ (endog[start:stop] - fitted)
+            hessians[position] = -(group_exog.T * (fitted * (1 - fitted))) @ group_exog
+            
+        return scores, hessians
+    
+    while active.any():
+        positions = np.flatnonzero(active)
+        scores, hessians = score_and_hessian(positions)
+        
+        separated = np.array([errors[group] is not None for group in positions], dtype = bool)
+        if separated.any():
+            active[positions[separated]] = False
+            positions, scores, hessians = positions[~separated], scores[~separated], hessians[~separated]
+            if len(positions) == 0:
+                continue
+        
+        nobs = records[positions]
+        
+        try:
+            steps = newton_step(hessians, scores, nobs)
+        except np.linalg.LinAlgError:
+            steps = np.full((len(positions), var_count), np.nan)
+            for position, group in enumerate(positions):
+                try:
+                    steps[position] = newton_step(hessians[position], scores[position], nobs[position])
+                except np.linalg.LinAlgError as error:
+                    errors[group] = repr(error)
+                    active[group] = False
+        
+        solved = ~np.isnan(steps).any(axis = 1)
+        positions, steps = positions[solved], steps[solved]
+        
+        params[positions] -= steps
+        iterations[positions] += 1
+        
+        still_moving = np.abs(steps).max(axis = 1) > tol if len(steps) else np.array([], dtype = bool)
+        active[positions] = still_moving & (iterations[positions] < maxiter)
+    
+    fitted_groups = np.flatnonzero([error is None for error in errors])
+    scores, hessians = score_and_hessian(fitted_groups)
+    
+    results_list = []
+    info_list = []
+    
+    for group in range(group_count):
+        group_key = groups[group]
+        group_apps = offsets[group_key][1] - offsets[group_key][0]
+        converged = bool(errors[group] is None and iterations[group] < maxiter)
+        
+        info = {group_col: group_key, 'group_apps': group_apps, 'converged': np.nan, 'iterations': np.nan,
+                'psuedo_rsquare': np.nan, 'error': errors[group]}
+        
+        if errors[group] is None:
+            fitted_position = np.searchsorted(fitted_groups, group)
+            
+            try:
+                with np.errstate(invalid = 'ignore'):
+                    bse = np.sqrt(np.diag(np.linalg.inv(-hessians[fitted_position])))
+            except np.linalg.LinAlgError as error:
+                errors[group] = info['error'] = repr(error)
+        
+        if errors[group] is not None:
+            ### Same empty rows the notebooks create when a model can't be fit
+            results_list.append(pd.DataFrame({group_col: group_key, 'group_apps': group_apps, 
+                                              'variable_name': independent_vars, 'standard_error': np.nan,
+                                              'z_value': np.nan, 'p_value': np.nan, 'odds_ratio': np.nan, 
+                                              'iteration_flag': np.nan, 'psuedo_rsquare': np.nan}))
+            info_list.append(info)
+            continue
+        
+        start, stop = bounds[group]
+        group_endog = endog[start:stop]
+        linear = exog[start:stop] @ params[group]
+        llf = np.sum(group_endog * linear - np.logaddexp(0, linear))
+        
+        ### inf when every record has the same outcome, same as Logit
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            prsquared = 1 - np.float64(llf)/null_loglike(records[group], group_endog.sum())
+        
+        results_df = logit_results_frame(design['names'], params[group], bse, prsquared)
+        results_df.insert(0, group_col, group_key)
+        results_df.insert(1, 'group_apps', group_apps)
+        results_df.insert(2, 'psuedo_rsquare', prsquared)
+        results_df['iteration_flag'] = converged
+        
+        info.update({'converged': converged, 'iterations': iterations[group], 'psuedo_rsquare': prsquared})
+        
+        results_list.append(results_df)
+        info_list.append(info)
+    
+    return pd.concat(results_list, ignore_index = True), fit_info_frame(info_list)
+
+
+def fit_batched_cached(design, offsets, group_col, groups, maxiter, tol, cache_dir):
+    '''
+    fit_batched_design for only the groups that aren't in the fit cache, the rest are loaded from it
+    '''
+    
+    names = design['names']
+    design_rows = np.r_[0, np.cumsum(design['keep'])]
+    solver = {'solver': 'batched', 'maxiter': maxiter, 'tol': tol, 'source': inspect.getsource(fit_batched_design)}
+    
+    keys = {}
+    cached = {}
+    for group_key in groups:
+        rows = slice(design_rows[offsets[group_key][0]], design_rows[offsets[group_key][1]])
+        keys[group_key] = fit_key(group_key, names[1:], solver, design['endog'][rows], design['exog'][rows])
+        
+        fit = load_fit(cache_dir, keys[group_key])
+        if fit is not None:
+            cached[group_key] = fit
+    
+    fits = {}
+    missing = [group_key for group_key in groups if group_key not in cached]
+    
+    if missing:
+        results_df, fit_info_df = fit_batched_design(design, offsets, group_col, missing, maxiter, tol)
+        group_results = dict(list(results_df.groupby(group_col, sort = False)))
+        
+        for fit_info in fit_info_df.to_dict('records'):
+            group_key = fit_info[group_col]
+            fit_info['cache_hit'] = False
+            fits[group_key] = (group_results[group_key].reset_index(drop = True), fit_info)
+            
+            ### to_dict turns a missing error into NaN, None is the no error value everywhere else
+            if pd.isnull(fit_info['error']):
+                fit_info['error'] = None
+            
+            if fit_info['error'] is None:
+                group_df = fits[group_key][0]
+                save_fit(cache_dir, keys[group_key], group_df['variable_name'], group_df['coefficient'], 
+                         group_df['standard_error'], group_df['z_value'], group_df['p_value'], 
+                         fit_info['psuedo_rsquare'], {'converged': fit_info['converged'], 
+                                                      'iterations': int(fit_info['iterations'])})
+    
+    for group_key, fit in cached.items():
+        group_apps = offsets[group_key][1] - offsets[group_key][0]
+        
+        ### The convert_results_to_df frame built straight from the saved values, without its merges
+        results_df = pd.DataFrame({'variable_name': fit.params.index, 'pseudo_rsquared': fit.prsquared, 
+                                   'coefficient': fit.params.values, 'standard_error': fit.bse.values, 
+                                   'z_value': fit.tvalues.values, 'p_value': fit.pvalues.values, 
+                                   'odds_ratio': np.exp(fit.params.values)})
+        results_df.insert(0, group_col, group_key)
+        results_df.insert(1, 'group_apps', group_apps)
+        results_df.insert(2, 'psuedo_rsquare', fit.prsquared)
+        results_df['iteration_flag'] = fit.mle_retvals['converged']
+        
+        fits[group_key] = (results_df, {group_col: group_key, 'group_apps': group_apps, 
+                                        'converged': fit.mle_retvals['converged'], 
+                                        'iterations': fit.mle_retvals['iterations'], 
+                                        'psuedo_rsquare': fit.prsquared, 'error': None, 'cache_hit': True})
+    
+    evict_cache(cache_dir, MAX_FIT_CACHE_BYTES)
+    
+    return (pd.concat([fits[group_key][0] for group_key in groups], ignore_index = True), 
+            fit_info_frame([fits[group_key][1] for group_key in groups]))
+
+
+def replayable_chunks(chunks, columns, spill_dir):
+    '''
+    A function returning the chunks again on every call, for fits that take several passes
+    A stage output path is read with iter_stage and a function is called, lists and other iterables that can be
+    read again are reused, and a generator is written to a stage file in spill_dir while it is read the first time
+    '''
+    
+    from utils.store_data import StageWriter, iter_stage
+    
+    if isinstance(chunks, str):
+        path = chunks
+        return lambda: iter_stage(path, columns = columns)
+    
+    if callable(chunks):
+        return chunks
+    
+    if iter(chunks) is not chunks:
+        return lambda: iter(chunks)
+    
+    spill_path = os.path.join(spill_dir, 'chunks.parquet')
+    spilled = []
+    
+    def first_pass():
+        with StageWriter(spill_path) as writer:
+            for chunk in chunks:
+                writer.write(chunk[columns])
+                yield chunk
+        spilled.append(writer.rows > 0)
+    
+    def replay():
+        if not spilled:
+            return first_pass()
+        return iter_stage(spill_path, columns = columns) if spilled[0] else iter([])
+    
+    return replay
+
+
+def stream_regression(chunks, independent_vars, maxiter = 35, tol = 1e-8):
+    '''
+    Fit the logit without holding the data in memory, every Newton iteration is one pass over the chunks
+    accumulating X'WX and the score, so memory depends on the chunk size and not on the number of records
+    chunks is a stage output path, a function returning an iterable of dataframes or any iterable of dataframes,
+    a generator is spilled to a temporary stage file so it can be read on every iteration
+    Same steps and results as smf.logit's newton solver, returns the convert_results_to_df frame and the fit info
+    Perfect separation and singular Hessians are caught the same way as the batched fit, the frame then has
+    empty rows and the fit info the error
+    '''
+    
+    independent_vars = list(independent_vars)
+    names = ['Intercept'] + independent_vars
+    var_count = len(names)
+    
+    def one_pass(params):
+        
+        totals = {'records': 0, 'denied': 0.0, 'llf': 0.0, 'score': np.zeros(var_count), 
+                  'hessian': np.zeros((var_count, var_count)), 'separated': True}
+        
+        for chunk in read_chunks():
+            design = design_matrix(chunk, independent_vars)
+            exog, endog = design['exog'], design['endog']
+            
+            linear = exog @ params
+            with np.errstate(over = 'ignore'):
+                fitted = 1/(1 + np.exp(-linear))
+            
+            totals['records'] += len(endog)
+            totals['denied'] += endog.sum()
+            totals['llf'] += np.sum(endog * linear - np.logaddexp(0, linear))
+            totals['score'] += exog.T @ (endog - fitted)
+            totals['hessian'] -= (exog.T * (fitted * (1 - fitted))) @ exog
+            totals['separated'] &= is_separated(fitted, endog)
+            
+        return totals
+    
+    with tempfile.TemporaryDirectory() as spill_dir:
+        read_chunks = replayable_chunks(chunks, ['denied'] + independent_vars, spill_dir)
+        
+        params = np.zeros(var_count)
+        iterations = 0
+        step = np.full(var_count, np.inf)
+        error = None
+        
+        while iterations < maxiter and np.any(np.abs(step) > tol):
+            totals = one_pass(params)
+            
+            if totals['records'] == 0:
+                error = 'No records'
+            elif totals['separated']:
+                error = repr(PerfectSeparationError(SEPARATION_MESSAGE))
+            else:
+                try:
+                    step = newton_step(totals['hessian'], totals['score'], totals['records'])
+                except np.linalg.LinAlgError as solve_error:
+                    error = repr(solve_error)
+            if error is not None:
+                break
+            
+            params = params - step
+            iterations += 1
+        
+        ### One more pass for the standard errors and likelihood at the final coefficients
+        if error is None:
+            totals = one_pass(params)
+            
+            try:
+                with np.errstate(invalid = 'ignore'):
+                    bse = np.sqrt(np.diag(np.linalg.inv(-totals['hessian'])))
+            except np.linalg.LinAlgError as inverse_error:
+                error = repr(inverse_error)
+    
+    if error is not None:
+        empty = np.full(var_count, np.nan)
+        fit_info = {'converged': np.nan, 'iterations': np.nan, 'records': totals['records'], 'llf': np.nan,
+                    'llnull': np.nan, 'psuedo_rsquare': np.nan, 'error': error}
+        return logit_results_frame(names, empty, empty, np.nan), fit_info
+    
+    llnull = null_loglike(totals['records'], totals['denied'])
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        prsquared = 1 - np.float64(totals['llf'])/llnull
+    
+    fit_info = {'converged': iterations < maxiter, 'iterations': iterations, 'records': totals['records'],
+                'llf': totals['llf'], 'llnull': llnull, 'psuedo_rsquare': prsquared, 'error': None}
+    
+    return logit_results_frame(names, params, bse, prsquared), fit_info
+
+
+def _init_evaluation_worker(data, independent_vars, fit_kwargs, threshold, single_thread = False):
+    
+    _init_group_worker(data, None, None, fit_kwargs, single_thread)
+    _worker_data['independent_vars'] = independent_vars
+    _worker_data['threshold'] = threshold
+    
+    
+def _evaluate_fold_task(task):
+    
+    fold, train_index, test_index = task
+    data = _worker_data['data']
+    fit_kwargs = _worker_data['fit_kwargs'] if _worker_data['fit_kwargs'] is not None else {'disp': 0}
+    
+    model = run_regression(data = data.iloc[train_index], formula = create_formula(_worker_data['independent_vars']))
+    results = model.fit(**fit_kwargs)
+    
+    test_df = data.iloc[test_index]
+    predicted = results.predict(test_df)
+    
+    scores = {'fold': fold, 'train_records': len(train_index), 'converged': results.mle_retvals['converged'],
+              'psuedo_rsquare': results.prsquared}
+    scores.update(score_predictions(test_df['denied'], predicted, _worker_data['threshold']))
+    
+    return scores
+
+
+def evaluate_model(df, independent_vars, folds = 5, holdout = None, processes = None, threshold = 0.5, 
+                   random_state = 303, fit_kwargs = None):
+    '''
+    Out-of-sample check of a model: stratified k-fold refits, or a single stratified holdout when holdout
+    is the share of records to hold out. Folds are fit in parallel and each one is scored on records it didn't see
+    Returns one row per fold with the confusion matrix counts, accuracy, recall and binned calibration
+    Records with a null outcome or variable are dropped before splitting, the fits would drop them anyway
+    '''
+    
+    data = df[['denied'] + list(independent_vars)].dropna().reset_index(drop = True)
+    denied = data['denied'].values
+    
+    if holdout is not None:
+        train_index, test_index = train_test_split(np.arange(len(data)), test_size = holdout, stratify = denied,
+                                                   random_state = random_state)
+        tasks = [('holdout', train_index, test_index)]
+    else:
+        splitter = StratifiedKFold(n_splits = folds, shuffle = True, random_state = random_state)
+        tasks = [(fold, train_index, test_index) 
+                 for fold, (train_index, test_index) in enumerate(splitter.split(np.zeros(len(data)), denied))]
+    
+    if processes == 1 or len(tasks) == 1:
+        _init_evaluation_worker(data, independent_vars, fit_kwargs, threshold)
+        scores = [_evaluate_fold_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(min(processes or len(tasks), len(tasks)), initializer = _init_evaluation_worker,
+                                  initargs = (data, independent_vars, fit_kwargs, threshold, True)) as pool:
+            scores = pool.map(_evaluate_fold_task, tasks, chunksize = 1)
+    
+    return pd.DataFrame(scores)